@@ -3,16 +3,25 @@
 alert_worker.py
 Отправляет bundle-алерты в Telegram по правилам из таблицы address_alerts.
 
-Алгоритм по каждому активному правилу:
-  1. Берём все выводы (flow='out') за последние time_gap_min минут
-     из tracked_transactions по адресу address_to_track.
+Правила группируются по address_to_track: выводы (flow='out') читаются
+из tracked_transactions один раз на адрес за максимальный time_gap_min
+его правил (services/alert_planner.py). Далее по каждому правилу:
+  1. Берём из общего среза выводы за последние time_gap_min минут.
   2. Оставляем транзакции, попадающие в диапазон
         min_transfer_amount  ≤ amount ≤  max_transfer_amount (если задан).
-  3. Если кол-во ≥ min_cnt и (max(amount)-min(amount)) ≤ amount_step – шлём алерт.
+  3. Ищем среди них наибольшую группу с (max(amount)-min(amount)) ≤ amount_step;
+     если в ней ≥ min_cnt выводов – пишем алерт по этой группе в outbox
+     (services/alert_outbox.py) с ключом rule_id + signatures группы:
+     тот же бандл на следующих проходах не дублируется. Затем outbox
+     разгружается в Telegram, sent-флаги ставятся пакетно.
+
+ALERT_MODE=stream: вместо опроса читаем Redis Stream, в который трекер
+публикует новые трансферы, и ищем кластеры инкрементально
+(services/bundle_stream.py) — алерт уходит сразу после записи трансферов.
 """
 
 import asyncio, logging, os
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timezone
 
 import numpy as np
 import pandas as pd
@@ -20,6 +29,15 @@ from dotenv import load_dotenv
 from supabase import create_client
 from telegram import Bot, constants
 
+from services.alert_outbox import AlertOutbox, OutboxAlert
+from services.alert_planner import AddressPlan, TxWindow, plan_by_address
+from services.telegram_delivery import TelegramDelivery
+from services.bundle_stream import (BundleStreamEngine, backlog_signatures, consume_transfers,
+                                    load_offset, transfer_from_row)
+from services.bundle_cluster import largest_cluster, rule_bounds
+from utils.time_utils import utc_iso, window_start
+from utils.loop_monitor import start_from_env as start_loop_monitor
+
 # ───────────── env / init ─────────────
 load_dotenv()
 
@@ -27,9 +45,13 @@ SUPABASE_URL  = os.getenv("SUPABASE_URL")
 SUPABASE_KEY  = os.getenv("SUPABASE_KEY")
 BOT_TOKEN     = os.getenv("TELEGRAM_BOT_TOKEN")
 POLL_SEC      = int(os.getenv("ALERT_POLL_SEC", 30))
+REDIS_URL     = os.getenv("REDIS_URL")
+ALERT_MODE    = os.getenv("ALERT_MODE", "poll")   # poll | stream
 
 sb  = create_client(SUPABASE_URL, SUPABASE_KEY)
 bot = Bot(BOT_TOKEN)
+outbox = AlertOutbox(sb)
+delivery = TelegramDelivery(bot)
 
 logging.basicConfig(
     level=logging.INFO,
@@ -51,10 +73,10 @@ def fetch_active_alerts():
     return res
 
 
-def fetch_transactions(addr: str, since: datetime) -> pd.DataFrame:
+def fetch_transactions(addr: str, since: datetime) -> list[dict]:
     """Выборка трансферов из tracked_transactions для адреса после since"""
-    since_iso = since.replace(tzinfo=timezone.utc).isoformat()
-    res = (
+    since_iso = utc_iso(since)
+    return (
         sb.table("tracked_transactions")
           .select("*")
           .filter("tracked_address", "eq", addr)
@@ -62,11 +84,10 @@ def fetch_transactions(addr: str, since: datetime) -> pd.DataFrame:
           .filter("block_time", "gte", since_iso)
           .execute()
     ).data or []
-    return pd.DataFrame(res)
 
 
-async def send_alert(task: dict, df: pd.DataFrame):
-    """Формируем и отправляем сообщение"""
+def format_alert(task: dict, df: pd.DataFrame) -> str:
+    """Текст сообщения об алерте"""
     addr  = task["address_to_track"]
     cnt   = len(df)
 
@@ -77,7 +98,7 @@ async def send_alert(task: dict, df: pd.DataFrame):
 
     tos = ", ".join(sorted(set(df["to"]))[:10])  # не больше 10 адресов
 
-    msg = (
+    return (
         "🚨 *BUNDLE ALERT!* 🚨\n\n"
         f"*Кошелёк*: `{addr}`\n"
         f"*Выводов*: *{cnt}*  за последние *{task['time_gap_min']} мин*\n"
@@ -88,55 +109,140 @@ async def send_alert(task: dict, df: pd.DataFrame):
         f"_Отправлено c_ `{addr}`"
     )
 
-    await bot.send_message(
-        chat_id=task["chat_id"],
-        text=msg,
-        parse_mode=constants.ParseMode.MARKDOWN,
+
+def to_outbox(task: dict, df: pd.DataFrame) -> OutboxAlert:
+    return OutboxAlert(task, list(df["signature"]), format_alert(task, df), constants.ParseMode.MARKDOWN)
+
+
+async def send_alert(entry: dict):
+    """Отправка записи из outbox через очередь доставки (лимиты, склейка алертов чата)"""
+    await delivery.send_message(
+        entry["chat_id"],
+        entry["text"],
+        merge=True,
+        parse_mode=entry.get("parse_mode"),
         disable_web_page_preview=True,
     )
-    logging.info("Alert sent to chat %s for %s", task["chat_id"], addr)
+    logging.info("Alert sent to chat %s (%s)", entry["chat_id"], entry["alert_key"])
 
 
-def need_alert(task: dict, df: pd.DataFrame) -> bool:
-    """Проверяем правила"""
-    if df.empty:
-        return False
-    if len(df) < task["min_cnt"]:
-        return False
+async def flush_alerts(alerts: list[OutboxAlert]):
+    """Один upsert в outbox за проход, затем доставка pending-записей."""
+    if alerts:
+        new = await asyncio.to_thread(outbox.enqueue, alerts)
+        logging.info("Outbox: %d detected, %d new", len(alerts), new)
+    await outbox.drain(send_alert)
 
-    # диапазон сумм (лампорты)
-    if "min_transfer_amount" in task and task["min_transfer_amount"] is not None:
-        df = df[df["amount"] >= int(float(task["min_transfer_amount"]) * LAMPORT)]
-    if "max_transfer_amount" in task and task["max_transfer_amount"] is not None:
-        df = df[df["amount"] <= int(float(task["max_transfer_amount"]) * LAMPORT)]
-    if len(df) < task["min_cnt"]:
-        return False
 
-    diff = (df["amount"].max() - df["amount"].min()) / LAMPORT
-    return diff <= float(task["amount_step"])
+def need_alert(task: dict, window: TxWindow, now: datetime) -> list[dict]:
+    """
+    Строки бандла правила: наибольший кластер выводов за time_gap_min с
+    суммами в [min_transfer_amount, max_transfer_amount] и разбросом
+    ≤ amount_step (services/bundle_cluster.py). Пусто — алерта нет.
+    Ключ outbox, текст и sent-флаги строятся только по этим строкам,
+    поэтому прочие трансферы окна не меняют ключ и не помечаются отправленными.
+    """
+    start = window.start_index(window_start(task["time_gap_min"], now))
+    group_idx = largest_cluster(window.lamports[start:], **rule_bounds(task)) + start
+    return [window.rows[i] for i in group_idx]
 
 
 # ───────────── main loop ─────────────
-async def handle_task(task: dict):
-    ago   = datetime.now(timezone.utc) - timedelta(minutes=task["time_gap_min"])
-    df    = fetch_transactions(task["address_to_track"], ago)
+def handle_task(task: dict, window: TxWindow, now: datetime) -> OutboxAlert | None:
+    group = need_alert(task, window, now)
+    if group:
+        return to_outbox(task, pd.DataFrame(group))
+    return None
+
 
-    if need_alert(task, df):
-        await send_alert(task, df)
+async def handle_address(plan: AddressPlan, now: datetime) -> list[OutboxAlert]:
+    """Один запрос за объединённым окном адреса, затем все его правила в памяти."""
+    window = TxWindow(await asyncio.to_thread(fetch_transactions, plan.address, plan.since(now)))
+    return [a for a in (handle_task(t, window, now) for t in plan.rules) if a]
 
 
 async def main_loop():
+    start_loop_monitor("alert_worker")
     while True:
         tasks = fetch_active_alerts()
         if not tasks:
             logging.info("No active alert rules")
         else:
-            await asyncio.gather(*(handle_task(t) for t in tasks))
+            now = datetime.now(timezone.utc)
+            found = await asyncio.gather(*(handle_address(p, now) for p in plan_by_address(tasks)))
+            try:
+                await flush_alerts([a for batch in found for a in batch])
+            except Exception as e:
+                logging.error("Outbox flush failed: %s", e, exc_info=True)
         await asyncio.sleep(POLL_SEC)
 
 
+# ───────────── stream mode ─────────────
+async def load_stream_rules(engine: BundleStreamEngine, skip: set = frozenset()):
+    """Подтягивает правила; новые адреса прогреваются из БД без алертов (кроме подписей skip)."""
+    tasks = await asyncio.to_thread(fetch_active_alerts)
+    known = set(engine.addresses)
+    engine.set_rules(tasks)
+    now = datetime.now(timezone.utc)
+    for plan in plan_by_address(tasks):
+        if plan.address in known:
+            continue
+        rows = await asyncio.to_thread(fetch_transactions, plan.address, plan.since(now))
+        transfers = [t for t in map(transfer_from_row, rows) if t and t["signature"] not in skip]
+        engine.ingest(plan.address, transfers, prime=True)
+
+
+async def refresh_stream_rules(engine: BundleStreamEngine):
+    """
+    Периодически обновляет правила движка и разгружает outbox: on_alert
+    разгружает его только при новом бандле, а неотправленные и зависшие
+    в sending записи должны уходить и без него — как в режиме опроса.
+    """
+    while True:
+        await asyncio.sleep(POLL_SEC)
+        try:
+            await load_stream_rules(engine)
+        except Exception as e:
+            logging.error("Stream rules refresh failed: %s", e, exc_info=True)
+        try:
+            await outbox.drain(send_alert)
+        except Exception as e:
+            logging.error("Outbox flush failed: %s", e, exc_info=True)
+
+
+async def stream_loop():
+    """
+    Алерты по мере поступления трансферов из Redis Stream трекера
+    (services/bundle_stream.py) вместо опроса tracked_transactions.
+    """
+    from services.redis_pool import close_async_redis, get_async_redis
+
+    start_loop_monitor("alert_worker")
+    engine = BundleStreamEngine()
+    redis_async = get_async_redis(REDIS_URL)
+
+    async def on_alert(task: dict, group: list[dict]):
+        await flush_alerts([to_outbox(task, pd.DataFrame(group))])
+
+    # Правила и прогрев — до чтения потока, иначе дочитанные после простоя
+    # сообщения пройдут мимо пустого движка. Трансферы из недочитанного
+    # хвоста в прогрев не берутся: они придут из потока и дадут алерт.
+    offset = await load_offset(redis_async)
+    skip = await backlog_signatures(redis_async, offset) if offset else set()
+    await load_stream_rules(engine, skip)
+    if skip:
+        logging.info("Stream: дочитываем %d трансферов, опубликованных за время простоя", len(skip))
+
+    refresher = asyncio.create_task(refresh_stream_rules(engine))
+    try:
+        await consume_transfers(redis_async, engine, on_alert, last_id=offset or "$")
+    finally:
+        refresher.cancel()
+        await close_async_redis()
+
+
 if __name__ == "__main__":
     try:
-        asyncio.run(main_loop())
+        asyncio.run(stream_loop() if ALERT_MODE == "stream" and REDIS_URL else main_loop())
     except KeyboardInterrupt:
         logging.info("Stopped by user")
@@ -16,7 +16,11 @@ import logging
 from logging.handlers import RotatingFileHandler
 from datetime import datetime, timezone, timedelta
 
-from supabase_client import supabase
+from services.supabase_async import get_client
+from services.lease_lock import run_singleton
+from services.redis_pool import get_redis
+from services import launchpad_cache
+from utils.loop_monitor import start_from_env as start_loop_monitor
 from fetch_tokens import fetch_tokens
 import fetch_dev_pnl
 
@@ -41,6 +45,7 @@ TOKEN_FETCH_LOOP_SLEEP_SECONDS = 20
 DEV_DISCOVERY_TOKEN_HOURS = 48     # оставляем как есть
 DEV_DISCOVERY_LOOP_SLEEP_SECONDS = 300
 DEV_STATS_LOOP_SLEEP_SECONDS = 10  # короткая пауза; high‑throughput
+LOOP_LEASE_TTL = int(os.getenv("LOOP_LEASE_TTL", 60))  # аренда циклов при нескольких репликах
 
 # --- Функции-помощники ---
 
@@ -58,17 +63,12 @@ async def safe_upsert(table: str, rows: list, *, on_conflict: str,
     Upsert rows to Supabase in manageable chunks with exponential
     back‑off & jitter to avoid http2 stream resets / 429 throttling.
     """
-    loop = asyncio.get_event_loop()
+    client = await get_client()
     for i in range(0, len(rows), chunk):
         part = rows[i:i + chunk]
         for attempt in range(1, max_retries + 1):
             try:
-                await loop.run_in_executor(
-                    None,
-                    lambda p=part: supabase.table(table)
-                                    .upsert(p, on_conflict=on_conflict)
-                                    .execute()
-                )
+                await client.table(table).upsert(part, on_conflict=on_conflict).execute()
                 break  # success
             except Exception as exc:
                 if attempt == max_retries:
@@ -102,7 +102,10 @@ async def token_fetch_loop():
         logger.info("TOKEN_FETCH_LOOP: [START] Looking for new tokens...")
         try:
             # Вызываем вашу функцию из fetch_tokens.py
-            await fetch_tokens(categories=["new_creation", "completed", "completing"])
+            tokens = await fetch_tokens(categories=["new_creation", "completed", "completing"])
+            new_launchpads = await launchpad_cache.note_launchpads(t.get("launchpad") for t in tokens or [])
+            if new_launchpads:
+                logger.info("TOKEN_FETCH_LOOP: new launchpads: %s", ", ".join(new_launchpads))
         except Exception as e:
             logger.error(f"TOKEN_FETCH_LOOP: A critical error occurred: {e}", exc_info=True)
         
@@ -117,13 +120,13 @@ async def dev_stats_update_loop():
     while True:
         logger.info("DEV_STATS_LOOP: [START] Looking for developers to update...")
         try:
-            loop = asyncio.get_event_loop()
-            response = await loop.run_in_executor(None, 
-                lambda: supabase.table("developer_stats")
-                            .select("developer_address")
-                            .order("last_updated_at", desc=False, nullsfirst=True)
-                            .limit(DEV_STATS_BATCH_SIZE)
-                            .execute()
+            client = await get_client()
+            response = await (
+                client.table("developer_stats")
+                      .select("developer_address")
+                      .order("last_updated_at", desc=False, nullsfirst=True)
+                      .limit(DEV_STATS_BATCH_SIZE)
+                      .execute()
             )
             
             if not response.data:
@@ -174,17 +177,17 @@ async def developer_discovery_loop():
     while True:
         logger.info("DEV_DISCOVERY_LOOP: [START] Looking for new developers from recent tokens...")
         try:
-            loop = asyncio.get_event_loop()
+            client = await get_client()
             
             # ИСПРАВЛЕНИЕ: Добавляем временной фильтр
             time_window_start = datetime.now(timezone.utc) - timedelta(hours=DEV_DISCOVERY_TOKEN_HOURS)
             
-            creators_res = await loop.run_in_executor(None,
-                lambda: supabase.table("tokens")
-                            .select("creator")
-                            .in_("category", ["completed", "completing", "migrated"])
-                            .gte("migration_time", time_window_start.isoformat()) # <-- ФИЛЬТР ПО ВРЕМЕНИ
-                            .execute()
+            creators_res = await (
+                client.table("tokens")
+                      .select("creator")
+                      .in_("category", ["completed", "completing", "migrated"])
+                      .gte("migration_time", time_window_start.isoformat()) # <-- ФИЛЬТР ПО ВРЕМЕНИ
+                      .execute()
             )
             
             if not creators_res.data:
@@ -202,13 +205,13 @@ async def developer_discovery_loop():
             known_devs = set()
             for i in range(0, len(creators), 500):
                 batch = creators[i:i + 500]
-                known_res = await loop.run_in_executor(None, lambda b=batch: supabase.table("developer_stats").select("developer_address").in_("developer_address", b).execute())
+                known_res = await client.table("developer_stats").select("developer_address").in_("developer_address", batch).execute()
                 if known_res.data: known_devs.update(item['developer_address'] for item in known_res.data)
             new_devs = list(set(creators) - known_devs)
             if new_devs:
                 logger.info(f"DEV_DISCOVERY_LOOP: Found {len(new_devs)} new developers.")
                 data_to_insert = [{"developer_address": addr} for addr in new_devs]
-                await loop.run_in_executor(None, lambda: supabase.table("developer_stats").upsert(data_to_insert, on_conflict="developer_address").execute())
+                await client.table("developer_stats").upsert(data_to_insert, on_conflict="developer_address").execute()
             else:
                 logger.info("DEV_DISCOVERY_LOOP: No new developers found this cycle.")
 
@@ -219,13 +222,20 @@ async def developer_discovery_loop():
         await asyncio.sleep(DEV_DISCOVERY_LOOP_SLEEP_SECONDS)
 
 
+def _redis_client():
+    return get_redis(os.getenv("REDIS_URL"))
+
+
 async def main():
     logger.info("BACKGROUND WORKER: Starting all automatic loops...")
+    start_loop_monitor("background_worker")
     # УДАЛИЛИ trader_fetch_loop
+    # Каждый цикл выполняется только в одной реплике — у владельца своей аренды
+    redis_client = _redis_client()
     await asyncio.gather(
-        token_fetch_loop(),
-        developer_discovery_loop(),
-        dev_stats_update_loop()
+        run_singleton(redis_client, "token_fetch_loop", lambda lease: token_fetch_loop(), ttl=LOOP_LEASE_TTL),
+        run_singleton(redis_client, "developer_discovery_loop", lambda lease: developer_discovery_loop(), ttl=LOOP_LEASE_TTL),
+        run_singleton(redis_client, "dev_stats_update_loop", lambda lease: dev_stats_update_loop(), ttl=LOOP_LEASE_TTL),
     )
 
 if __name__ == "__main__":
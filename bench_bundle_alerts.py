@@ -0,0 +1,90 @@
+"""
+Синтетический бенчмарк кластеризации бандлов: старый Decimal-цикл из
+check_bundle_alerts против векторной версии services/bundle_cluster.
+
+Запуск:  python bench_bundle_alerts.py [transfers] [rules]
+По умолчанию 10 000 трансферов на адрес и 300 правил.
+"""
+import sys
+import time
+from decimal import Decimal
+
+import numpy as np
+
+from services.bundle_cluster import largest_cluster, lamports_array, rule_bounds
+
+
+def legacy_cluster(raw_txs, rule):
+    """Копия прежнего алгоритма check_bundle_alerts (Decimal + срезы списков)."""
+    min_cnt = rule.get("min_cnt")
+    amount_eps = Decimal(str(rule.get("amount_step", "0.1")))
+    amin = Decimal(str(rule.get("min_transfer_amount", "0")))
+    amax_val = rule.get("max_transfer_amount")
+    amax = Decimal(str(amax_val)) if amax_val is not None else None
+
+    txs = []
+    for t in raw_txs:
+        dec = int(t.get("decimals") or 9)
+        amount_sol = Decimal(t["amount"]) / (10 ** dec)
+        if amount_sol < amin:
+            continue
+        if amax is not None and amount_sol > amax:
+            continue
+        t["amount_sol"] = amount_sol
+        txs.append(t)
+
+    if len(txs) < min_cnt:
+        return []
+
+    txs_sorted = sorted(txs, key=lambda t: t["amount_sol"])
+    max_group = []
+    left = 0
+    for right in range(len(txs_sorted)):
+        while (txs_sorted[right]["amount_sol"] - txs_sorted[left]["amount_sol"]) > amount_eps:
+            left += 1
+        current_group = txs_sorted[left:right + 1]
+        if len(current_group) > len(max_group) and len(current_group) >= min_cnt:
+            max_group = current_group
+    return max_group if len(max_group) >= min_cnt else []
+
+
+def make_data(n_transfers, n_rules, seed=42):
+    rng = np.random.default_rng(seed)
+    amounts = rng.integers(10_000_000, 50_000_000_000, size=n_transfers)   # 0.01 – 50 SOL
+    txs = [{"id": i, "amount": str(int(a)), "decimals": 9, "to": f"to{i}"} for i, a in enumerate(amounts)]
+    rules = []
+    for _ in range(n_rules):
+        lo = float(rng.uniform(0, 10))
+        rules.append({
+            "min_cnt": int(rng.integers(2, 6)),
+            "amount_step": round(float(rng.uniform(0.001, 0.05)), 4),
+            "min_transfer_amount": round(lo, 2),
+            "max_transfer_amount": round(lo + float(rng.uniform(1, 40)), 2) if rng.random() < 0.7 else None,
+        })
+    return txs, rules
+
+
+def main():
+    n_transfers = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    n_rules = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    txs, rules = make_data(n_transfers, n_rules)
+    print(f"Трансферов: {n_transfers}, правил: {n_rules}")
+
+    t0 = time.perf_counter()
+    legacy = [len(legacy_cluster(txs, r)) for r in rules]
+    t_legacy = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    lamports = lamports_array(txs)                      # один раз на адрес
+    fast = [len(largest_cluster(lamports, **rule_bounds(r))) for r in rules]
+    t_fast = time.perf_counter() - t0
+
+    mismatches = sum(a != b for a, b in zip(legacy, fast))
+    print(f"Decimal-цикл: {t_legacy:.3f}s")
+    print(f"NumPy:        {t_fast:.3f}s")
+    print(f"Ускорение:    x{t_legacy / t_fast:.1f}")
+    print(f"Расхождений в размере группы: {mismatches}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Нагрузочный бенчмарк обработки апдейтов бота: задержка лёгких
+обработчиков (p50/p99), когда часть пользователей запускает тяжёлые
+операции.
+
+Режимы:
+  sequential — как PTB по умолчанию (один апдейт за раз);
+  ordered    — services/update_processor.UserOrderedUpdateProcessor,
+               тяжёлая операция занимает очередь своего пользователя;
+  ordered+heavy — то же, тяжёлый обработчик помечен @heavy_operation:
+               в очереди пользователя остаётся только его быстрая часть.
+
+Генератор: USERS пользователей шлют апдейты с экспоненциальными
+паузами, доля HEAVY_SHARE из них — тяжёлые (HEAVY_SEC секунд await),
+остальные — лёгкие (LIGHT_SEC). Проверяется и порядок: апдейты
+пользователя в его очереди (для @heavy_operation — часть, работающая с
+user_data) должны завершаться в порядке отправки.
+
+Запуск:  python bench_update_processor.py [users] [seconds]
+По умолчанию 200 пользователей, 10 секунд нагрузки.
+"""
+import asyncio
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+import numpy as np
+from telegram.ext import SimpleUpdateProcessor
+
+from services.update_processor import UserOrderedUpdateProcessor, heavy_operation
+
+RATE_PER_USER = 0.5     # апдейтов в секунду на пользователя
+HEAVY_SHARE = 0.02
+HEAVY_SEC = 2.0
+LIGHT_SEC = 0.02
+
+
+def make_load(users, seconds, seed=42):
+    rng = random.Random(seed)
+    events = []
+    for user in range(users):
+        t, seq = rng.expovariate(RATE_PER_USER), 0
+        while t < seconds:
+            events.append((t, user, seq, rng.random() < HEAVY_SHARE))
+            t += rng.expovariate(RATE_PER_USER)
+            seq += 1
+    return sorted(events)
+
+
+async def run_mode(mode, events):
+    processor = SimpleUpdateProcessor(1) if mode == "sequential" else UserOrderedUpdateProcessor()
+    latencies, done_order, tasks = [], {}, []
+    context = SimpleNamespace(
+        user_data={}, bot=None,
+        application=SimpleNamespace(create_task=lambda coro, update=None, name=None: tasks.append(asyncio.create_task(coro)),
+                                    update_processor=processor),
+    )
+
+    async def light(update):
+        await asyncio.sleep(LIGHT_SEC)
+        latencies.append(time.perf_counter() - update.arrived)
+        done_order.setdefault(update.effective_user.id, []).append(update.seq)
+
+    async def heavy_inline(update, _context):
+        await asyncio.sleep(HEAVY_SEC)
+        done_order.setdefault(update.effective_user.id, []).append(update.seq)
+
+    async def heavy_ordered_part(update, _context):
+        done_order.setdefault(update.effective_user.id, []).append(update.seq)
+        return asyncio.sleep(HEAVY_SEC)
+
+    heavy_detached = heavy_operation(heavy_ordered_part)
+
+    start = time.perf_counter()
+    for at, user, seq, is_heavy in events:
+        delay = start + at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        user_obj = SimpleNamespace(id=user)
+        update = SimpleNamespace(effective_user=user_obj, effective_chat=user_obj, callback_query=None,
+                                 seq=seq, arrived=time.perf_counter())
+        if not is_heavy:
+            handler = light(update)
+        elif mode == "ordered+heavy":
+            handler = heavy_detached(update, context)
+        else:
+            handler = heavy_inline(update, context)
+        tasks.append(asyncio.create_task(processor.process_update(update, handler)))
+    while tasks:
+        pending, tasks[:] = list(tasks), []
+        await asyncio.gather(*pending)
+
+    ordered = all(seqs == sorted(seqs) for seqs in done_order.values())
+    return np.array(latencies) * 1000, ordered, time.perf_counter() - start
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    events = make_load(users, seconds)
+    heavy = sum(e[3] for e in events)
+    print(f"Пользователей: {users}, апдейтов: {len(events)} (тяжёлых {heavy}), нагрузка {seconds:.0f}s")
+    for mode in ("sequential", "ordered", "ordered+heavy"):
+        lat, ordered, wall = asyncio.run(run_mode(mode, events))
+        print(f"{mode:14s} лёгкие: p50={np.percentile(lat, 50):8.1f}ms  p99={np.percentile(lat, 99):8.1f}ms  "
+              f"max={lat.max():8.1f}ms  порядок={'OK' if ordered else 'НАРУШЕН'}  всего {wall:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,7 @@
 Отвечает за инициализацию, регистрацию обработчиков и запуск бота.
 """
 
+import asyncio
 import logging
 from telegram.ext import (
     Application,
@@ -22,6 +23,11 @@ from jobs.check_bundle_alerts import check_bundle_alerts # TODO: Раскомм
 from handlers import commands, callbacks, messages
 from handlers.conv_activate import conv_activate
 from jobs.price_job import update_sol_price_job
+from services.redis_pool import get_redis
+from utils.loop_monitor import start_from_env as start_loop_monitor
+from services import update_queue
+from services.redis_persistence import RedisPersistence
+from services.update_processor import UserOrderedUpdateProcessor
 
 # --- Настройка логирования ---
 logging.basicConfig(
@@ -33,24 +39,34 @@ logger = logging.getLogger(__name__)
 
 async def post_init(application: Application):
     """Выполняется после инициализации приложения, перед запуском polling'а."""
+    start_loop_monitor("bot")   # LOOP_MONITOR=1 — замер лагов loop'а и стеки блокировок
     await application.bot.set_my_commands([
         BotCommand("start", "🚀 Запустить / Сменить язык"),
         BotCommand("language", "⚙️ Сменить язык"),
     ])
     
     # TODO: Раскомментируйте этот блок, когда перенесете check_bundle_alerts в jobs/
-    application.job_queue.run_repeating(
-        check_bundle_alerts,
-        interval=30,
-        first=15,
-        name="bundle_alerts_job"
-    )
+    # Алерты шлёт одна реплика, иначе каждый уйдёт BOT_SHARDS раз
+    if update_queue.is_primary():
+        application.job_queue.run_repeating(
+            check_bundle_alerts,
+            interval=30,
+            first=15,
+            name="bundle_alerts_job"
+        )
     application.job_queue.run_repeating(
         update_sol_price_job, 
         interval=3600, 
         first=1, 
         name="update_sol_price"
     )
+    # Пул Redis открывает соединение заранее и в потоке — не в обработчике пользователя
+    redis_client = get_redis()
+    if redis_client:
+        try:
+            await asyncio.to_thread(redis_client.ping)
+        except Exception as e:
+            logger.warning(f"Redis недоступен при старте: {e}")
     logger.info("Команды бота установлены.")
 
 
@@ -61,12 +77,15 @@ def main():
         return
 
     # 1. Собираем приложение
-    application = (
-        Application.builder()
-        .token(config.TELEGRAM_BOT_TOKEN)
-        .post_init(post_init)
-        .build()
-    )
+    # user_data (state, template_data, main_message_id, ...) живёт в Redis и переживает рестарт
+    builder = Application.builder().token(config.TELEGRAM_BOT_TOKEN).post_init(post_init)
+    if config.REDIS_URL:
+        builder = builder.persistence(RedisPersistence("bot"))
+    if config.BOT_MODE == "worker":
+        builder = builder.updater(None)   # апдейты приходят из очереди webhook_ingress.py
+    # Разные пользователи — параллельно, апдейты одного пользователя — по порядку
+    builder = builder.concurrent_updates(UserOrderedUpdateProcessor())
+    application = builder.build()
 
     # 2. Регистрируем обработчики из модулей
     # Каждый хендлер теперь указывает на функцию в соответствующем файле.
@@ -100,7 +119,10 @@ def main():
 
     # 3. Запускаем бота
     logger.info("Бот запускается...")
-    application.run_polling()
+    if config.BOT_MODE == "worker":
+        asyncio.run(update_queue.run_worker(application, "bot"))
+    else:
+        application.run_polling()
 
 
 if __name__ == "__main__":
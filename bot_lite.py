@@ -4,6 +4,7 @@
 Отвечает за инициализацию, регистрацию обработчиков и запуск бота.
 """
 
+import asyncio
 import logging
 from telegram.ext import (
     Application,
@@ -24,6 +25,10 @@ import handlers.commands_lite as commands
 import handlers.messages_lite as messages
 import handlers.callbacks_lite as callbacks # <-- Используем урезанную логику
 from jobs.price_job import update_sol_price_job
+from utils.loop_monitor import start_from_env as start_loop_monitor
+from services import update_queue
+from services.redis_persistence import RedisPersistence
+from services.update_processor import UserOrderedUpdateProcessor
 
 # --- Настройка логирования ---
 logging.basicConfig(
@@ -35,6 +40,7 @@ logger = logging.getLogger(__name__)
 
 async def post_init(application: Application):
     """Выполняется после инициализации приложения, перед запуском polling'а."""
+    start_loop_monitor("bot_lite")   # LOOP_MONITOR=1 — замер лагов loop'а и стеки блокировок
     await application.bot.set_my_commands([
         BotCommand("start", "🚀 Запустить бота"),
     ])
@@ -59,12 +65,15 @@ def main():
         return
 
     # 1. Собираем приложение
-    application = (
-        Application.builder()
-        .token(config.TELEGRAM_BOT_LITE_TOKEN) # Рассмотрите использование отдельного токена
-        .post_init(post_init)
-        .build()
-    )
+    # user_data живёт в Redis и переживает рестарт
+    builder = Application.builder().token(config.TELEGRAM_BOT_LITE_TOKEN).post_init(post_init)  # Рассмотрите использование отдельного токена
+    if config.REDIS_URL:
+        builder = builder.persistence(RedisPersistence("bot_lite"))
+    if config.BOT_MODE == "worker":
+        builder = builder.updater(None)   # апдейты приходят из очереди webhook_ingress.py
+    # Разные пользователи — параллельно, апдейты одного пользователя — по порядку
+    builder = builder.concurrent_updates(UserOrderedUpdateProcessor())
+    application = builder.build()
 
     # 2. Регистрируем урезанный список обработчиков
     
@@ -92,7 +101,10 @@ def main():
 
     # 3. Запускаем бота
     logger.info("Lite-бот запускается...")
-    application.run_polling()
+    if config.BOT_MODE == "worker":
+        asyncio.run(update_queue.run_worker(application, "bot_lite"))
+    else:
+        application.run_polling()
 
 
 if __name__ == "__main__":
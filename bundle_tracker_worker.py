@@ -1,11 +1,15 @@
 #!/usr/bin/env python3
-"""bundle_tracker_worker.py – MINIMAL (no‑dedup)
+"""bundle_tracker_worker.py
 
 ➊ Открыть страницу Solscan:
    https://solscan.io/account/{address}?exclude_amount_zero=false&remove_spam=false&flow=out&token_address=So11111111111111111111111111111111111111111#transfers
 ➋ Нажать «Export CSV»  →  «Download».
-➌ Сохранить CSV, прочитать Pandas‑ом и **целиком** вставить в таблицу `tracked_transactions` Supabase **без каких‑либо on‑conflict / dedup**.
-➍ Повторять каждые `POLL_INTERVAL` секунд.  Логи в консоль.
+➌ Сохранить CSV, прочитать Pandas‑ом, отфильтровать уже записанное по in‑memory watermark'у и подписям
+   (services/tx_watermarks.py) и сделать идемпотентный upsert в `tracked_transactions` по `signature`.
+➍ Повторять по расписанию: у каждого адреса свой интервал (старт `POLL_INTERVAL`), который сжимается
+   при новых трансферах и растёт при простое, но не выше половины минимального `time_gap_min`.  Логи в консоль.
+➎ При нескольких репликах работает только владелец аренды `bundle_tracker` (services/lease_lock.py),
+   остальные ждут в резерве и подхватывают работу, если владелец упал.
 """
 from __future__ import annotations
 
@@ -22,17 +26,34 @@ import re
 import numpy as np
 import pandas as pd
 from dotenv import load_dotenv
-from playwright.async_api import async_playwright, Browser, Page, TimeoutError as PwTimeout, Route, Playwright
+from playwright.async_api import async_playwright, Browser, Page, TimeoutError as PwTimeout, Error as PwError, Route, Playwright
 from supabase import create_client
 
+from services.proxy_manager import ProxyManager
+from services.redis_pool import get_redis
+from services.tx_watermarks import WatermarkStore
+from services.poll_scheduler import AdaptivePollScheduler
+from services.bundle_stream import publish_transfers
+from services.lease_lock import run_singleton
+from utils.time_utils import normalize_timestamps, timestamps_to_iso
+
 # ──────────── ENV ────────────
 load_dotenv()
 SUPABASE_URL  = os.getenv("SUPABASE_URL")
 SUPABASE_KEY  = os.getenv("SUPABASE_KEY")
+REDIS_URL     = os.getenv("REDIS_URL")
 HEADLESS      = os.getenv("HEADLESS", "1") == "1"
-POLL_INTERVAL = int(os.getenv("POLL_INTERVAL", 60)) # Увеличено для стабильности
+POLL_INTERVAL = int(os.getenv("POLL_INTERVAL", 60)) # Стартовый интервал опроса адреса
+MIN_POLL_INTERVAL = int(os.getenv("MIN_POLL_INTERVAL", 15))
+MAX_POLL_INTERVAL = int(os.getenv("MAX_POLL_INTERVAL", 3600))
+RULES_REFRESH_SEC = int(os.getenv("RULES_REFRESH_SEC", 60))
 DOWNLOAD_DIR  = os.getenv("DOWNLOAD_DIR", "downloads")
 MAX_RETRIES   = 3
+PROXY_CHECK_CONCURRENCY = int(os.getenv("PROXY_CHECK_CONCURRENCY", 5))
+PROXY_FAILURE_THRESHOLD = int(os.getenv("PROXY_FAILURE_THRESHOLD", 3))
+PROXY_COOLDOWN_SEC      = int(os.getenv("PROXY_COOLDOWN_SEC", 120))
+RECENT_SIGNATURES       = int(os.getenv("RECENT_SIGNATURES", 2000))
+TRACKER_LEASE_TTL       = int(os.getenv("TRACKER_LEASE_TTL", 60))
 
 logging.basicConfig(level=logging.INFO,
                     format="%(asctime)s %(levelname)s %(message)s",
@@ -131,7 +152,16 @@ async def click_dialog_download(page: Page) -> str | None:
         logging.error("Timeout waiting for Download dialog button.")
         return None
 
-async def grab_csv(address: str, browser: Browser) -> pd.DataFrame | None:
+class ProxyFailure(Exception):
+    """Страница не открылась на сетевом уровне (таймаут, net::ERR_*) — виноват прокси."""
+
+
+async def grab_csv(address: str, browser: Browser) -> tuple[pd.DataFrame | None, float]:
+    """
+    Возвращает (df, время навигации). Ошибки страницы и разбора CSV дают
+    (None, время) — прокси при этом отработал; сетевой сбой навигации
+    поднимает ProxyFailure.
+    """
     url = (
         f"https://solscan.io/account/{address}"
         "?exclude_amount_zero=false&remove_spam=false&flow=out"
@@ -139,130 +169,196 @@ async def grab_csv(address: str, browser: Browser) -> pd.DataFrame | None:
     )
     page = None
     ctx = None
+    nav_time = None
     try:
         ctx = await browser.new_context(user_agent=next(_ua_cycle), accept_downloads=True)
         page = await ctx.new_page()
         await page.route(BLOCK_RESOURCE_PATTERN, block_unnecessary_requests)
         
         logging.info("Navigating to Solscan for address %s", address)
-        await page.goto(url, timeout=120_000, wait_until="domcontentloaded")
-        
+        t0 = asyncio.get_running_loop().time()
+        try:
+            await page.goto(url, timeout=120_000, wait_until="domcontentloaded")
+        except (PwTimeout, PwError) as e:
+            raise ProxyFailure(str(e).split('\n')[0]) from e
+        nav_time = asyncio.get_running_loop().time() - t0
+
         await page.wait_for_selector("button:has-text('Export CSV'), div.text-sm.text-gray-500:has-text('Tx Hash')", timeout=120_000)
         logging.info("Page content loaded, ready to export.")
 
         await click_export(page)
         path = await click_dialog_download(page)
         
-        if not path: return None
+        if not path: return None, nav_time
             
         df = pd.read_csv(path)
         df.columns = [c.lower().replace(" ", "_") for c in df.columns]
         if "block_time" in df.columns:
-            df["block_time"] = df["block_time"].apply(_to_dt)
-        return df
+            df["block_time"] = normalize_timestamps(df["block_time"])
+        return df, nav_time
+    except ProxyFailure:
+        raise
     except PwTimeout as e:
         logging.error("Playwright Timeout for %s: %s", address, str(e).split('\n')[0])
-        return None
+        return None, nav_time
     except Exception as e:
         logging.error("General error in grab_csv for %s: %s", address, e)
-        return None
+        return None, nav_time
     finally:
         if page: await page.close()
         if ctx: await ctx.close()
 
 # ──────────── Helper functions ────────────
-def latest_ts(addr: str) -> datetime | None:
-    res = sb.table("tracked_transactions").select("block_time").eq("tracked_address", addr).order("block_time", desc=True).limit(1).execute()
-    return datetime.fromisoformat(res.data[0]["block_time"]) if res.data else None
+def recent_rows(addr: str) -> List[dict[str, Any]]:
+    """Холодный старт watermark'а: последние подписи адреса (один раз на адрес)."""
+    res = (sb.table("tracked_transactions")
+             .select("signature,block_time")
+             .eq("tracked_address", addr)
+             .order("block_time", desc=True)
+             .limit(RECENT_SIGNATURES)
+             .execute())
+    return res.data or []
+
+def _redis_client():
+    return get_redis(REDIS_URL)
+
+redis_client = _redis_client()
+watermarks = WatermarkStore(bootstrap=recent_rows, redis_client=redis_client, max_signatures=RECENT_SIGNATURES)
 
 def filter_new(df: pd.DataFrame, addr: str) -> pd.DataFrame:
-    last = latest_ts(addr)
-    return df if last is None else df[df["block_time"] > last]
+    return watermarks.filter_new(df, addr)
 
 def upsert_to_supabase(df: pd.DataFrame, address: str):
     df.columns = [c.lower().replace(" ", "_") for c in df.columns]
-    df = df.replace([np.inf, -np.inf], np.nan).where(pd.notnull(df), None)
-
+    signatures = df["signature"].tolist() if "signature" in df.columns else []
+    max_block_time = None
+    block_time_iso = None
     if "block_time" in df.columns:
-        df["block_time"] = df["block_time"].apply(_to_dt).apply(lambda x: x.isoformat() if pd.notna(x) else None)
+        block_time = normalize_timestamps(df["block_time"])
+        max_block_time = block_time.max()
+        block_time_iso = timestamps_to_iso(block_time)
+
+    df = df.replace([np.inf, -np.inf], np.nan).where(pd.notnull(df), None)
+    if block_time_iso is not None:
+        df["block_time"] = block_time_iso
 
     df["tracked_address"] = address
     rows: List[dict[str, Any]] = df.to_dict("records")
     if not rows: return
-    sb.table("tracked_transactions").insert(rows).execute()
-    logging.info("Inserted %d new rows for %s", len(rows), address)
- 
-def _to_dt(x):
-    if pd.isna(x): return pd.NaT
-    if isinstance(x, (int, float, np.integer)): return datetime.fromtimestamp(int(x), tz=timezone.utc)
-    if isinstance(x, pd.Timestamp): return x.to_pydatetime().replace(tzinfo=timezone.utc) if x.tzinfo is None else x.to_pydatetime()
-    if isinstance(x, datetime): return x.replace(tzinfo=timezone.utc) if x.tzinfo is None else x
-    try:
-        return datetime.fromisoformat(str(x)).replace(tzinfo=timezone.utc)
-    except (ValueError, TypeError):
-        return pd.NaT
+    # идемпотентно: повторная запись той же подписи ничего не меняет
+    sb.table("tracked_transactions").upsert(rows, on_conflict="signature", ignore_duplicates=True).execute()
+    watermarks.commit(address, signatures, max_block_time)
+    logging.info("Upserted %d new rows for %s", len(rows), address)
+    if redis_client is not None:
+        # потоковый детектор бандлов (alert_worker в режиме stream) получает пачку сразу
+        try:
+            publish_transfers(redis_client, address, rows)
+        except Exception as e:
+            logging.warning("Failed to publish transfers for %s: %s", address, e)
+
+# ──────────── Per-address fetch ────────────
+async def fetch_address(pw: Playwright, proxies: ProxyManager, addr: str) -> pd.DataFrame | None:
+    df = None
+    for attempt in range(MAX_RETRIES):
+        browser = None
+        proxy_url = proxies.acquire() # Самый здоровый/быстрый прокси с учётом веса
+        try:
+            logging.info("Processing address: %s (Attempt %d/%d via %s)", addr, attempt + 1, MAX_RETRIES, proxy_url)
+            browser = await pw.chromium.launch(headless=HEADLESS, proxy={"server": proxy_url})
+            df, nav_time = await grab_csv(addr, browser)
+            # страница открылась — прокси здоров, даже если экспорт/CSV не удался;
+            # в латентность идёт только навигация, не весь скрейп
+            if nav_time is not None:
+                proxies.report(proxy_url, True, nav_time)
+            if df is not None:
+                logging.info("Successfully fetched data for %s", addr)
+                break 
+        except ProxyFailure as e:
+            logging.warning("Proxy %s failed for %s: %s", proxy_url, addr, e)
+            proxies.report(proxy_url, False)
+        except Exception as e:
+            logging.error("Critical error during attempt %d for %s: %s", attempt + 1, addr, e)
+        finally:
+            if browser: await browser.close()
+        
+        if df is None:
+            logging.warning("Attempt %d failed for %s. Retrying with new proxy in 5 seconds...", attempt + 1, addr)
+            await asyncio.sleep(5)
+    return df
+
+def fetch_tracking_rules() -> List[dict[str, Any]]:
+    return (sb.table("address_alerts")
+              .select("address_to_track,time_gap_min")
+              .eq("is_active", True)
+              .execute().data or [])
 
 # ──────────── MAIN LOOP ────────────
 async def main():
     pw = await async_playwright().start()
     
     logging.info("Начинаю предварительную проверку всех прокси из списка...")
-    working_proxies = []
-    for proxy in PROXIES:
-        if await check_proxy(pw, proxy):
-            working_proxies.append(proxy)
-    
+    proxies = ProxyManager(
+        PROXIES,
+        probe=lambda proxy_url: check_proxy(pw, proxy_url),
+        failure_threshold=PROXY_FAILURE_THRESHOLD,
+        cooldown=PROXY_COOLDOWN_SEC,
+        probe_concurrency=PROXY_CHECK_CONCURRENCY,
+    )
+    working_proxies = await proxies.validate_all()
+
     if not working_proxies:
         logging.error("Не найдено ни одного рабочего прокси. Воркер не может быть запущен. Проверьте список прокси.")
         await pw.stop()
         return
 
     logging.info(f"Проверка завершена. Найдено рабочих прокси: {len(working_proxies)} из {len(PROXIES)}.")
-    _proxy_cycle = itertools.cycle(working_proxies)
+    reprobe_task = asyncio.create_task(proxies.reprobe_loop())
+    try:
+        await poll_loop(pw, proxies)
+    finally:
+        reprobe_task.cancel()
+        await pw.stop()
 
-    while True:
-        res = sb.table("address_alerts").select("address_to_track").execute().data or []
-        addresses = {row["address_to_track"] for row in res}
-        if not addresses:
-            logging.warning("No addresses to track in Supabase. Waiting...")
-            await asyncio.sleep(POLL_INTERVAL * 2)
-            continue
-
-        for addr in addresses:
-            df = None
-            for attempt in range(MAX_RETRIES):
-                browser = None
-                proxy_url = next(_proxy_cycle) # Берем следующий рабочий прокси
-                try:
-                    logging.info("Processing address: %s (Attempt %d/%d via %s)", addr, attempt + 1, MAX_RETRIES, proxy_url)
-                    browser = await pw.chromium.launch(headless=HEADLESS, proxy={"server": proxy_url})
-                    df = await grab_csv(addr, browser)
-                    if df is not None:
-                        logging.info("Successfully fetched data for %s", addr)
-                        break 
-                except Exception as e:
-                    logging.error("Critical error during attempt %d for %s: %s", attempt + 1, addr, e)
-                finally:
-                    if browser: await browser.close()
-                
-                if df is None:
-                    logging.warning("Attempt %d failed for %s. Retrying with new proxy in 5 seconds...", attempt + 1, addr)
-                    await asyncio.sleep(5)
 
-            if df is not None:
-                new_df = filter_new(df, addr)
-                if not new_df.empty:
-                    upsert_to_supabase(new_df, addr)
-                else:
-                    logging.info("No new transactions found for %s", addr)
+async def poll_loop(pw: Playwright, proxies: ProxyManager):
+    # Каждый адрес опрашивается по своему расписанию (services/poll_scheduler.py)
+    scheduler = AdaptivePollScheduler(POLL_INTERVAL, min_interval=MIN_POLL_INTERVAL, max_interval=MAX_POLL_INTERVAL)
+    loop = asyncio.get_running_loop()
+    rules_refreshed_at = float("-inf")
+
+    while True:
+        if loop.time() - rules_refreshed_at >= RULES_REFRESH_SEC:
+            scheduler.sync(fetch_tracking_rules())
+            rules_refreshed_at = loop.time()
+            if not len(scheduler):
+                logging.warning("No addresses to track in Supabase. Waiting...")
+                await asyncio.sleep(RULES_REFRESH_SEC)
+                continue
+
+        for addr in scheduler.pop_due():
+            df = await fetch_address(pw, proxies, addr)
+            if df is None:
+                logging.error("All %d attempts failed for address %s. Retrying in %d seconds.", MAX_RETRIES, addr, POLL_INTERVAL)
+                scheduler.retry_later(addr, POLL_INTERVAL)
+                continue
+
+            new_df = filter_new(df, addr)
+            if not new_df.empty:
+                upsert_to_supabase(new_df, addr)
             else:
-                logging.error("All %d attempts failed for address %s. Skipping for this cycle.", MAX_RETRIES, addr)
+                logging.info("No new transactions found for %s", addr)
+            interval = scheduler.report(addr, found_new=not new_df.empty)
+            logging.info("Next poll of %s in %.0f seconds.", addr, interval)
 
-        logging.info("Cycle finished. Waiting %d seconds for the next one.", POLL_INTERVAL)
-        await asyncio.sleep(POLL_INTERVAL)
+        wait = scheduler.seconds_until_next()
+        wait = RULES_REFRESH_SEC if wait is None else min(wait, RULES_REFRESH_SEC)
+        if wait > 0:
+            logging.info("Healthy proxies: %d/%d. Tracking %d addresses, next due in %.0f seconds.",
+                         len(proxies.healthy), len(PROXIES), len(scheduler), wait)
+            await asyncio.sleep(wait)
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        asyncio.run(run_singleton(redis_client, "bundle_tracker", lambda lease: main(), ttl=TRACKER_LEASE_TTL))
     except KeyboardInterrupt:
         logging.info("Interrupted by user.")
@@ -6,13 +6,20 @@ import json
 
 load_dotenv()
 
-celery = Celery('celery_app', broker=os.getenv('REDIS_URL'))
-
+# backend нужен chord'ам All-In Parse (результаты чанков собираются в финальную задачу)
+celery = Celery('celery_app', broker=os.getenv('REDIS_URL'), backend=os.getenv('REDIS_URL'))
+
+from services.task_routing import (
+    PRIORITY_BACKGROUND, PRIORITY_DEFAULT, PRIORITY_STEPS, QUEUE_API, QUEUE_PERIODIC, TASK_ROUTES,
+)
+from services.redis_pool import get_redis
+from services.task_eta import connect_signals
 from tasks.celery_tasks import run_all_in_parse_periodic_task
 
 celery.conf.timezone = 'UTC'
 celery.conf.broker_connection_retry_on_startup = True
 celery.conf.worker_cancel_long_running_tasks_on_connection_loss = True
+celery.conf.result_expires = 86400
 
 # Фикс BrokenPipe
 celery.conf.broker_heartbeat = 0
@@ -22,14 +29,30 @@ celery.conf.broker_transport_options = {
     'socket_connect_timeout': 60,
     'socket_keepalive': True,
     'retry_on_timeout': True,
+    # приоритетные полосы внутри очередей (services/task_routing.py)
+    'priority_steps': PRIORITY_STEPS,
+    'queue_order_strategy': 'priority',
 }
 
+# Очереди: selenium_heavy / api_light / periodic, у каждой свои воркеры
+celery.conf.task_routes = TASK_ROUTES
+celery.conf.task_default_queue = QUEUE_API
+celery.conf.task_default_priority = PRIORITY_DEFAULT
+# по одной задаче на процесс: иначе предвыборка обходит приоритеты и держит тяжёлые задачи в буфере
+celery.conf.worker_prefetch_multiplier = 1
+
+# История длительностей задач и занятые воркеры — для ETA в сообщениях очереди
+_redis = get_redis()
+if _redis:
+    connect_signals(_redis)
+
 ALL_IN_TEMPLATE = json.loads(os.getenv('ALL_IN_TEMPLATE_JSON', '{"time_period": "24h", "platforms": [], "categories": ["completed", "completing"]}'))
 
 # Запуск первой задачи при старте Celery
 @celery.on_after_configure.connect
 def setup_periodic_task(sender, **kwargs):
-    sender.send_task("tasks.celery_tasks.run_all_in_parse_periodic_task", args=(ALL_IN_TEMPLATE,), countdown=0)
+    sender.send_task("tasks.celery_tasks.run_all_in_parse_periodic_task", args=(ALL_IN_TEMPLATE,), countdown=0,
+                     queue=QUEUE_PERIODIC, priority=PRIORITY_BACKGROUND)
 
 celery.autodiscover_tasks(['tasks.celery_tasks'])
 
@@ -7,12 +7,14 @@ load_dotenv()
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 REDIS_URL = os.getenv("REDIS_URL")
 TELEGRAM_BOT_LITE_TOKEN = os.getenv("TELEGRAM_BOT_LITE_TOKEN")  # Токен для Lite-версии бота
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling | worker (реплика за webhook_ingress.py)
 # Пути
 CHROME_PROFILE_PATH = os.path.abspath("chrome_profile")
 FILES_DIR = os.path.abspath("pnl_files")
 SWAPS_FILES_DIR = os.path.abspath("swaps_files")
 TOP_TRADERS_DIR = os.path.abspath("top_traders_files") # Для новой функции
 DOWNLOAD_DIR = os.path.abspath("downloads")
+PAYLOAD_DIR = os.path.abspath("payloads")  # большие аргументы задач Celery, если нет Redis
 
 # Константы
 TARGET_DM_URL = "https://discord.com/channels/@me/1331338750789419090"
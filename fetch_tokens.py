@@ -10,7 +10,7 @@ from logging.handlers import RotatingFileHandler
 import requests
 from cloudscraper.exceptions import CloudflareChallengeError
 import cloudscraper
-from supabase_client import supabase
+from services.supabase_async import get_client
 
 # --- Load config ---
 load_dotenv()
@@ -61,9 +61,9 @@ def format_launchpad(lp: str) -> str:
 async def upsert_tokens_batch_in_db(tokens):
     if not tokens:
         return
-    await asyncio.get_event_loop().run_in_executor(
-        None,
-        lambda: supabase.table("tokens")
+    client = await get_client()
+    await (
+        client.table("tokens")
             .upsert(tokens, on_conflict="contract_address")
             .execute()
     )
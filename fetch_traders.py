@@ -2,7 +2,7 @@ import os, json, uuid, asyncio
 import cloudscraper, requests
 from datetime import datetime, timezone
 from dotenv import load_dotenv
-from supabase_client import supabase
+from services.supabase_async import get_client
 
 # --- Load config ---
 load_dotenv()
@@ -36,32 +36,30 @@ RETRY403 = float(os.getenv("INITIAL_403_DELAY_S","10.0"))
 
 async def insert_trader_batch(lst):
     if not lst: return
-    await asyncio.get_event_loop().run_in_executor(
-        None,
-        lambda: supabase.table("traders").insert(lst).execute()
-    )
+    client = await get_client()
+    await client.table("traders").insert(lst).execute()
     print(f"Inserted {len(lst)} new traders")
 
 async def get_existing(token_id):
     try:
-        resp = await asyncio.get_event_loop().run_in_executor(
-            None,
-            lambda: supabase.table("traders")
-                       .select("trader_address")
-                       .eq("token_id", token_id)
-                       .execute()
+        client = await get_client()
+        resp = await (
+            client.table("traders")
+                  .select("trader_address")
+                  .eq("token_id", token_id)
+                  .execute()
         )
         return {r["trader_address"] for r in resp.data}
     except:
         return set()
 
 async def mark_processed(token_id):
-    await asyncio.get_event_loop().run_in_executor(
-        None,
-        lambda: supabase.table("tokens")
-                   .update({"traders_last_fetched_at": datetime.now(timezone.utc).isoformat()})
-                   .eq("id", token_id)
-                   .execute()
+    client = await get_client()
+    await (
+        client.table("tokens")
+              .update({"traders_last_fetched_at": datetime.now(timezone.utc).isoformat()})
+              .eq("id", token_id)
+              .execute()
     )
     print(f"Token {token_id} marked processed")
 
@@ -2,9 +2,6 @@ def get_user_lang(context):
     return context.user_data.get("lang", "en")
 import asyncio
 import os
-import io
-import csv
-import uuid
 import pandas as pd
 from datetime import datetime, timezone, timedelta
 import logging
@@ -21,6 +18,12 @@ from ui.keyboards import get_template_settings_keyboard, get_template_category_k
 # Контекст приложения (для доступа к driver и lock)
 from app_context import driver, driver_lock
 from services import supabase_service, discord_scraper, queue_service, price_service # <-- Убедитесь, что price_service здесь
+from services.task_routing import QUEUE_API, QUEUE_SELENIUM, priority_for
+from services.task_eta import ALL_IN_PIPELINE
+from services import file_id_cache, launchpad_cache
+from services.supabase_async import get_client
+from services.update_processor import heavy_operation
+from services.export_writer import ExportWriter, iter_query_rows, part_caption, send_export
 
 # UI компоненты
 from ui.keyboards import (
@@ -37,8 +40,6 @@ from config import TOKEN_CATEGORIES, MAX_TRACKING_TASKS_PER_USER
 from .commands import ensure_main_msg, send_new_main_menu  # Импортируем из соседнего файла в этой же папке
 
 # --- Временные импорты (в будущем переедут в services) ---
-# TODO: Перенести всю работу с Supabase в services/supabase_service.py
-from supabase_client import supabase
 
 # TODO: Перенести всю работу с "тяжелыми" задачами в services/task_orchestrator.py
 # и workers/
@@ -63,65 +64,6 @@ async def fetch_pnl_via_discord(wallets: list[str]) -> str | None:
             lambda: perform_pnl_fetch(driver, wallets)
         )
 
-# TODO: Перенести в services/supabase_service.py
-async def fetch_unique_launchpads() -> list:
-    try:
-        response = await asyncio.get_event_loop().run_in_executor(None, lambda: supabase.table("tokens").select("launchpad").execute())
-        if response.data:
-            return sorted(list(set(item['launchpad'] for item in response.data if item['launchpad'] and item['launchpad'] != 'unknown')))
-        return []
-    except Exception as e:
-        print(f"Ошибка при получении списка лаунчпадов: {e}")
-        return []
-
-# TODO: Перенести в services/supabase_service.py
-async def fetch_user_templates(user_id: int) -> list:
-    try:
-        response = await asyncio.get_event_loop().run_in_executor(
-            None, lambda: supabase.table("parse_templates").select("*").eq("user_id", user_id).execute()
-        )
-        return response.data or []
-    except Exception as e:
-        print(f"Ошибка получения шаблонов для пользователя {user_id}: {e}")
-        return []
-
-# TODO: Перенести в services/supabase_service.py
-async def create_template(user_id: int, template_name: str, platforms: list, time_period: str, categories: list) -> dict:
-    template_data = {
-        "id": str(uuid.uuid4()), "user_id": int(user_id), "template_name": template_name,
-        "platforms": platforms, "time_period": time_period, "categories": categories,
-    }
-    try:
-        response = await asyncio.get_event_loop().run_in_executor(
-            None, lambda: supabase.table("parse_templates").insert(template_data).execute()
-        )
-        return response.data[0]
-    except Exception as e:
-        print(f"Ошибка создания шаблона для пользователя {user_id}: {e}")
-        raise
-
-# TODO: Перенести в services/supabase_service.py
-async def update_template(template_id: str, template_name: str, platforms: list, time_period: str, categories: list) -> dict:
-    updates = {"template_name": template_name, "platforms": platforms, "time_period": time_period, "categories": categories}
-    try:
-        response = await asyncio.get_event_loop().run_in_executor(
-            None, lambda: supabase.table("parse_templates").update(updates).eq("id", template_id).execute()
-        )
-        return response.data[0]
-    except Exception as e:
-        print(f"Ошибка обновления шаблона {template_id}: {e}")
-        raise
-
-# TODO: Перенести в services/supabase_service.py
-async def delete_template(template_id: str) -> None:
-    try:
-        await asyncio.get_event_loop().run_in_executor(
-            None, lambda: supabase.table("parse_templates").delete().eq("id", template_id).execute()
-        )
-    except Exception as e:
-        print(f"Ошибка удаления шаблона {template_id}: {e}")
-        raise
-
 #
 # =================================================================================
 #  Раздел 2: Основные обработчики колбэков (`..._callback`)
@@ -337,7 +279,7 @@ async def parse_submenu_callback(update: Update, context: ContextTypes.DEFAULT_T
         
     elif command == "parse_get_tokens":
         # Шаг 1: Получаем все доступные платформы
-        all_platforms = await supabase_service.fetch_unique_launchpads()
+        all_platforms = await launchpad_cache.get_launchpads()
         
         # Шаг 2: Устанавливаем ЭТОТ ЖЕ СПИСОК как изначально выбранный
         context.user_data.update({
@@ -376,7 +318,7 @@ async def token_settings_callback(update: Update, context: ContextTypes.DEFAULT_
     command = query.data
     
     if command == "tokensettings_platforms":
-        all_platforms = await supabase_service.fetch_unique_launchpads()
+        all_platforms = await launchpad_cache.get_launchpads()
         selected_platforms = context.user_data.get('token_parse_platforms', [])
         reply_markup = get_platform_selection_keyboard(lang, all_platforms, selected_platforms)
         await query.message.edit_text(text=get_text(lang, "platforms_menu_prompt"), reply_markup=reply_markup, disable_web_page_preview=True)
@@ -405,8 +347,12 @@ async def token_settings_callback(update: Update, context: ContextTypes.DEFAULT_
             "lang": lang,
         }
         
-        # Ставим задачу в очередь. Метод .delay() не блокирует бота.
-        run_token_parse_task.delay(chat_id=chat_id, settings=settings)
+        # Ставим задачу в очередь api_light; премиум-пользователи — в приоритетной полосе.
+        premium = await supabase_service.user_is_premium(update.effective_user.id)
+        run_token_parse_task.apply_async(
+            kwargs={"chat_id": chat_id, "settings": settings},
+            queue=QUEUE_API, priority=priority_for(premium),
+        )
         
         # Сразу же отвечаем пользователю
         await query.message.edit_text(text="✅ Ваш запрос принят в очередь и уже выполняется в фоне. Вы получите файл, как только он будет готов.", disable_web_page_preview=True)
@@ -476,7 +422,7 @@ async def platform_selection_callback(update: Update, context: ContextTypes.DEFA
     data_source[list_key] = selected_list
 
     # Обновляем клавиатуру
-    all_platforms = await supabase_service.fetch_unique_launchpads()
+    all_platforms = await launchpad_cache.get_launchpads()
     reply_markup = get_platform_selection_keyboard(lang, all_platforms, selected_list)
     await query.message.edit_reply_markup(reply_markup=reply_markup)
 
@@ -613,15 +559,21 @@ async def template_management_callback(update: Update, context: ContextTypes.DEF
             await query.message.edit_text(get_text(lang, "template_not_found_error"))
             return
 
-        queue_len = queue_service.get_queue_length()
-        position = queue_len + 1
-        queue_text = get_text(lang, "all_in_parse_queued").format(position)
+        # Место считаем в selenium-очереди своей полосы: там проходит основное ожидание
+        premium = await supabase_service.user_is_premium(user_id)
+        priority = priority_for(premium)
+        eta = await asyncio.to_thread(queue_service.get_queue_eta, ALL_IN_PIPELINE, 1, QUEUE_SELENIUM, priority)
+        queue_text = get_text(lang, "all_in_parse_queued").format(queue_service.format_queue_eta(eta, lang))
         await query.message.edit_text(text=queue_text)
 
-        run_all_in_parse_pipeline_task_wrapper.delay(
-            chat_id=update.effective_chat.id, 
-            template=selected_template,
-            message_id=query.message.message_id 
+        run_all_in_parse_pipeline_task_wrapper.apply_async(
+            kwargs={
+                "chat_id": update.effective_chat.id,
+                "template": selected_template,
+                "message_id": query.message.message_id,
+                "priority": priority,
+            },
+            priority=priority,
         )
 
     elif command.startswith("template_edit_"):
@@ -643,7 +595,7 @@ async def template_management_callback(update: Update, context: ContextTypes.DEF
     
     elif command.startswith("template_delete_"):
         template_id = command.replace("template_delete_", "")
-        await supabase_service.delete_template(template_id)
+        await supabase_service.delete_template(template_id, user_id)
         templates = await supabase_service.fetch_user_templates(user_id)
         await query.message.edit_text(
             text=get_text(lang, "template_deleted"),
@@ -676,7 +628,7 @@ async def template_settings_callback(update: Update, context: ContextTypes.DEFAU
     # --- Роутер для кнопок ---
     if command == "template_set_platforms":
         context.user_data['state'] = 'template_editing_platforms'
-        all_platforms = await supabase_service.fetch_unique_launchpads()
+        all_platforms = await launchpad_cache.get_launchpads()
         await query.message.edit_text("Выберите платформы:", reply_markup=get_platform_selection_keyboard(lang, all_platforms, template_data.get('platforms', [])))
 
     elif command == "template_set_category":
@@ -925,33 +877,39 @@ async def execute_token_parse(update: Update, context: ContextTypes.DEFAULT_TYPE
         hours = int(period_key.replace('h', ''))
         start_time = datetime.now(timezone.utc) - timedelta(hours=hours)
         
-        sql_query = supabase.table("tokens").select("contract_address, ticker, name, migration_time, launchpad, category")
-        sql_query = sql_query.gte("migration_time", start_time.isoformat())
-        if selected_platforms:
-            sql_query = sql_query.in_("launchpad", selected_platforms)
-        if selected_categories and set(selected_categories) != set(TOKEN_CATEGORIES):
-            sql_query = sql_query.in_("category", selected_categories)
-            
-        response = await asyncio.get_event_loop().run_in_executor(None, lambda: sql_query.range(0, 10000).execute())
-        df = pd.DataFrame(response.data or [])
+        client = await get_client()
+
+        def make_query():
+            sql_query = client.table("tokens").select("contract_address, ticker, name, migration_time, launchpad, category")
+            sql_query = sql_query.gte("migration_time", start_time.isoformat())
+            if selected_platforms:
+                sql_query = sql_query.in_("launchpad", selected_platforms)
+            if selected_categories and set(selected_categories) != set(TOKEN_CATEGORIES):
+                sql_query = sql_query.in_("category", selected_categories)
+            return sql_query.order("migration_time")
 
         back_button_markup = InlineKeyboardMarkup([[InlineKeyboardButton(TRANSLATIONS[lang]["back_btn"], callback_data="parse_back")]])
 
-        if df.empty:
+        # Строки идут страницами прямо в сжатый файл, CSV целиком в памяти не собирается
+        fieldnames = ["contract_address", "ticker", "name", "migration_time", "launchpad", "category"]
+        with ExportWriter(f"tokens_{datetime.now().strftime('%Y%m%d_%H%M%S')}", fieldnames) as writer:
+            async for row in iter_query_rows(make_query):
+                writer.write_row(row)
+
+        if not writer.total_rows:
             await context.bot.edit_message_text(chat_id=chat_id, message_id=main_msg_id, text=get_text(lang, "no_tokens_found"), reply_markup=back_button_markup, disable_web_page_preview=True)
             return
-            
-        output = io.StringIO()
-        fieldnames = ["contract_address", "ticker", "name", "migration_time", "launchpad", "category"]
-        writer = csv.DictWriter(output, fieldnames=fieldnames, extrasaction='ignore')
-        writer.writeheader()
-        writer.writerows(df.to_dict(orient='records'))
-        
-        csv_file = io.BytesIO(output.getvalue().encode('utf-8'))
-        csv_file.name = f"tokens_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-        
-        media_to_upload = InputMediaDocument(media=csv_file_bytes, caption=caption)
-        await query.message.edit_media(media=media_to_upload, reply_markup=back_button_markup)
+
+        caption = get_text(lang, "csv_caption").format(writer.total_rows)
+        first, *rest = writer.parts
+        await file_id_cache.edit_message_document(
+            context.bot, chat_id, query.message.message_id, first.digest, first.file,
+            filename=first.filename, caption=part_caption(caption, 1, len(writer.parts)),
+            reply_markup=None if rest else back_button_markup,
+        )
+        first.file.close()
+        if rest:
+            await send_export(context.bot, chat_id, rest, caption, reply_markup=back_button_markup)
     except Exception as e:
         # logger.error(...)
         await context.bot.edit_message_text(chat_id=chat_id, message_id=main_msg_id, text=get_text(lang, "error_occurred"), reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(TRANSLATIONS[lang]["back_btn"], callback_data="parse_back")]]), disable_web_page_preview=True)
@@ -978,7 +936,7 @@ async def run_all_in_parse_pipeline(update: Update, context: ContextTypes.DEFAUL
         # Получаем данные шаблона из базы, если их нет или они некорректны
         user_id = update.effective_user.id
         if not selected_template.get('platforms') or not selected_template.get('time_period') or not selected_template.get('categories'):
-            templates = await fetch_user_templates(user_id)
+            templates = await supabase_service.fetch_user_templates(user_id)
             selected_template = next((t for t in templates if t["id"] == selected_template['id']), {})
             if not selected_template:
                 await context.bot.edit_message_text(
@@ -1028,12 +986,12 @@ async def run_all_in_parse_pipeline(update: Update, context: ContextTypes.DEFAUL
             )
             return
 
-        response_with_ids = await asyncio.get_event_loop().run_in_executor(
-            None,
-            lambda: supabase.table('tokens')
-                           .select('id, contract_address, category')
-                           .in_('contract_address', [t['contract_address'] for t in filtered_tokens])
-                           .execute()
+        client = await get_client()
+        response_with_ids = await (
+            client.table('tokens')
+                  .select('id, contract_address, category')
+                  .in_('contract_address', [t['contract_address'] for t in filtered_tokens])
+                  .execute()
         )
         tokens_with_ids = response_with_ids.data
 
@@ -1045,10 +1003,7 @@ async def run_all_in_parse_pipeline(update: Update, context: ContextTypes.DEFAUL
         logger.info(f"ALL-IN-PARSE: Step 2: Fetching traders for {len(tokens_with_ids)} tokens...")
         await process_tokens_for_traders(tokens_with_ids)
         token_ids = [t['id'] for t in tokens_with_ids]
-        traders_response = await asyncio.get_event_loop().run_in_executor(
-            None,
-            lambda: supabase.table("traders").select("trader_address").in_("token_id", token_ids).execute()
-        )
+        traders_response = await client.table("traders").select("trader_address").in_("token_id", token_ids).execute()
         if not traders_response.data:
             await context.bot.edit_message_text(
                 chat_id=chat_id,
@@ -1170,7 +1125,7 @@ async def dev_parse_settings_callback(update: Update, context: ContextTypes.DEFA
     # --- Устанавливаем правильные состояния перед переходом в подменю ---
     if command == "devparse_platforms":
         context.user_data['state'] = 'dev_parse_editing_platforms'
-        all_platforms = await supabase_service.fetch_unique_launchpads()
+        all_platforms = await launchpad_cache.get_launchpads()
         reply_markup = get_platform_selection_keyboard(lang, all_platforms, ud.get('dev_parse_platforms', []))
         await query.message.edit_text(
             get_text(lang, "dev_parse_platform_prompt"), # <-- ИЗМЕНЕНО
@@ -1218,60 +1173,64 @@ async def dev_parse_settings_callback(update: Update, context: ContextTypes.DEFA
         await query.message.edit_text(get_text(lang, "dev_parse_menu_prompt"), reply_markup=reply_markup)
 
     elif command == "devparse_execute":
-        await query.message.edit_text("🔍 Выполняю поиск и фильтрацию...")
-        
-        hours = int(ud.get('dev_parse_period', '72h').replace('h', ''))
-        start_time = datetime.now(timezone.utc) - timedelta(hours=hours)
+        await execute_dev_parse(update, context)
 
-        initial_dev_stats = await supabase_service.fetch_dev_stats_by_criteria(
-            start_time, ud.get('dev_parse_platforms', []), ud.get('dev_parse_categories', [])
-        )
+@heavy_operation
+async def execute_dev_parse(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Снимок настроек Dev Parse в очереди пользователя; поиск и выгрузки — отдельной задачей."""
+    ud = context.user_data
+    hours = int(ud.get('dev_parse_period', '72h').replace('h', ''))
+    return _dev_parse_export(
+        context.bot, update.callback_query.message, update.effective_chat.id,
+        datetime.now(timezone.utc) - timedelta(hours=hours),
+        list(ud.get('dev_parse_platforms', [])), list(ud.get('dev_parse_categories', [])),
+        dict(ud.get('dev_pnl_filters', {})),
+    )
 
-        if not initial_dev_stats:
-            await query.message.edit_text("🤷 По вашим критериям токенов разработчики не найдены.")
-            return
 
-        pnl_filters = ud.get('dev_pnl_filters', {})
-        final_dev_stats = apply_dev_pnl_filters(initial_dev_stats, pnl_filters)
-        
-        if not final_dev_stats:
-            await query.message.edit_text("🤷 Разработчики, соответствующие PNL-фильтрам, не найдены.")
-            return
+async def _dev_parse_export(bot, message, chat_id: int, start_time: datetime,
+                            platforms: list, categories: list, pnl_filters: dict):
+    """Поиск девов и две выгрузки; новое меню (main_message_id в user_data) — снова в очереди пользователя."""
+    await message.edit_text("🔍 Выполняю поиск и фильтрацию...")
 
-        chat_id = update.effective_chat.id
+    initial_dev_stats = await supabase_service.fetch_dev_stats_by_criteria(start_time, platforms, categories)
 
-        # 1. Отправляем первый файл (PNL)
-        pnl_output = io.StringIO()
-        pd.DataFrame(final_dev_stats).to_csv(pnl_output, index=False)
-        pnl_csv_bytes = io.BytesIO(pnl_output.getvalue().encode('utf-8'))
-        pnl_csv_bytes.name = "dev_pnl_stats_filtered.csv"
-        await context.bot.send_document(
-            chat_id=chat_id,
-            document=pnl_csv_bytes,
-            caption=f"✅ Ваш PNL-отчет по разработчикам готов. Найдено (после всех фильтров): {len(final_dev_stats)} девов."
+    if not initial_dev_stats:
+        await message.edit_text("🤷 По вашим критериям токенов разработчики не найдены.")
+        return None
+
+    final_dev_stats = apply_dev_pnl_filters(initial_dev_stats, pnl_filters)
+    
+    if not final_dev_stats:
+        await message.edit_text("🤷 Разработчики, соответствующие PNL-фильтрам, не найдены.")
+        return None
+
+    # 1. Отправляем первый файл (PNL)
+    with ExportWriter("dev_pnl_stats_filtered") as writer:
+        writer.write_rows(final_dev_stats)
+    await send_export(
+        bot, chat_id, writer.parts,
+        caption=f"✅ Ваш PNL-отчет по разработчикам готов. Найдено (после всех фильтров): {len(final_dev_stats)} девов."
+    )
+
+    # Сообщение о статусе перед отправкой второго файла
+    await message.edit_text("⚙️ Загружаю список токенов для отфильтрованных разработчиков...")
+    
+    # 2. Отправляем второй файл (токены)
+    developer_addresses = [dev['developer_address'] for dev in final_dev_stats]
+    deployed_tokens = await supabase_service.fetch_deployed_tokens_for_devs(developer_addresses)
+    
+    if deployed_tokens:
+        with ExportWriter("dev_deployed_tokens_filtered") as writer:
+            writer.write_rows(deployed_tokens)
+        await send_export(
+            bot, chat_id, writer.parts,
+            caption=f"✅ Список из {len(deployed_tokens)} токенов, созданных отфильтрованными разработчиками."
         )
+    
+    # 3. 🔥 ГЛАВНОЕ ИЗМЕНЕНИЕ: Отправляем новое главное меню вниз
+    return lambda context: send_new_main_menu(bot, chat_id, context)
 
-        # Сообщение о статусе перед отправкой второго файла
-        await query.message.edit_text("⚙️ Загружаю список токенов для отфильтрованных разработчиков...")
-        
-        # 2. Отправляем второй файл (токены)
-        developer_addresses = [dev['developer_address'] for dev in final_dev_stats]
-        deployed_tokens = await supabase_service.fetch_deployed_tokens_for_devs(developer_addresses)
-        
-        if deployed_tokens:
-            tokens_output = io.StringIO()
-            pd.DataFrame(deployed_tokens).to_csv(tokens_output, index=False)
-            tokens_csv_bytes = io.BytesIO(tokens_output.getvalue().encode('utf-8'))
-            tokens_csv_bytes.name = "dev_deployed_tokens_filtered.csv"
-            await context.bot.send_document(
-                chat_id=chat_id,
-                document=tokens_csv_bytes,
-                caption=f"✅ Список из {len(deployed_tokens)} токенов, созданных отфильтрованными разработчиками."
-            )
-        
-        # 3. 🔥 ГЛАВНОЕ ИЗМЕНЕНИЕ: Отправляем новое главное меню вниз
-        await send_new_main_menu(context.bot, chat_id, context)
-                
 async def pnl_filter_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Обрабатывает всю навигацию внутри меню PNL-фильтров.
@@ -7,7 +7,6 @@ from ui.translations import get_text
 from ui.keyboards import get_language_keyboard
 
 from services import price_service, supabase_service, discord_scraper, queue_service
-from services import db_access
 
 def get_user_lang(context):
     return context.user_data.get("lang", "en")
@@ -82,7 +81,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     lang = get_user_lang(context)
 
     # ── NEW: determine premium status each time from DB ──
-    premium = db_access.is_premium_user(update.effective_user.id)
+    premium = await supabase_service.user_is_premium(update.effective_user.id)
     context.user_data["premium"] = premium  # cache for later use
     
     # --- ИСПРАВЛЕНИЕ: Всегда получаем цену перед отправкой меню ---
@@ -1,8 +1,6 @@
 # handlers/conv_activate.py
 from telegram.ext import ConversationHandler, MessageHandler, filters, CommandHandler
-from services import db_access
-from services.db_access import _sb      # ← импортируем клиент Supabase
-from services import db_access  
+from services import supabase_service
 
 ASK_CODE = 1
 
@@ -12,19 +10,15 @@ async def cmd_activate(update, context):
 
 async def process_code(update, context):
     code = update.message.text.strip()
-    row  = db_access.check_code(code)
+    row  = await supabase_service.get_access_code(code)
     if not row:
         await update.message.reply_text("❌ Код не найден.")
     elif row["used"]:
         await update.message.reply_text("😕 Этот код уже использован.")
     else:
         tg_id = update.effective_user.id
-        db_access.mark_code_used(code, tg_id)
-        # 1) пишем в БД
-        _sb.table("users").upsert(
-            {"id": tg_id, "is_premium": True},
-            on_conflict="id"
-        ).execute()
+        # 1) пишем в БД: код использован, пользователь — премиум
+        await supabase_service.activate_access_code(code, tg_id)
 
         # 2) сохраняем в user_data — /start будет читать отсюда
         context.user_data["premium"] = True
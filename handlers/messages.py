@@ -2,14 +2,17 @@ import asyncio
 import os
 import io
 import csv
-import pandas as pd
 import tempfile
 from datetime import datetime
 import telegram
 
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, InputMediaDocument
+from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import ContextTypes
-from services import supabase_service, discord_scraper, queue_service
+from services import supabase_service, discord_scraper, queue_service, file_id_cache
+from services.task_routing import QUEUE_SELENIUM, priority_for
+from services.update_processor import heavy_operation
+from services.export_writer import ExportWriter, part_caption, send_export
+from services.job_dedup import ATTACHED, CACHED, JOB_PNL, JOB_TOP_TRADERS, RESULT_FILENAMES, default_coalescer
 from tasks.celery_tasks import run_swaps_fetch_task, run_pnl_fetch_task, run_traders_fetch_task
 
 # --- Импорты из нашей новой архитектуры ---
@@ -25,7 +28,7 @@ from ui.translations import get_text
 from ui.keyboards import get_template_view_keyboard, get_pnl_filter_main_menu_keyboard, get_dev_pnl_filter_main_menu_keyboard # <-- ADD IT HERE
 from ui.translations import get_text
 # Конфигурация
-from config import MAX_ADDRESS_LIST_SIZE, FILES_DIR
+from config import MAX_ADDRESS_LIST_SIZE
 
 # --- Временные импорты и хелперы (в будущем переедут в services) ---
 
@@ -34,8 +37,6 @@ from workers.get_trader_pnl import perform_pnl_fetch
 from workers.get_program_swaps import perform_program_swaps
 # from workers.get_top_traders import perform_toplevel_traders_fetch # Импорт для новой функции
 
-# TODO: Перенести в services/supabase_service.py
-from supabase_client import supabase
 from .commands import send_new_main_menu
 #
 # =================================================================================
@@ -63,7 +64,6 @@ async def process_wallet_stats(addresses: list[str], update: Update, context: Co
     address_chunks = [addresses[i:i + MAX_ADDRESS_LIST_SIZE] for i in range(0, len(addresses), MAX_ADDRESS_LIST_SIZE)]
     num_chunks = len(address_chunks)
     all_csv_paths = []
-    final_csv_path = None
 
     try:
         if num_chunks > 1:
@@ -87,30 +87,28 @@ async def process_wallet_stats(addresses: list[str], update: Update, context: Co
 
         if len(all_csv_paths) > 1:
             await context.bot.edit_message_text(chat_id=chat_id, message_id=main_msg_id, text=f"🖇️ Объединяю {len(all_csv_paths)} отчетов...", disable_web_page_preview=True)
-            df_list = [pd.read_csv(path) for path in all_csv_paths]
-            merged_df = pd.concat(df_list, ignore_index=True)
-            
-            merged_filename = f"pnl_merged_{uuid.uuid4()}.csv"
-            final_csv_path = os.path.join(FILES_DIR, merged_filename)
-            merged_df.to_csv(final_csv_path, index=False)
-        else:
-            final_csv_path = all_csv_paths[0]
+
+        # Отчёты склеиваются кусками прямо в сжатый файл, без pd.concat в памяти
+        with ExportWriter(f"pnl_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}") as writer:
+            await asyncio.to_thread(writer.write_csv_files, all_csv_paths)
 
         caption = get_text(lang, "pnl_report_caption", len(addresses))
-        with open(final_csv_path, "rb") as f:
-            await context.bot.edit_message_media(
-                chat_id=chat_id, message_id=main_msg_id,
-                media=InputMediaDocument(media=f, caption=caption),
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "back_btn"), callback_data="main_menu")]])
-            )
+        back_markup = InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "back_btn"), callback_data="main_menu")]])
+        first, *rest = writer.parts
+        await file_id_cache.edit_message_document(
+            context.bot, chat_id, main_msg_id, first.digest, first.file,
+            filename=first.filename, caption=part_caption(caption, 1, len(writer.parts)),
+            reply_markup=None if rest else back_markup
+        )
+        first.file.close()
+        if rest:
+            await send_export(context.bot, chat_id, rest, caption, reply_markup=back_markup)
     except Exception as e:
         # logger.error(...)
         await context.bot.edit_message_text(chat_id=chat_id, message_id=main_msg_id, text=get_text(lang, "error_occurred"), disable_web_page_preview=True)
     finally:
         for path in all_csv_paths:
             if os.path.exists(path): os.remove(path)
-        if final_csv_path and final_csv_path not in all_csv_paths and os.path.exists(final_csv_path):
-             os.remove(final_csv_path)
 
 # TODO: И другие функции-исполнители, такие как `handle_dev_stats_request`, `search_by_wallet_address`...
 # Я их пропущу для краткости, но их нужно перенести сюда.
@@ -435,17 +433,19 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 
         program = context.user_data.pop('program_parse_program')
         context.user_data.pop('state', None)
-        # 1. Получаем текущую длину очереди
-        current_queue_len = queue_service.get_queue_length()
-
-        # 2. Наша задача будет следующей
-        user_position = current_queue_len + 1
+        # 1-2. Место в selenium-очереди с учётом полосы пользователя (премиум обгоняет обычных)
+        premium = await supabase_service.user_is_premium(update.effective_user.id)
+        priority = priority_for(premium)
+        eta = await asyncio.to_thread(queue_service.get_queue_eta, run_swaps_fetch_task.name, 1, QUEUE_SELENIUM, priority)
 
-        # 3. Формируем новое сообщение для пользователя
-        queue_text = f"⏳ Ваш запрос принят. Вы {user_position}-й в очереди. Пожалуйста, подождите..."
+        # 3. Формируем новое сообщение для пользователя: место и ожидание по истории длительностей
+        queue_text = f"⏳ Ваш запрос принят. {queue_service.format_queue_eta(eta)} Пожалуйста, подождите..."
 
         # 4. Ставим задачу в очередь
-        run_swaps_fetch_task.delay(program=program, interval=text, chat_id=chat_id)
+        run_swaps_fetch_task.apply_async(
+            kwargs={"program": program, "interval": text, "chat_id": chat_id},
+            queue=QUEUE_SELENIUM, priority=priority,
+        )
 
         # 5. Мгновенно отвечаем пользователю с указанием его места
         await context.bot.edit_message_text(
@@ -464,61 +464,107 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         )
 
 
-async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+def _parse_address_lines(raw: bytes) -> list[str]:
+    return [line.strip() for line in raw.decode('utf-8').splitlines() if line.strip()]
+
+
+@heavy_operation
+async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Обрабатывает входящие .txt файлы для "тяжелых" задач.
+    В очереди пользователя читается и сбрасывается state; загрузка, разбор
+    и постановка задачи идут отдельной задачей (_process_address_file).
     ИСПРАВЛЕНО: Все вызовы get_text теперь используют .format().
     """
     lang = context.user_data.get('lang', 'en')
     state = context.user_data.get('state')
     
     if state not in ['awaiting_trader_list', 'awaiting_wallet_stats']:
-        return
+        return None
 
     await update.message.delete()
 
     doc = update.message.document
+    main_msg_id = context.user_data.get("main_message_id")
+    chat_id = update.effective_chat.id
     if not doc.file_name.lower().endswith('.txt'):
         await context.bot.edit_message_text(
-            chat_id=update.effective_chat.id,
-            message_id=context.user_data.get("main_message_id"),
+            chat_id=chat_id,
+            message_id=main_msg_id,
             text="Поддерживаются только файлы формата .txt", disable_web_page_preview=True
         )
-        return
+        return None
 
-    main_msg_id = context.user_data.get("main_message_id")
-    chat_id = update.effective_chat.id
-    
+    # файл принят как ответ на этот state — нажатия меню после него state уже не потеряют
+    context.user_data.pop('state', None)
+    return _process_address_file(context.bot, doc, state, lang, chat_id, main_msg_id, update.effective_user.id)
+
+
+def _restore_state(state: str):
+    """follow-up: файл не прошёл проверку — снова ждём файл, если за это время не выбрано другое действие."""
+    async def follow_up(context):
+        if context.user_data.get('state') is None:
+            context.user_data['state'] = state
+    return follow_up
+
+
+async def _process_address_file(bot, doc, state: str, lang: str, chat_id: int, main_msg_id, user_id: int):
+    """Тяжёлая часть handle_document: работает только с переданными значениями, не с user_data."""
     tg_file = await doc.get_file()
     file_content_bytes = await tg_file.download_as_bytearray()
-    file_content_str = file_content_bytes.decode('utf-8')
-    addresses = [line.strip() for line in file_content_str.splitlines() if line.strip()]
+    # 40k адресов — заметная работа CPU, разбираем вне event loop'а
+    addresses = await asyncio.to_thread(_parse_address_lines, file_content_bytes)
 
     # --- Валидация ---
     if not addresses:
         # ИСПОЛЬЗУЕМ .format()
-        await context.bot.edit_message_text(chat_id=chat_id, message_id=main_msg_id, text=get_text(lang, "input_empty_error"), disable_web_page_preview=True)
-        return
+        await bot.edit_message_text(chat_id=chat_id, message_id=main_msg_id, text=get_text(lang, "input_empty_error"), disable_web_page_preview=True)
+        return _restore_state(state)
         
     invalid_lines = [addr for addr in addresses if not (32 <= len(addr) <= 44)]
     if invalid_lines:
         error_sample = "\n".join(f"`{line}`" for line in invalid_lines[:5])
         # ИСПОЛЬЗУЕМ .format()
         error_text = get_text(lang, "input_address_length_error").format(error_sample)
-        await context.bot.edit_message_text(chat_id=chat_id, message_id=main_msg_id, text=error_text, parse_mode='Markdown', disable_web_page_preview=True)
-        return
+        await bot.edit_message_text(chat_id=chat_id, message_id=main_msg_id, text=error_text, parse_mode='Markdown', disable_web_page_preview=True)
+        return _restore_state(state)
+
+    # --- Склейка с такими же задачами (services/job_dedup.py) ---
+    job_type = JOB_TOP_TRADERS if state == 'awaiting_trader_list' else JOB_PNL
+    coalescer = default_coalescer()
+    outcome, ref = await asyncio.to_thread(coalescer.submit, job_type, addresses, chat_id)
+
+    if outcome == CACHED:
+        # Такой же список недавно обрабатывался — отдаём готовый файл без Discord;
+        # если он уже уходил в Telegram, байты не читаются и не загружаются вовсе
+        await file_id_cache.edit_message_document(
+            bot, chat_id, main_msg_id, ref.split(":", 1)[1],
+            lambda: asyncio.to_thread(coalescer.store.get_bytes, ref),
+            filename=RESULT_FILENAMES[job_type],
+            caption="✅ Готовый отчёт по этому списку (недавний результат).",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(get_text(lang, "back_btn"), callback_data="main_menu")]])
+        )
+        return None
+    if outcome == ATTACHED:
+        await bot.edit_message_text(
+            chat_id=chat_id, message_id=main_msg_id,
+            text="⏳ Такой же запрос уже выполняется. Пришлю результат, как только он будет готов.",
+            disable_web_page_preview=True
+        )
+        return None
 
     # --- Логика очереди ---
-    current_queue_len = queue_service.get_queue_length()
-    user_position = current_queue_len + 1
-    queue_text = f"⏳ Ваш запрос принят. Вы {user_position}-й в очереди на выполнение."
-    
+    premium = await supabase_service.user_is_premium(user_id)
+    priority = priority_for(premium)
+    task = run_traders_fetch_task if job_type == JOB_TOP_TRADERS else run_pnl_fetch_task
+    eta = await asyncio.to_thread(queue_service.get_queue_eta, task.name, len(addresses), QUEUE_SELENIUM, priority)
+    queue_text = f"⏳ Ваш запрос принят. {queue_service.format_queue_eta(eta)}"
+
     # --- Запуск задачи ---
-    if state == 'awaiting_trader_list':
-        run_traders_fetch_task.delay(file_content_str=file_content_str, chat_id=chat_id)
-    elif state == 'awaiting_wallet_stats':
-        run_pnl_fetch_task.delay(wallets=addresses, chat_id=chat_id)
-    
-    context.user_data.pop('state', None)
-    await context.bot.edit_message_text(chat_id=chat_id, message_id=main_msg_id, text=queue_text, disable_web_page_preview=True)
+    # Адреса уже лежат в payload store, в брокер уходит только короткая ссылка
+    ref_kwarg = "addresses_ref" if job_type == JOB_TOP_TRADERS else "wallets_ref"
+    task.apply_async(kwargs={ref_kwarg: ref, "chat_id": chat_id}, queue=QUEUE_SELENIUM, priority=priority)
+
+    await bot.edit_message_text(chat_id=chat_id, message_id=main_msg_id, text=queue_text, disable_web_page_preview=True)
+    return None
     
\ No newline at end of file
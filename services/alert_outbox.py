@@ -0,0 +1,213 @@
+# services/alert_outbox.py
+"""
+Outbox для bundle-алертов.
+
+Детектор не шлёт в Telegram сам, а записывает найденный бандл в таблицу
+`alert_outbox` с детерминированным ключом sha1(rule_id + отсортированные
+signatures). Повторное обнаружение того же бандла на следующем проходе
+даёт тот же ключ, и upsert с ignore_duplicates его отбрасывает — алерт не
+дублируется. Отправитель (`drain`) забирает pending-записи, шлёт их и одним
+batch-update помечает доставленные записи и их трансферы
+(tracked_transactions.sent) вместо запроса на каждый алерт.
+
+Разгружают outbox несколько процессов (alert_worker и job бота), поэтому
+перед отправкой записи захватываются: update status='sending' с условием
+status='pending' — Postgres перепроверяет условие под блокировкой строки,
+и каждую запись получает ровно один отправитель. Захват, не закрытый за
+OUTBOX_CLAIM_TTL (отправитель упал), возвращается в pending.
+
+Схема:
+    create table alert_outbox (
+        alert_key   text primary key,
+        rule_id     text,
+        chat_id     bigint not null,
+        text        text not null,
+        parse_mode  text,
+        signatures  text[] not null,
+        status      text not null default 'pending',   -- pending | sending | sent
+        claimed_by  text,
+        claimed_at  timestamptz,
+        created_at  timestamptz not null default now(),
+        sent_at     timestamptz
+    );
+    -- для существующей таблицы:
+    -- alter table alert_outbox add column claimed_by text, add column claimed_at timestamptz;
+    create index on alert_outbox (status, created_at);
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import logging
+import os
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_TABLE = "alert_outbox"
+PENDING = "pending"
+SENDING = "sending"
+SENT = "sent"
+OUTBOX_CLAIM_TTL = int(os.getenv("OUTBOX_CLAIM_TTL", 300))
+
+Sender = Callable[[Dict[str, Any]], Awaitable[None]]
+
+
+def rule_id(rule: Dict[str, Any]) -> str:
+    """id правила address_alerts; для строк без id — user_id:address."""
+    rid = rule.get("id")
+    if rid is not None:
+        return str(rid)
+    return f"{rule.get('user_id')}:{rule.get('address_to_track')}"
+
+
+def alert_key(rule: Dict[str, Any], signatures: Iterable[str]) -> str:
+    """Детерминированный ключ алерта: одинаков для одного и того же бандла правила."""
+    raw = rule_id(rule) + "|" + ",".join(sorted(signatures))
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+@dataclass
+class OutboxAlert:
+    rule: Dict[str, Any]
+    signatures: List[str]
+    text: str
+    parse_mode: Optional[str] = "Markdown"
+
+    @property
+    def key(self) -> str:
+        return alert_key(self.rule, self.signatures)
+
+    def to_row(self) -> Dict[str, Any]:
+        return {
+            "alert_key": self.key,
+            "rule_id": rule_id(self.rule),
+            "chat_id": self.rule["chat_id"],
+            "text": self.text,
+            "parse_mode": self.parse_mode,
+            "signatures": sorted(self.signatures),
+            "status": PENDING,
+        }
+
+
+class AlertOutbox:
+    """Запись найденных бандлов и пакетная доставка (sync Supabase-клиент)."""
+
+    def __init__(self, sb, *, batch_size: int = 100, claim_ttl: int = OUTBOX_CLAIM_TTL):
+        self._sb = sb
+        self.batch_size = batch_size
+        self.claim_ttl = claim_ttl
+        self.owner = uuid.uuid4().hex
+
+    def enqueue(self, alerts: Iterable[OutboxAlert]) -> int:
+        """Одним upsert кладёт алерты в outbox; уже известные ключи игнорируются.
+        Возвращает кол-во реально новых записей."""
+        rows = {}
+        for alert in alerts:
+            if alert.signatures:
+                row = alert.to_row()
+                rows[row["alert_key"]] = row
+        if not rows:
+            return 0
+        res = (
+            self._sb.table(OUTBOX_TABLE)
+                    .upsert(list(rows.values()), on_conflict="alert_key", ignore_duplicates=True)
+                    .execute()
+        )
+        return len(res.data or [])
+
+    def pending(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        return (
+            self._sb.table(OUTBOX_TABLE)
+                    .select("*")
+                    .eq("status", PENDING)
+                    .order("created_at")
+                    .limit(limit or self.batch_size)
+                    .execute()
+        ).data or []
+
+    def claim(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Захватывает pending-записи за этим отправителем. Возвращает только
+        те, что удалось перевести в sending: записи, захваченные другим
+        процессом между select и update, условие status='pending' отсекает.
+        """
+        keys = [e["alert_key"] for e in self.pending(limit)]
+        if not keys:
+            return []
+        res = (
+            self._sb.table(OUTBOX_TABLE)
+                    .update({"status": SENDING, "claimed_by": self.owner,
+                             "claimed_at": datetime.now(timezone.utc).isoformat()})
+                    .in_("alert_key", keys)
+                    .eq("status", PENDING)
+                    .execute()
+        )
+        return sorted(res.data or [], key=lambda e: e.get("created_at") or "")
+
+    def release(self, entries: List[Dict[str, Any]]) -> None:
+        """Возвращает неотправленные записи в pending для следующего прохода."""
+        if not entries:
+            return
+        self._sb.table(OUTBOX_TABLE).update(
+            {"status": PENDING, "claimed_by": None, "claimed_at": None}
+        ).in_("alert_key", [e["alert_key"] for e in entries]).eq("claimed_by", self.owner).execute()
+
+    def requeue_stale(self) -> int:
+        """Захваты старше claim_ttl (отправитель упал посреди пачки) → снова pending."""
+        cutoff = (datetime.now(timezone.utc) - timedelta(seconds=self.claim_ttl)).isoformat()
+        res = (
+            self._sb.table(OUTBOX_TABLE)
+                    .update({"status": PENDING, "claimed_by": None, "claimed_at": None})
+                    .eq("status", SENDING)
+                    .lt("claimed_at", cutoff)
+                    .execute()
+        )
+        return len(res.data or [])
+
+    def mark_sent(self, entries: List[Dict[str, Any]]) -> None:
+        """Два запроса на всю пачку: статус outbox и sent-флаги трансферов."""
+        if not entries:
+            return
+        keys = [e["alert_key"] for e in entries]
+        signatures = sorted({s for e in entries for s in (e.get("signatures") or [])})
+        self._sb.table(OUTBOX_TABLE).update(
+            {"status": SENT, "sent_at": datetime.now(timezone.utc).isoformat()}
+        ).in_("alert_key", keys).execute()
+        if signatures:
+            self._sb.table("tracked_transactions").update({"sent": True}).in_("signature", signatures).execute()
+
+    async def drain(self, send: Sender) -> int:
+        """
+        Захватывает pending-алерты, отправляет через send(entry) и пакетно
+        помечает доставленные. Ошибка отправки возвращает запись в pending
+        до следующего прохода; дубль возможен лишь при падении между
+        отправкой и mark_sent, если захват успеет протухнуть.
+        """
+        requeued = await asyncio.to_thread(self.requeue_stale)
+        if requeued:
+            logger.warning("Outbox: %d зависших захватов возвращено в pending", requeued)
+        total = 0
+        while True:
+            entries = await asyncio.to_thread(self.claim)
+            if not entries:
+                return total
+            # отправки пачки идут параллельно: очередь доставки сама держит лимиты
+            # и склеивает алерты одного чата
+            results = await asyncio.gather(*(send(e) for e in entries), return_exceptions=True)
+            delivered, failed = [], []
+            for entry, res in zip(entries, results):
+                if isinstance(res, Exception):
+                    logger.error("Outbox: не удалось отправить %s в %s: %s",
+                                 entry["alert_key"], entry.get("chat_id"), res)
+                    failed.append(entry)
+                else:
+                    delivered.append(entry)
+            await asyncio.to_thread(self.mark_sent, delivered)
+            await asyncio.to_thread(self.release, failed)
+            total += len(delivered)
+            if failed or len(entries) < self.batch_size:
+                return total
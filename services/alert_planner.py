@@ -0,0 +1,94 @@
+# services/alert_planner.py
+"""
+Планировщик проверки bundle-правил: один запрос к tracked_transactions на адрес.
+
+Активные правила группируются по `address_to_track`. Для каждого адреса
+выбирается объединённое окно (максимальный `time_gap_min` среди его правил),
+транзакции за это окно читаются один раз, а каждое правило проверяется на
+своём срезе общего списка (`TxWindow.since`). Нагрузка на БД за цикл
+растёт с числом различных адресов, а не с числом правил.
+"""
+from __future__ import annotations
+
+from bisect import bisect_left
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+
+from services.bundle_cluster import lamports_array
+from utils.time_utils import parse_iso, window_start
+
+
+@dataclass
+class AddressPlan:
+    address: str
+    rules: List[Dict[str, Any]] = field(default_factory=list)
+    max_gap_min: float = 0
+
+    def since(self, now: Optional[datetime] = None) -> datetime:
+        """Начало объединённого окна для адреса."""
+        return window_start(self.max_gap_min, now)
+
+
+def plan_by_address(rules: Iterable[Dict[str, Any]]) -> List[AddressPlan]:
+    """Группирует правила по адресу; правила без адреса или окна пропускаются."""
+    plans: Dict[str, AddressPlan] = {}
+    for rule in rules:
+        addr = rule.get("address_to_track")
+        gap = rule.get("time_gap_min")
+        if not addr or not gap:
+            continue
+        plan = plans.setdefault(addr, AddressPlan(addr))
+        plan.rules.append(rule)
+        plan.max_gap_min = max(plan.max_gap_min, gap)
+    return list(plans.values())
+
+
+class TxWindow:
+    """
+    Транзакции одного адреса за объединённое окно, отсортированные по
+    block_time, чтобы срез под окно правила брался бинарным поиском.
+    """
+
+    def __init__(self, rows: Iterable[Dict[str, Any]]):
+        timed = [(ts, row) for row in rows if (ts := parse_iso(row.get("block_time"))) is not None]
+        timed.sort(key=lambda pair: pair[0])
+        self._times = [ts for ts, _ in timed]
+        self._rows = [row for _, row in timed]
+        self._lamports: Optional[np.ndarray] = None
+
+    @property
+    def rows(self) -> List[Dict[str, Any]]:
+        return self._rows
+
+    @property
+    def lamports(self) -> np.ndarray:
+        """Суммы строк в lamports (int64), выровненные с `rows`; считаются один раз."""
+        if self._lamports is None:
+            self._lamports = lamports_array(self._rows)
+        return self._lamports
+
+    def start_index(self, start: datetime) -> int:
+        return bisect_left(self._times, start)
+
+    def since(self, start: datetime) -> List[Dict[str, Any]]:
+        return self._rows[self.start_index(start):]
+
+    def for_rule(self, rule: Dict[str, Any], now: Optional[datetime] = None) -> List[Dict[str, Any]]:
+        return self.since(window_start(rule["time_gap_min"], now))
+
+    def discard(self, ids: Iterable[Any]) -> None:
+        """Убирает строки (по `id`), уже отмеченные как отправленные."""
+        drop = set(ids)
+        if not drop:
+            return
+        keep = [i for i, row in enumerate(self._rows) if row.get("id") not in drop]
+        self._times = [self._times[i] for i in keep]
+        self._rows = [self._rows[i] for i in keep]
+        if self._lamports is not None:
+            self._lamports = self._lamports[keep]
+
+    def __len__(self) -> int:
+        return len(self._rows)
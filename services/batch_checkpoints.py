@@ -0,0 +1,144 @@
+# services/batch_checkpoints.py
+"""
+Чекпоинты этапов All-In Parse под batch_id.
+
+Чанки DAG выполняются на разных воркерах и хостах (очередь selenium),
+а finalize — на другой очереди, поэтому результаты этапов лежат не на
+локальном диске, а в общем payload store (services/payload_store.py).
+Индекс чекпоинта — hash Redis `all_in_parse:checkpoint:<batch_id>`:
+    tokens        — ссылка на список токенов этапа 1 (фиксирует нарезку на чанки);
+    traders:<i>   — ссылка на трейдеров i-го пакета токенов;
+    pnl:<i>       — ссылка на PNL-CSV i-го пакета трейдеров.
+Поле пишется после того, как данные легли в хранилище, поэтому его
+наличие означает, что чанк завершён. Повторная попытка задачи или новый
+запуск с тем же batch_id пропускает готовые чанки. Индекс удаляется после
+успешной финальной задачи, брошенные истекают через CHECKPOINT_TTL.
+Отсутствующий результат чанка — ошибка (ChunkResultMissing), а не
+пустой кусок отчёта.
+
+Незавершённый batch_id запуска хранится в Redis (`active_batch`), чтобы
+перезапуск после падения подхватывал уже скачанные данные. Пока batch
+выполняется, на нём стоит маркер `live` (снимается в finalize/errback,
+иначе истекает через BATCH_LIVE_TTL): второй запуск того же run_key в это
+время не подхватывает чужой batch, а начинает свой.
+"""
+from __future__ import annotations
+
+import os
+from typing import List, Optional
+
+from services.payload_store import PAYLOAD_TTL, PayloadMissing, PayloadStore, default_store
+from services.redis_pool import get_redis
+
+CHECKPOINT_TTL = PAYLOAD_TTL
+ACTIVE_BATCH_TTL = 24 * 3600
+BATCH_LIVE_TTL = int(os.getenv("ALL_IN_MAX_RUNTIME", 6 * 3600))   # худший случай длительности DAG
+KEY_PREFIX = "all_in_parse:checkpoint:"
+ACTIVE_BATCH_PREFIX = "all_in_parse:active_batch:"
+LIVE_PREFIX = "all_in_parse:live:"
+
+# снимает указатель, только если он всё ещё на наш batch
+_FINISH = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    redis.call('del', KEYS[1])
+end
+return redis.call('del', KEYS[2])
+"""
+
+
+class ChunkResultMissing(RuntimeError):
+    """Результат чанка не найден ни в ответе задачи, ни в чекпоинте."""
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class BatchCheckpoint:
+    def __init__(self, batch_id: str, redis_client=None, store: Optional[PayloadStore] = None):
+        self.batch_id = batch_id
+        self.redis = redis_client or get_redis()
+        self.store = store or default_store()
+        self.key = KEY_PREFIX + batch_id
+
+    def _ref(self, field: str) -> Optional[str]:
+        return _decode(self.redis.hget(self.key, field))
+
+    def _save_ref(self, field: str, ref: str) -> str:
+        pipe = self.redis.pipeline()
+        pipe.hset(self.key, field, ref)
+        pipe.expire(self.key, CHECKPOINT_TTL)
+        pipe.execute()
+        return ref
+
+    def _load_lines(self, field: str) -> Optional[List[str]]:
+        ref = self._ref(field)
+        if ref is None:
+            return None
+        try:
+            return self.store.get(ref)
+        except PayloadMissing:
+            return None   # данные истекли раньше индекса — чанк считается заново
+
+    # ─────────── этап 1: токены ───────────
+    def load_tokens(self) -> Optional[list]:
+        return self._load_lines("tokens")
+
+    def save_tokens(self, tokens: list) -> None:
+        self._save_ref("tokens", self.store.put(tokens))
+
+    # ─────────── этап 2: трейдеры ───────────
+    def load_traders(self, index: int) -> Optional[List[str]]:
+        return self._load_lines(f"traders:{index}")
+
+    def save_traders(self, index: int, traders: List[str]) -> None:
+        self._save_ref(f"traders:{index}", self.store.put(traders))
+
+    # ─────────── этап 3: PNL ───────────
+    def pnl_ref(self, index: int) -> Optional[str]:
+        return self._ref(f"pnl:{index}")
+
+    def save_pnl_ref(self, index: int, ref: str) -> str:
+        """CSV уже в хранилище (результат задачи или кэш services/job_dedup.py)."""
+        return self._save_ref(f"pnl:{index}", ref)
+
+    def save_pnl(self, index: int, data: bytes) -> str:
+        return self.save_pnl_ref(index, self.store.put_bytes(data))
+
+    def load_pnl(self, index: int, ref: Optional[str] = None) -> bytes:
+        ref = ref or self.pnl_ref(index)
+        if ref is None:
+            raise ChunkResultMissing(f"batch {self.batch_id}: нет PNL-пакета {index}")
+        try:
+            return self.store.get_bytes(ref)
+        except PayloadMissing:
+            raise ChunkResultMissing(f"batch {self.batch_id}: PNL-пакет {index} истёк в хранилище") from None
+
+    def cleanup(self) -> None:
+        # сами данные адресуются хэшем и могут быть общими с кэшем job_dedup — их снимет TTL
+        self.redis.delete(self.key)
+
+
+def claim_batch(redis_client, run_key: str, new_id: str) -> str:
+    """
+    batch_id незавершённого запуска run_key, если он сейчас не выполняется,
+    иначе new_id. Выбранный batch помечается как выполняющийся.
+    """
+    active_key = ACTIVE_BATCH_PREFIX + run_key
+    active = _decode(redis_client.get(active_key))
+    if active and redis_client.set(LIVE_PREFIX + active, new_id, nx=True, ex=BATCH_LIVE_TTL):
+        redis_client.expire(active_key, ACTIVE_BATCH_TTL)
+        return active
+    redis_client.set(LIVE_PREFIX + new_id, new_id, ex=BATCH_LIVE_TTL)
+    redis_client.set(active_key, new_id, ex=ACTIVE_BATCH_TTL)
+    return new_id
+
+
+def release_batch(redis_client, batch_id: str) -> None:
+    """Прогон остановился с ошибкой: batch остаётся для продолжения следующим запуском."""
+    redis_client.delete(LIVE_PREFIX + batch_id)
+
+
+def finish_batch(redis_client, run_key: str, batch_id: str) -> None:
+    """Прогон завершён: следующий запуск run_key начнётся с нуля."""
+    redis_client.eval(_FINISH, 2, ACTIVE_BATCH_PREFIX + run_key, LIVE_PREFIX + batch_id, batch_id)
@@ -0,0 +1,90 @@
+# services/bundle_cluster.py
+"""
+Векторная кластеризация трансферов по суммам в целых lamports.
+
+Суммы хранятся как int64 lamports, поэтому сравнения точные (без Decimal
+и float). Поиск бандла: маска по min/max, `argsort`, затем `searchsorted`
+даёт для каждого левого края самый дальний правый в пределах amount_step —
+наибольший кластер находится одним `argmax`. Возвращаются индексы в
+исходный массив, а не копии строк.
+"""
+from __future__ import annotations
+
+from decimal import ROUND_CEILING, ROUND_FLOOR, Decimal
+from typing import Any, Dict, Optional, Sequence
+
+import numpy as np
+
+LAMPORT_DECIMALS = 9
+LAMPORTS_PER_SOL = 10 ** LAMPORT_DECIMALS
+
+_EMPTY = np.empty(0, dtype=np.intp)
+
+
+def to_lamports(amount, decimals=None) -> int:
+    """Сырая сумма с `decimals` знаками → целые lamports (9 знаков)."""
+    dec = int(decimals) if decimals not in (None, "") else LAMPORT_DECIMALS
+    shift = LAMPORT_DECIMALS - dec
+    value = int(amount)
+    return value * 10 ** shift if shift >= 0 else value // 10 ** (-shift)
+
+
+def sol_to_lamports(value, rounding=ROUND_FLOOR) -> int:
+    """SOL (число/строка) → lamports. rounding=ROUND_CEILING для нижних границ."""
+    return int((Decimal(str(value)) * LAMPORTS_PER_SOL).to_integral_value(rounding=rounding))
+
+
+def lamports_array(rows: Sequence[Dict[str, Any]]) -> np.ndarray:
+    """Колонки amount/decimals списка строк → int64 lamports (один проход)."""
+    n = len(rows)
+    raw = np.fromiter((int(r["amount"]) for r in rows), dtype=np.int64, count=n)
+    dec = np.fromiter((int(r.get("decimals") or LAMPORT_DECIMALS) for r in rows), dtype=np.int64, count=n)
+    if n == 0 or (dec == LAMPORT_DECIMALS).all():
+        return raw
+    shift = LAMPORT_DECIMALS - dec
+    up = np.power(10, np.clip(shift, 0, None), dtype=np.int64)
+    down = np.power(10, np.clip(-shift, 0, None), dtype=np.int64)
+    return raw * up // down
+
+
+def largest_cluster(
+    amounts: np.ndarray,
+    eps: int,
+    *,
+    amin: int = 0,
+    amax: Optional[int] = None,
+    min_cnt: int = 1,
+) -> np.ndarray:
+    """
+    Индексы наибольшей группы трансферов с amin ≤ amount ≤ amax и
+    разбросом max-min ≤ eps (всё в lamports), упорядоченные по сумме.
+    Пустой массив, если группа меньше min_cnt.
+    """
+    amounts = np.asarray(amounts, dtype=np.int64)
+    mask = amounts >= amin
+    if amax is not None:
+        mask &= amounts <= amax
+    idx = np.flatnonzero(mask)
+    if idx.size < max(min_cnt, 1):
+        return _EMPTY
+
+    order = idx[np.argsort(amounts[idx], kind="stable")]
+    sorted_amounts = amounts[order]
+    right = np.searchsorted(sorted_amounts, sorted_amounts + eps, side="right")
+    sizes = right - np.arange(sorted_amounts.size)
+    best = int(np.argmax(sizes))
+    if sizes[best] < min_cnt:
+        return _EMPTY
+    return order[best:right[best]]
+
+
+def rule_bounds(rule: Dict[str, Any]) -> Dict[str, Any]:
+    """Параметры правила address_alerts в lamports для largest_cluster."""
+    amax = rule.get("max_transfer_amount")
+    step = rule.get("amount_step")   # 0 — бандл из одинаковых сумм, не «не задано»
+    return {
+        "eps": sol_to_lamports(step if step is not None else "0.1"),
+        "amin": sol_to_lamports(rule.get("min_transfer_amount") or 0, ROUND_CEILING),
+        "amax": sol_to_lamports(amax) if amax is not None else None,
+        "min_cnt": int(rule.get("min_cnt") or 1),
+    }
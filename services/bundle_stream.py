@@ -0,0 +1,296 @@
+# services/bundle_stream.py
+"""
+Потоковый инкрементальный детектор бандлов.
+
+Трекер (bundle_tracker_worker) после записи новых трансферов публикует их
+в Redis Stream `TRANSFER_STREAM` — одно сообщение на пачку адреса.
+Консьюмер (`consume_transfers`) читает поток и передаёт пачки в
+`BundleStreamEngine`, который для каждого адреса держит окно трансферов
+в двух `SortedList`:
+  • по сумме (lamports) — для поиска кластера в пределах amount_step;
+  • по времени — для вытеснения всего, что старше max(time_gap_min).
+При вставке проверяются только соседи новых трансферов по сумме
+(±amount_step), поэтому алерт находится сразу при поступлении данных,
+без перезапроса и пересортировки всего окна.
+
+Позиция чтения хранится в Redis (`<TRANSFER_STREAM>:offset:<consumer>`)
+после каждой обработанной пачки: перезапущенный консьюмер дочитывает всё,
+что трекер опубликовал за время простоя. Повторно обработанные сообщения
+(падение посреди пачки) дают те же ключи outbox и не дублируют алерты.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import math
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from sortedcontainers import SortedList
+
+from services.bundle_cluster import rule_bounds, to_lamports
+from utils.time_utils import parse_iso
+
+logger = logging.getLogger(__name__)
+
+TRANSFER_STREAM = "bundle_tracker:transfers"
+STREAM_MAXLEN = 100_000
+DEFAULT_CONSUMER = "alert_worker"
+
+Alert = Tuple[Dict[str, Any], List[Dict[str, Any]]]
+
+
+# ─────────── нормализация трансферов ───────────
+def _epoch(value) -> Optional[float]:
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return None if isinstance(value, float) and math.isnan(value) else float(value)
+    if hasattr(value, "timestamp"):
+        return value.timestamp()
+    dt = parse_iso(value)
+    return dt.timestamp() if dt else None
+
+
+def transfer_from_row(row: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Строка tracked_transactions / CSV Solscan → компактный трансфер для потока."""
+    ts = _epoch(row.get("block_time"))
+    sig = row.get("signature")
+    if ts is None or not sig or row.get("amount") is None:
+        return None
+    try:
+        amount = to_lamports(row["amount"], row.get("decimals"))
+    except (TypeError, ValueError):
+        return None
+    return {"signature": sig, "to": row.get("to"), "amount": amount, "block_time": ts}
+
+
+def publish_transfers(redis_client, address: str, rows: Iterable[Dict[str, Any]]) -> int:
+    """Публикует пачку новых трансферов адреса в Redis Stream. Возвращает кол-во."""
+    payload = [t for t in (transfer_from_row(r) for r in rows) if t]
+    if not payload:
+        return 0
+    redis_client.xadd(
+        TRANSFER_STREAM,
+        {"address": address, "rows": json.dumps(payload)},
+        maxlen=STREAM_MAXLEN,
+        approximate=True,
+    )
+    return len(payload)
+
+
+# ─────────── состояние ───────────
+@dataclass
+class _RuleState:
+    rule: Dict[str, Any]
+    gap_sec: float
+    min_cnt: int
+    eps: int
+    amin: int
+    amax: Optional[int]
+    alerted: Set[str] = field(default_factory=set)
+
+    @classmethod
+    def from_rule(cls, rule: Dict[str, Any]) -> "_RuleState":
+        # те же границы, что у опроса (alert_worker / check_bundle_alerts)
+        return cls(rule=rule, gap_sec=float(rule["time_gap_min"]) * 60, **rule_bounds(rule))
+
+    def accepts(self, amount: int, ts: float, cutoff: float) -> bool:
+        return ts >= cutoff and amount >= self.amin and (self.amax is None or amount <= self.amax)
+
+
+class _AddressWindow:
+    def __init__(self):
+        self.by_amount = SortedList()     # (amount, ts, signature)
+        self.by_time = SortedList()       # (ts, amount, signature)
+        self.rows: Dict[str, Dict[str, Any]] = {}
+
+    def add(self, t: Dict[str, Any]) -> bool:
+        sig = t["signature"]
+        if sig in self.rows:
+            return False
+        self.rows[sig] = t
+        self.by_amount.add((t["amount"], t["block_time"], sig))
+        self.by_time.add((t["block_time"], t["amount"], sig))
+        return True
+
+    def evict(self, cutoff: float) -> None:
+        while self.by_time and self.by_time[0][0] < cutoff:
+            ts, amount, sig = self.by_time.pop(0)
+            self.by_amount.remove((amount, ts, sig))
+            self.rows.pop(sig, None)
+
+    def neighbours(self, amount: int, eps: int) -> List[Tuple[int, float, str]]:
+        return list(self.by_amount.irange((amount - eps,), (amount + eps, math.inf)))
+
+
+def _best_cluster(window: _AddressWindow, state: _RuleState, new_sigs: List[str], now: float) -> List[str]:
+    """Наибольший кластер с разбросом сумм ≤ eps, содержащий хотя бы один новый трансфер."""
+    cutoff = now - state.gap_sec
+    best: List[str] = []
+    for sig in new_sigs:
+        t = window.rows.get(sig)
+        if t is None or not state.accepts(t["amount"], t["block_time"], cutoff):
+            continue
+        cand = [c for c in window.neighbours(t["amount"], state.eps) if state.accepts(c[0], c[1], cutoff)]
+        left = 0
+        for right in range(len(cand)):
+            while cand[right][0] - cand[left][0] > state.eps:
+                left += 1
+            size = right - left + 1
+            if size > len(best) and cand[left][0] <= t["amount"] <= cand[right][0]:
+                best = [c[2] for c in cand[left:right + 1]]
+    return best
+
+
+# ─────────── движок ───────────
+class BundleStreamEngine:
+    """Инкрементальная проверка правил address_alerts по мере поступления трансферов."""
+
+    def __init__(self, clock: Callable[[], float] = time.time, max_alerted: int = 5000):
+        self._clock = clock
+        self._max_alerted = max_alerted
+        self._rules: Dict[str, List[_RuleState]] = {}
+        self._windows: Dict[str, _AddressWindow] = {}
+
+    @staticmethod
+    def _rule_key(rule: Dict[str, Any]):
+        return rule.get("id") or (rule.get("user_id"), rule.get("address_to_track"))
+
+    def set_rules(self, rules: Iterable[Dict[str, Any]]) -> None:
+        """Обновляет набор правил, сохраняя память об уже отправленных алертах."""
+        previous = {self._rule_key(s.rule): s for states in self._rules.values() for s in states}
+        grouped: Dict[str, List[_RuleState]] = {}
+        for rule in rules:
+            addr = rule.get("address_to_track")
+            if not addr or not rule.get("time_gap_min"):
+                continue
+            state = _RuleState.from_rule(rule)
+            old = previous.get(self._rule_key(rule))
+            if old is not None:
+                state.alerted = old.alerted
+            grouped.setdefault(addr, []).append(state)
+        self._rules = grouped
+        for addr in list(self._windows):
+            if addr not in grouped:
+                del self._windows[addr]
+
+    @property
+    def addresses(self) -> List[str]:
+        return list(self._rules)
+
+    def ingest(self, address: str, transfers: Iterable[Dict[str, Any]], *, prime: bool = False) -> List[Alert]:
+        """
+        Добавляет пачку трансферов и возвращает [(rule, group_rows), ...].
+        `prime=True` — прогрев окна при старте: кластеры запоминаются как
+        уже отправленные, но алерты не возвращаются.
+        """
+        states = self._rules.get(address)
+        if not states:
+            return []
+        now = self._clock()
+        horizon = now - max(s.gap_sec for s in states)
+        window = self._windows.setdefault(address, _AddressWindow())
+        window.evict(horizon)
+
+        new_sigs = [t["signature"] for t in transfers if t["block_time"] >= horizon and window.add(t)]
+        if not new_sigs:
+            return []
+
+        alerts: List[Alert] = []
+        for state in states:
+            group = _best_cluster(window, state, new_sigs, now)
+            if len(group) < state.min_cnt or all(sig in state.alerted for sig in group):
+                continue
+            state.alerted.update(group)
+            if len(state.alerted) > self._max_alerted:
+                live = set(window.rows)
+                state.alerted &= live
+            if not prime:
+                alerts.append((state.rule, [window.rows[sig] for sig in group]))
+        return alerts
+
+
+# ─────────── позиция чтения ───────────
+def offset_key(consumer: str) -> str:
+    return f"{TRANSFER_STREAM}:offset:{consumer}"
+
+
+async def load_offset(redis_async, consumer: str = DEFAULT_CONSUMER) -> Optional[str]:
+    """Id последнего обработанного сообщения или None, если консьюмер стартует впервые."""
+    value = await redis_async.get(offset_key(consumer))
+    return _decode(value) if value else None
+
+
+async def backlog_signatures(redis_async, after_id: str, page: int = 1000) -> Set[str]:
+    """
+    Подписи из сообщений после after_id — то, что консьюмер ещё не видел.
+    Прогрев окна из БД должен их пропустить: иначе кластеры с ними
+    запомнятся как отправленные, и дочитанные алерты потеряются.
+    """
+    signatures: Set[str] = set()
+    start = f"({after_id}"
+    while True:
+        messages = await redis_async.xrange(TRANSFER_STREAM, min=start, max="+", count=page)
+        for msg_id, fields in messages:
+            try:
+                rows = json.loads(_decode(fields.get(b"rows", fields.get("rows"))))
+            except (TypeError, ValueError):
+                continue
+            signatures.update(r.get("signature") for r in rows if r.get("signature"))
+        if len(messages) < page:
+            return signatures
+        start = f"({_decode(messages[-1][0])}"
+
+
+# ─────────── консьюмер ───────────
+async def consume_transfers(
+    redis_async,
+    engine: BundleStreamEngine,
+    on_alert: Callable[[Dict[str, Any], List[Dict[str, Any]]], Awaitable[None]],
+    *,
+    consumer: str = DEFAULT_CONSUMER,
+    last_id: Optional[str] = None,
+    block_ms: int = 5000,
+    count: int = 100,
+) -> None:
+    """
+    Бесконечно читает TRANSFER_STREAM и отправляет найденные бандлы в on_alert.
+    Без last_id продолжает с сохранённой позиции консьюмера (при первом
+    запуске — с новых сообщений).
+    """
+    if last_id is None:
+        last_id = await load_offset(redis_async, consumer) or "$"
+    key = offset_key(consumer)
+    while True:
+        try:
+            response = await redis_async.xread({TRANSFER_STREAM: last_id}, block=block_ms, count=count)
+        except Exception as exc:
+            logger.error("Bundle stream: xread failed: %s", exc)
+            await asyncio.sleep(1)
+            continue
+        for _stream, messages in response or []:
+            for msg_id, fields in messages:
+                last_id = msg_id
+                try:
+                    address = _decode(fields.get(b"address", fields.get("address")))
+                    rows = json.loads(_decode(fields.get(b"rows", fields.get("rows"))))
+                except (TypeError, ValueError) as exc:
+                    logger.warning("Bundle stream: bad message %s: %s", msg_id, exc)
+                    continue
+                for rule, group in engine.ingest(address, rows):
+                    try:
+                        await on_alert(rule, group)
+                    except Exception as exc:
+                        logger.error("Bundle stream: alert delivery failed for %s: %s", address, exc, exc_info=True)
+            # позиция сохраняется после пачки: алерты по ней уже лежат в outbox
+            try:
+                await redis_async.set(key, last_id)
+            except Exception as exc:
+                logger.warning("Bundle stream: не удалось сохранить позицию %s: %s", _decode(last_id), exc)
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
@@ -1,5 +1,9 @@
 from supabase import create_client
-import os, datetime
+import os, datetime, logging
+
+from services import user_cache
+
+logger = logging.getLogger(__name__)
 
 _url  = os.environ["SUPABASE_URL"]
 _key  = os.environ["SUPABASE_KEY"]
@@ -16,6 +20,7 @@ def mark_code_used(code: str, tg_id: int):
         "used_by": tg_id,
         "used_at": datetime.datetime.utcnow().isoformat()
     }).eq("code", code).execute()
+    user_cache.invalidate_sync(user_cache.PREMIUM, tg_id)
 
 
 def is_premium_user(tg_id: int) -> bool:
@@ -0,0 +1,232 @@
+# services/export_writer.py
+"""
+Потоковая выгрузка CSV для отправки в Telegram.
+
+Строки пишутся сразу в сжатый поток (zip или gzip) поверх
+SpooledTemporaryFile: пока часть меньше EXPORT_SPOOL_MAX, она в памяти,
+дальше — во временном файле на диске. Целиком CSV в памяти не собирается
+ни как str, ни как bytes.
+
+Когда сжатая часть дорастает до EXPORT_PART_LIMIT (ниже лимита Bot API
+на документ в 50 МБ), она закрывается, и следующие строки идут в новую
+часть со своим заголовком: `tokens.part1.zip`, `tokens.part2.zip`, ...
+
+    with ExportWriter("tokens_20240101", FIELDNAMES) as writer:
+        async for row in iter_query_rows(lambda: client.table("tokens").select(...)):
+            writer.write_row(row)
+    await send_export(bot, chat_id, writer.parts, caption)
+
+Пиковая память выгрузки ≈ страница запроса / кусок DataFrame + EXPORT_SPOOL_MAX.
+
+У каждой части есть `digest` — sha256 несжатого CSV (заголовки zip/gzip
+содержат время и имя, поэтому сжатые байты одинаковых отчётов
+различаются). По нему send_export переотправляет уже загруженные
+части по file_id (services/file_id_cache).
+"""
+from __future__ import annotations
+
+import csv
+import gzip
+import hashlib
+import io
+import os
+import tempfile
+import zipfile
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, List, Optional, Sequence
+
+import pandas as pd
+
+from services import file_id_cache
+
+EXPORT_PART_LIMIT = int(os.getenv("EXPORT_PART_LIMIT", 45 * 1024 * 1024))
+EXPORT_SPOOL_MAX = int(os.getenv("EXPORT_SPOOL_MAX", 4 * 1024 * 1024))
+EXPORT_COMPRESSION = os.getenv("EXPORT_COMPRESSION", "zip")   # zip | gzip | none
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", 1000))
+FRAME_CHUNK_ROWS = 5000
+_SIZE_CHECK_EVERY = 500   # строк между проверками размера части
+
+_EXTENSIONS = {"zip": ".zip", "gzip": ".csv.gz", "none": ".csv"}
+
+
+@dataclass
+class ExportPart:
+    file: Any          # SpooledTemporaryFile, перемотан в начало
+    filename: str
+    rows: int
+    size: int
+    digest: str        # sha256 несжатого CSV + формат
+
+
+class _HashingStream(io.RawIOBase):
+    """Пропускает байты в нижний поток, попутно считая sha256."""
+
+    def __init__(self, target):
+        self.target = target
+        self.sha = hashlib.sha256()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self.sha.update(b)
+        self.target.write(b)
+        return len(b)
+
+
+class ExportWriter:
+    def __init__(self, basename: str, fieldnames: Optional[Sequence[str]] = None, *,
+                 compression: str = EXPORT_COMPRESSION, part_limit: int = EXPORT_PART_LIMIT,
+                 spool_max: int = EXPORT_SPOOL_MAX):
+        if compression not in _EXTENSIONS:
+            raise ValueError(f"Неизвестное сжатие: {compression}")
+        self.basename = basename
+        self.fieldnames = list(fieldnames) if fieldnames else None
+        self.compression = compression
+        self.part_limit = part_limit
+        self.spool_max = spool_max
+        self.parts: List[ExportPart] = []
+        self.total_rows = 0
+        self._raw = None
+        self._stream = None       # gzip/zip-поток под текстовой обёрткой
+        self._hashing = None
+        self._zip = None
+        self._text = None
+        self._csv = None
+        self._part_rows = 0
+
+    # ─────────── части ───────────
+    def _open_part(self) -> None:
+        self._raw = tempfile.SpooledTemporaryFile(max_size=self.spool_max)
+        inner = f"{self.basename}.csv"
+        if self.compression == "gzip":
+            self._stream = gzip.GzipFile(filename=inner, mode="wb", fileobj=self._raw)
+        elif self.compression == "zip":
+            self._zip = zipfile.ZipFile(self._raw, "w", compression=zipfile.ZIP_DEFLATED)
+            self._stream = self._zip.open(inner, "w", force_zip64=True)
+        else:
+            self._stream = self._raw
+        self._hashing = _HashingStream(self._stream)
+        self._text = io.TextIOWrapper(io.BufferedWriter(self._hashing), encoding="utf-8", newline="")
+        self._csv = csv.DictWriter(self._text, fieldnames=self.fieldnames, extrasaction="ignore")
+        self._csv.writeheader()
+        self._part_rows = 0
+
+    def _close_part(self) -> None:
+        self._text.flush()
+        self._text.detach().detach()   # не закрываем raw вместе с обёртками
+        if self._stream is not self._raw:
+            self._stream.close()
+        if self._zip is not None:
+            self._zip.close()
+        size = self._raw.tell()
+        self._raw.seek(0)
+        digest = f"{self._hashing.sha.hexdigest()}.{self.compression}"
+        self.parts.append(ExportPart(self._raw, "", self._part_rows, size, digest))
+        self._raw = self._stream = self._hashing = self._zip = self._text = self._csv = None
+
+    def _part_size(self) -> int:
+        self._text.flush()
+        return self._raw.tell()
+
+    # ─────────── запись ───────────
+    def write_row(self, row: Dict[str, Any]) -> None:
+        if self.fieldnames is None:
+            self.fieldnames = list(row.keys())
+        if self._csv is None:
+            self._open_part()
+        self._csv.writerow(row)
+        self._part_rows += 1
+        self.total_rows += 1
+        if self._part_rows % _SIZE_CHECK_EVERY == 0 and self._part_size() >= self.part_limit:
+            self._close_part()
+
+    def write_rows(self, rows: Iterable[Dict[str, Any]]) -> None:
+        for row in rows:
+            self.write_row(row)
+
+    def write_frame(self, df: pd.DataFrame, chunk_rows: int = FRAME_CHUNK_ROWS) -> None:
+        """DataFrame кусками: в dict превращается не больше chunk_rows строк за раз."""
+        if self.fieldnames is None:
+            self.fieldnames = [str(c) for c in df.columns]
+        for start in range(0, len(df), chunk_rows):
+            chunk = df.iloc[start:start + chunk_rows]
+            self.write_rows(chunk.astype(object).where(chunk.notna(), None).to_dict(orient="records"))
+
+    def write_csv_files(self, paths: Iterable[str], chunk_rows: int = FRAME_CHUNK_ROWS) -> None:
+        """
+        Склейка CSV-файлов без pd.concat: каждый читается кусками. Колонки —
+        объединение заголовков всех файлов (как у pd.concat), недостающие пусты.
+        """
+        paths = list(paths)
+        if self.fieldnames is None:
+            columns: Dict[str, None] = {}
+            for path in paths:
+                columns.update(dict.fromkeys(str(c) for c in pd.read_csv(path, nrows=0).columns))
+            self.fieldnames = list(columns)
+        for path in paths:
+            for chunk in pd.read_csv(path, chunksize=chunk_rows):
+                self.write_frame(chunk, chunk_rows)
+
+    def close(self) -> List[ExportPart]:
+        if self._csv is None and not self.parts and self.fieldnames:
+            self._open_part()       # пустая выгрузка — файл с одним заголовком
+        if self._csv is not None:
+            self._close_part()
+        ext = _EXTENSIONS[self.compression]
+        for i, part in enumerate(self.parts, 1):
+            suffix = f".part{i}" if len(self.parts) > 1 else ""
+            part.filename = f"{self.basename}{suffix}{ext}"
+        return self.parts
+
+    def discard(self) -> None:
+        if self._raw is not None:
+            self._raw.close()
+        for part in self.parts:
+            part.file.close()
+
+    def __enter__(self) -> "ExportWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+async def iter_query_rows(make_query: Callable[[], Any], page_size: int = EXPORT_PAGE_SIZE) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Постранично читает запрос postgrest (.range), отдавая строки по одной.
+    make_query должен каждый раз строить новый запрос с теми же фильтрами.
+    """
+    offset = 0
+    while True:
+        response = await make_query().range(offset, offset + page_size - 1).execute()
+        rows = response.data or []
+        for row in rows:
+            yield row
+        if len(rows) < page_size:
+            return
+        offset += page_size
+
+
+def part_caption(caption: str, index: int, total: int) -> str:
+    return caption if total == 1 else f"{caption}\n\n📦 Часть {index}/{total}"
+
+
+async def send_export(bot, chat_id: int, parts: List[ExportPart], caption: str, reply_markup=None) -> None:
+    """
+    Отправляет части документами по порядку (кнопки — под последней) и
+    закрывает временные файлы. Уже загруженные части уходят по file_id.
+    """
+    try:
+        for i, part in enumerate(parts, 1):
+            await file_id_cache.send_document(
+                bot, chat_id, part.digest, part.file, filename=part.filename,
+                caption=part_caption(caption, i, len(parts)),
+                reply_markup=reply_markup if i == len(parts) else None,
+            )
+    finally:
+        for part in parts:
+            part.file.close()
@@ -0,0 +1,124 @@
+# services/file_id_cache.py
+"""
+Реестр отправленных документов: sha256 содержимого → Telegram file_id.
+
+Одинаковые отчёты (склеенные задачи job_dedup, повторные выгрузки
+токенов) уходят разным пользователям в пределах минут. Первая доставка
+загружает файл, Bot API возвращает file_id, и он запоминается; следующие
+доставки тех же байтов отправляют только file_id — без повторной
+загрузки, за время обычного сообщения.
+
+file_id действителен только для бота, который его получил, поэтому ключ
+включает id бота: `tgfile:<bot_id>:<sha256>`. Если Telegram отверг
+сохранённый file_id (BadRequest), запись удаляется и файл загружается
+заново.
+
+Без Redis реестр живёт в памяти процесса.
+"""
+from __future__ import annotations
+
+import inspect
+import logging
+import os
+from typing import Any, Dict, Optional
+
+from telegram import InputMediaDocument
+from telegram.error import BadRequest
+
+from services.redis_pool import get_async_redis
+
+logger = logging.getLogger(__name__)
+
+FILE_ID_TTL = int(os.getenv("FILE_ID_TTL", 30 * 24 * 3600))
+KEY_PREFIX = "tgfile:"
+
+_local: Dict[str, str] = {}
+
+
+def _key(bot, digest: str) -> str:
+    # bot.id требует get_me(), а Bot в задачах Celery не инициализируется
+    return f"{KEY_PREFIX}{bot.token.split(':', 1)[0]}:{digest}"
+
+
+async def get_file_id(bot, digest: str) -> Optional[str]:
+    key = _key(bot, digest)
+    redis = get_async_redis()
+    if redis is None:
+        return _local.get(key)
+    try:
+        value = await redis.get(key)
+    except Exception as e:
+        logger.warning("FILE_ID_CACHE: Redis недоступен: %s", e)
+        return _local.get(key)
+    return value.decode() if isinstance(value, bytes) else value
+
+
+async def remember(bot, digest: str, message) -> None:
+    """Сохраняет file_id документа из ответа Bot API (Message; True для inline — пропускаем)."""
+    document = getattr(message, "document", None)
+    if document is None:
+        return
+    key = _key(bot, digest)
+    _local[key] = document.file_id
+    redis = get_async_redis()
+    if redis is not None:
+        try:
+            await redis.set(key, document.file_id, ex=FILE_ID_TTL)
+        except Exception as e:
+            logger.warning("FILE_ID_CACHE: не удалось сохранить %s: %s", key, e)
+
+
+async def forget(bot, digest: str) -> None:
+    key = _key(bot, digest)
+    _local.pop(key, None)
+    redis = get_async_redis()
+    if redis is not None:
+        try:
+            await redis.delete(key)
+        except Exception as e:
+            logger.warning("FILE_ID_CACHE: не удалось удалить %s: %s", key, e)
+
+
+async def _content(document: Any) -> Any:
+    """document — bytes/файл или функция без аргументов (в т.ч. async), вызываемая только при загрузке."""
+    if callable(document):
+        document = document()
+        if inspect.isawaitable(document):
+            document = await document
+    return document
+
+
+async def send_document(bot, chat_id: int, digest: str, document: Any, filename: Optional[str] = None, **kwargs):
+    """bot.send_document, но повторное содержимое уходит по file_id."""
+    file_id = await get_file_id(bot, digest)
+    if file_id:
+        try:
+            return await bot.send_document(chat_id=chat_id, document=file_id, **kwargs)
+        except BadRequest as e:
+            logger.info("FILE_ID_CACHE: file_id отвергнут (%s), загружаем заново", e)
+            await forget(bot, digest)
+    message = await bot.send_document(chat_id=chat_id, document=await _content(document), filename=filename, **kwargs)
+    await remember(bot, digest, message)
+    return message
+
+
+async def edit_message_document(bot, chat_id: int, message_id: int, digest: str, document: Any,
+                                filename: Optional[str] = None, caption: Optional[str] = None, reply_markup=None):
+    """bot.edit_message_media с документом, повторное содержимое — по file_id."""
+    file_id = await get_file_id(bot, digest)
+    if file_id:
+        try:
+            return await bot.edit_message_media(
+                chat_id=chat_id, message_id=message_id,
+                media=InputMediaDocument(media=file_id, caption=caption), reply_markup=reply_markup,
+            )
+        except BadRequest as e:
+            logger.info("FILE_ID_CACHE: file_id отвергнут (%s), загружаем заново", e)
+            await forget(bot, digest)
+    message = await bot.edit_message_media(
+        chat_id=chat_id, message_id=message_id,
+        media=InputMediaDocument(media=await _content(document), filename=filename, caption=caption),
+        reply_markup=reply_markup,
+    )
+    await remember(bot, digest, message)
+    return message
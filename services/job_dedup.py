@@ -0,0 +1,140 @@
+# services/job_dedup.py
+"""
+Склейка одинаковых задач PNL / топ-трейдеров и переиспользование результата.
+
+Ключ задачи — тип + sha256 нормализованного входа (отсортированные
+уникальные адреса). Нормализованный список кладётся в payload store, и
+его ссылка одновременно служит ключом: `job:<type>:<sha256>`.
+
+    :result   — ссылка на готовый результат (CSV/TXT в payload store), живёт JOB_RESULT_TTL;
+    :inflight — маркер выполняющейся задачи (SET NX, истекает вместе с visibility_timeout);
+    :waiters  — список chat_id, которым нужно отдать результат.
+
+`submit()` атомарно (Lua) выбирает один из исходов:
+    CACHED   — свежий результат уже есть, отдаём его без Discord;
+    ATTACHED — такая же задача уже в работе, chat_id дописан в waiters;
+    NEW      — задачи нет, вызывающий ставит её в очередь.
+Воркер по завершении вызывает `complete()`: результат сохраняется, waiters
+забираются и получают один и тот же файл. `fail()` снимает маркер и
+возвращает waiters для сообщения об ошибке. Задачи без своих ожидающих
+(чанки All-In Parse) только пополняют кэш через `store_result()`.
+
+Без Redis склейки нет: `submit()` всегда возвращает NEW.
+"""
+from __future__ import annotations
+
+import os
+from typing import Iterable, List, Optional, Tuple
+
+from services.payload_store import PayloadStore, default_store
+
+JOB_RESULT_TTL = int(os.getenv("JOB_RESULT_TTL", 1800))
+JOB_INFLIGHT_TTL = 7200   # = visibility_timeout брокера
+KEY_PREFIX = "job:"
+
+JOB_PNL = "pnl"
+JOB_TOP_TRADERS = "top_traders"
+RESULT_FILENAMES = {JOB_PNL: "pnl_report.csv", JOB_TOP_TRADERS: "top_traders.txt"}
+
+CACHED = "cached"
+ATTACHED = "attached"
+NEW = "new"
+
+_SUBMIT = """
+local result = redis.call('get', KEYS[1])
+if result then
+    return {0, result}
+end
+if redis.call('exists', KEYS[2]) == 1 then
+    redis.call('rpush', KEYS[3], ARGV[1])
+    return {1, ''}
+end
+redis.call('set', KEYS[2], ARGV[1], 'EX', ARGV[2])
+redis.call('del', KEYS[3])
+redis.call('rpush', KEYS[3], ARGV[1])
+redis.call('expire', KEYS[3], ARGV[2])
+return {2, ''}
+"""
+# KEYS: result, inflight, waiters; ARGV: result ref ('' при ошибке), result ttl
+_FINISH = """
+if ARGV[1] ~= '' then
+    redis.call('set', KEYS[1], ARGV[1], 'EX', ARGV[2])
+end
+local waiters = redis.call('lrange', KEYS[3], 0, -1)
+redis.call('del', KEYS[2], KEYS[3])
+return waiters
+"""
+_OUTCOMES = {0: CACHED, 1: ATTACHED, 2: NEW}
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def normalize(addresses: Iterable[str]) -> List[str]:
+    return sorted({a.strip() for a in addresses if a and a.strip()})
+
+
+class JobCoalescer:
+    def __init__(self, redis_client, store: PayloadStore, *, result_ttl: int = JOB_RESULT_TTL):
+        self.redis = redis_client
+        self.store = store
+        self.result_ttl = result_ttl
+
+    def _keys(self, job_type: str, input_ref: str) -> List[str]:
+        base = f"{KEY_PREFIX}{job_type}:{input_ref.split(':', 1)[1]}"
+        return [f"{base}:result", f"{base}:inflight", f"{base}:waiters"]
+
+    def input_ref(self, addresses: Iterable[str]) -> str:
+        """Ссылка на нормализованный вход — она же ключ задачи."""
+        return self.store.put(normalize(addresses))
+
+    def submit(self, job_type: str, addresses: Iterable[str], chat_id: int) -> Tuple[str, str]:
+        """
+        (CACHED, ссылка на результат) | (ATTACHED, ссылка на вход) | (NEW, ссылка на вход).
+        """
+        ref = self.input_ref(addresses)
+        if self.redis is None:
+            return NEW, ref
+        code, result = self.redis.eval(_SUBMIT, 3, *self._keys(job_type, ref), chat_id, JOB_INFLIGHT_TTL)
+        outcome = _OUTCOMES[int(code)]
+        return outcome, (_decode(result) if outcome == CACHED else ref)
+
+    def cached(self, job_type: str, input_ref: str) -> Optional[str]:
+        """Готовый результат без склейки (чанки DAG All-In Parse)."""
+        if self.redis is None:
+            return None
+        return _decode(self.redis.get(self._keys(job_type, input_ref)[0]))
+
+    def complete(self, job_type: str, input_ref: str, result: Optional[bytes]) -> Tuple[Optional[str], List[int]]:
+        """Сохраняет результат (None — неудача) и забирает ожидающих: (ссылка на результат, chat_id)."""
+        result_ref = self.store.put_bytes(result) if result else None
+        if self.redis is None:
+            return result_ref, []
+        waiters = self.redis.eval(_FINISH, 3, *self._keys(job_type, input_ref), result_ref or "", self.result_ttl)
+        return result_ref, [int(_decode(w)) for w in waiters]
+
+    def store_result(self, job_type: str, input_ref: str, result: bytes) -> str:
+        """
+        Только кэширует результат (чанки DAG All-In Parse). Маркер и waiters
+        не трогает: такая же задача пользователя, если она в работе, сама
+        раздаст свой результат ожидающим.
+        """
+        result_ref = self.store.put_bytes(result)
+        if self.redis is not None:
+            self.redis.set(self._keys(job_type, input_ref)[0], result_ref, ex=self.result_ttl)
+        return result_ref
+
+    def fail(self, job_type: str, input_ref: str) -> List[int]:
+        return self.complete(job_type, input_ref, None)[1]
+
+
+_default: Optional[JobCoalescer] = None
+
+
+def default_coalescer() -> JobCoalescer:
+    global _default
+    if _default is None:
+        store = default_store()
+        _default = JobCoalescer(store.redis, store)
+    return _default
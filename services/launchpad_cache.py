@@ -0,0 +1,127 @@
+# services/launchpad_cache.py
+"""
+Кэш списка лаунчпадов для меню выбора платформ.
+
+Меню открывается часто, а список меняется редко, поэтому БД здесь не
+опрашивается на каждое нажатие:
+
+    1. локальная копия процесса — живёт LAUNCHPADS_TTL секунд;
+    2. Redis-множество `launchpads` — общее для бота и background_worker;
+    3. БД (RPC get_distinct_launchpads) — только если Redis пуст/недоступен.
+
+token_fetch_loop после каждого сбора вызывает `note_launchpads()`: новые
+значения дописываются в Redis (SADD), и бот видит их не позже, чем
+истечёт его локальная копия. Дописываются только в существующий ключ:
+непустое множество считается полным списком, поэтому отсутствующий ключ
+(свежий Redis, истёк LAUNCHPADS_DB_TTL) сначала заполняется из БД.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import time
+from typing import Iterable, List, Optional
+
+from services import supabase_service
+from services.redis_pool import get_async_redis
+
+logger = logging.getLogger(__name__)
+
+LAUNCHPADS_TTL = float(os.getenv("LAUNCHPADS_TTL", 60))
+LAUNCHPADS_DB_TTL = int(os.getenv("LAUNCHPADS_DB_TTL", 6 * 3600))   # полная сверка Redis с БД
+REDIS_KEY = "launchpads"
+
+# SADD только в существующее множество; -1 — ключа нет, нужен полный список из БД
+_SADD_EXISTING = """
+if redis.call('exists', KEYS[1]) == 0 then
+    return -1
+end
+return redis.call('sadd', KEYS[1], unpack(ARGV))
+"""
+
+_values: List[str] = []
+_expires_at = 0.0
+_lock: Optional[asyncio.Lock] = None
+
+
+def _clean(names: Iterable[str]) -> set:
+    return {n for n in names if n and n != "unknown"}
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+async def _load() -> List[str]:
+    redis = get_async_redis()
+    if redis is not None:
+        try:
+            members = await redis.smembers(REDIS_KEY)
+            if members:
+                return sorted(_clean(_decode(m) for m in members))
+        except Exception as e:
+            logger.warning("LAUNCHPADS: Redis недоступен, читаем из БД: %s", e)
+            redis = None
+
+    return await _seed(redis)
+
+
+async def _seed(redis, extra: Iterable[str] = ()) -> List[str]:
+    """Полный список из БД (плюс extra) → Redis с TTL полной сверки."""
+    values = sorted(set(await supabase_service.fetch_unique_launchpads()) | _clean(extra))
+    if redis is not None and values:
+        try:
+            pipe = redis.pipeline()
+            pipe.sadd(REDIS_KEY, *values)
+            pipe.expire(REDIS_KEY, LAUNCHPADS_DB_TTL)
+            await pipe.execute()
+        except Exception as e:
+            logger.warning("LAUNCHPADS: не удалось сохранить список в Redis: %s", e)
+    return values
+
+
+async def get_launchpads() -> List[str]:
+    """Отсортированный список лаунчпадов (без 'unknown')."""
+    global _values, _expires_at, _lock
+    if time.monotonic() < _expires_at:
+        return list(_values)
+    if _lock is None:
+        _lock = asyncio.Lock()
+    async with _lock:
+        if time.monotonic() >= _expires_at:
+            values = await _load()
+            # пустой ответ (ошибка БД) не кэшируем надолго
+            _values, _expires_at = values, time.monotonic() + (LAUNCHPADS_TTL if values else 5)
+    return list(_values)
+
+
+async def note_launchpads(names: Iterable[str]) -> List[str]:
+    """
+    Дописывает в кэш лаунчпады только что собранных токенов.
+    Возвращает действительно новые (для лога).
+    """
+    global _values
+    names = _clean(names)   # может прийти генератор — нужен дважды
+    fresh = sorted(names - set(_values))
+    if not fresh:
+        return []
+    redis = get_async_redis()
+    if redis is not None:
+        try:
+            added = int(await redis.eval(_SADD_EXISTING, 1, REDIS_KEY, *fresh))
+            if added < 0:
+                # неполное множество из одной пачки меню приняло бы за весь список
+                await _seed(redis, fresh)
+            elif not added:
+                # другой процесс уже записал — просто догоняем локальную копию
+                fresh = []
+        except Exception as e:
+            logger.warning("LAUNCHPADS: не удалось обновить Redis: %s", e)
+    _values = sorted(set(_values) | names)
+    return fresh
+
+
+def invalidate() -> None:
+    global _expires_at
+    _expires_at = 0.0
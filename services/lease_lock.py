@@ -0,0 +1,244 @@
+# services/lease_lock.py
+"""
+Распределённая блокировка-аренда (lease) в Redis.
+
+• Владение по токену: ключ `lease:<name>` хранит случайный токен владельца,
+  продлить и снять блокировку может только он (Lua-скрипты сравнивают токен).
+• Короткий TTL + heartbeat: фоновый поток продлевает аренду каждые ttl/3.
+  Упавший процесс теряет блокировку через ttl секунд, а не через час, и
+  длинный прогон её не теряет, пока жив.
+• Fencing token: при каждом захвате атомарно растёт счётчик
+  `lease:<name>:fence`. Перед записью владелец может проверить `check()` —
+  если блокировку уже перехватили (пауза GC, сетевой разрыв), запись не
+  пройдёт с устаревшим fence.
+• Метрики конкуренции пишутся в hash `lease:<name>:metrics` (общие для
+  всех реплик): acquired, contended, renewed, lost, released.
+
+`run_singleton()` — обёртка для бесконечных asyncio-циклов: реплика ждёт
+аренду, запускает цикл и отменяет его, если аренда потеряна.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import threading
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "lease:"
+
+_ACQUIRE = """
+if redis.call('set', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return redis.call('incr', KEYS[2])
+end
+return 0
+"""
+_RENEW = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+_RELEASE = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class LeaseLost(RuntimeError):
+    """Аренда перехвачена другим владельцем или истекла."""
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class Lease:
+    """
+    Аренда `name` на ttl секунд для sync redis-клиента.
+
+        lease = Lease(redis_client, "all_in_parse", ttl=600)
+        if lease.acquire():
+            lease.start_heartbeat()
+            try: ...
+            finally: lease.release()
+
+    Для задач, разнесённых по нескольким процессам (DAG Celery), владение
+    передаётся через `token`/`fence`: `Lease.adopt(...)` в следующей задаче.
+    """
+
+    def __init__(self, redis_client, name: str, ttl: float = 60, *, token: Optional[str] = None,
+                 fence: Optional[int] = None):
+        self.redis = redis_client
+        self.name = name
+        self.ttl = ttl
+        self.token = token or uuid.uuid4().hex
+        self.fence = fence
+        self._key = KEY_PREFIX + name
+        self._fence_key = f"{self._key}:fence"
+        self._metrics_key = f"{self._key}:metrics"
+        self._lost = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def adopt(cls, redis_client, name: str, token: str, fence: int, ttl: float = 60) -> "Lease":
+        """Продолжение владения, полученного в другой задаче/процессе."""
+        return cls(redis_client, name, ttl, token=token, fence=fence)
+
+    @property
+    def _ttl_ms(self) -> int:
+        return int(self.ttl * 1000)
+
+    def _metric(self, field: str) -> None:
+        try:
+            self.redis.hincrby(self._metrics_key, field, 1)
+        except Exception as exc:
+            logger.debug("Lease %s: метрика %s не записана: %s", self.name, field, exc)
+
+    # ─────────── захват / продление / снятие ───────────
+    def acquire(self) -> bool:
+        fence = int(self.redis.eval(_ACQUIRE, 2, self._key, self._fence_key, self.token, self._ttl_ms))
+        if not fence:
+            self._metric("contended")
+            return False
+        self.fence = fence
+        self._lost.clear()
+        self._metric("acquired")
+        logger.info("Lease %s захвачена (fence=%d)", self.name, fence)
+        return True
+
+    def acquire_blocking(self, timeout: float, poll: float = 1.0) -> bool:
+        deadline = time.monotonic() + timeout
+        while True:
+            if self.acquire():
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(poll)
+
+    def renew(self) -> bool:
+        ok = bool(self.redis.eval(_RENEW, 1, self._key, self.token, self._ttl_ms))
+        if ok:
+            self._metric("renewed")
+        else:
+            if not self._lost.is_set():
+                logger.warning("Lease %s потеряна (fence=%s)", self.name, self.fence)
+                self._metric("lost")
+            self._lost.set()
+        return ok
+
+    def release(self) -> bool:
+        self.stop_heartbeat()
+        released = bool(self.redis.eval(_RELEASE, 1, self._key, self.token))
+        if released:
+            self._metric("released")
+        return released
+
+    # ─────────── heartbeat ───────────
+    def start_heartbeat(self, interval: Optional[float] = None) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        interval = interval or self.ttl / 3
+        self._stop.clear()
+
+        def _beat():
+            while not self._stop.wait(interval):
+                try:
+                    if not self.renew():
+                        return
+                except Exception as exc:
+                    # временный сбой Redis: пробуем ещё раз до истечения ttl
+                    logger.warning("Lease %s: heartbeat не прошёл: %s", self.name, exc)
+
+        self._thread = threading.Thread(target=_beat, name=f"lease-{self.name}", daemon=True)
+        self._thread.start()
+
+    def stop_heartbeat(self) -> None:
+        self._stop.set()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(timeout=1)
+        self._thread = None
+
+    # ─────────── проверка владения ───────────
+    @property
+    def lost(self) -> bool:
+        return self._lost.is_set()
+
+    def is_held(self) -> bool:
+        return _decode(self.redis.get(self._key)) == self.token
+
+    def check(self) -> None:
+        """Fencing-проверка перед записью: наш ли токен и самый ли свежий fence."""
+        current_fence = _decode(self.redis.get(self._fence_key))
+        if self.lost or not self.is_held() or str(self.fence) != str(current_fence):
+            self._lost.set()
+            raise LeaseLost(f"lease {self.name} (fence={self.fence}) больше не принадлежит этому процессу")
+
+    def __enter__(self) -> "Lease":
+        if not self.acquire():
+            raise LeaseLost(f"lease {self.name} занята")
+        self.start_heartbeat()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.release()
+
+
+def lease_metrics(redis_client, name: str) -> Dict[str, int]:
+    raw = redis_client.hgetall(f"{KEY_PREFIX}{name}:metrics") or {}
+    return {_decode(k): int(v) for k, v in raw.items()}
+
+
+async def run_singleton(
+    redis_client,
+    name: str,
+    factory: Callable[[Lease], Awaitable[None]],
+    *,
+    ttl: float = 60,
+    poll: Optional[float] = None,
+) -> None:
+    """
+    Запускает factory(lease) только в одной реплике. Остальные ждут и
+    перехватывают аренду, если владелец упал. Без redis_client (нет
+    REDIS_URL) цикл просто запускается — поведение одной реплики.
+    """
+    if redis_client is None:
+        logger.warning("Lease %s: Redis не настроен, запуск без блокировки", name)
+        await factory(None)
+        return
+
+    poll = poll or ttl / 3
+    while True:
+        lease = Lease(redis_client, name, ttl)
+        try:
+            acquired = await asyncio.to_thread(lease.acquire)
+        except Exception as exc:
+            logger.error("Lease %s: Redis недоступен: %s", name, exc)
+            acquired = False
+        if not acquired:
+            await asyncio.sleep(poll)
+            continue
+
+        lease.start_heartbeat()
+        task = asyncio.create_task(factory(lease))
+        try:
+            while not task.done():
+                await asyncio.wait({task}, timeout=1)
+                if lease.lost and not task.done():
+                    logger.warning("Lease %s потеряна — останавливаю цикл и жду повторного захвата", name)
+                    task.cancel()
+            if not task.cancelled() and task.exception():
+                logger.error("Lease %s: цикл завершился с ошибкой: %s", name, task.exception())
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        finally:
+            await asyncio.to_thread(lease.release)
+        if not lease.lost:
+            return
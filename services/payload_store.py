@@ -0,0 +1,160 @@
+# services/payload_store.py
+"""
+Хранилище больших аргументов задач Celery (списки кошельков / токенов).
+
+Вместо того чтобы гонять через брокер JSON на 40k адресов, отправитель
+кладёт список в хранилище и передаёт в задачу короткую ссылку
+`<кол-во>:<sha256>`. Содержимое адресуется хэшем: одинаковые списки
+хранятся один раз, повторная отправка не пишет ничего нового.
+
+• Данные — строки через "\\n" (или произвольный blob — `put_bytes`), сжатые zlib.
+• Бэкенд — Redis (`payload:<sha256>`, общий для бота и воркеров) или,
+  без Redis, каталог PAYLOAD_DIR на общем диске (`<sha256>.z`).
+• TTL: ключ Redis истекает через ttl секунд, каждое чтение его продлевает
+  (повторы задачи не теряют вход); файлы старше ttl удаляет `prune()`.
+• `iter_lines()` распаковывает поток кусками — задача читает адреса
+  по мере надобности, не держа в памяти сжатую и распакованную копии разом.
+"""
+from __future__ import annotations
+
+import hashlib
+import os
+import time
+import zlib
+from typing import Iterable, Iterator, List, Optional
+
+import config
+from services.redis_pool import get_redis
+
+PAYLOAD_TTL = int(os.getenv("PAYLOAD_TTL", 2 * 24 * 3600))
+KEY_PREFIX = "payload:"
+_READ_CHUNK = 64 * 1024
+
+
+class PayloadMissing(KeyError):
+    """Ссылка устарела (истёк TTL) или указывает на чужое хранилище."""
+
+
+def ref_size(ref: str) -> int:
+    """Кол-во элементов по ссылке — без чтения самих данных."""
+    return int(ref.split(":", 1)[0])
+
+
+class PayloadStore:
+    def __init__(self, redis_client=None, *, root: Optional[str] = None, ttl: int = PAYLOAD_TTL):
+        self.redis = redis_client
+        self.root = root or config.PAYLOAD_DIR
+        self.ttl = ttl
+
+    def _file(self, digest: str) -> str:
+        return os.path.join(self.root, f"{digest}.z")
+
+    @staticmethod
+    def _split(ref: str) -> str:
+        try:
+            count, digest = ref.split(":", 1)
+            int(count)
+        except ValueError:
+            raise PayloadMissing(ref) from None
+        return digest
+
+    # ─────────── запись ───────────
+    def put(self, items: Iterable[str]) -> str:
+        items = list(items)
+        return self.put_bytes("\n".join(items).encode("utf-8"), len(items))
+
+    def put_bytes(self, raw: bytes, count: Optional[int] = None) -> str:
+        """Произвольный blob (например, готовый CSV); count по умолчанию — размер в байтах."""
+        digest = hashlib.sha256(raw).hexdigest()
+        ref = f"{len(raw) if count is None else count}:{digest}"
+        if self.redis is not None:
+            key = KEY_PREFIX + digest
+            # тот же список уже лежит — только продлеваем
+            if not self.redis.expire(key, self.ttl):
+                self.redis.set(key, zlib.compress(raw, 6), ex=self.ttl)
+            return ref
+
+        path = self._file(digest)
+        if os.path.exists(path):
+            os.utime(path)
+            return ref
+        os.makedirs(self.root, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(zlib.compress(raw, 6))
+        os.replace(tmp, path)
+        return ref
+
+    # ─────────── чтение ───────────
+    def _compressed_chunks(self, digest: str) -> Iterator[bytes]:
+        if self.redis is not None:
+            key = KEY_PREFIX + digest
+            blob = self.redis.get(key)
+            if blob is None:
+                raise PayloadMissing(digest)
+            self.redis.expire(key, self.ttl)
+            for i in range(0, len(blob), _READ_CHUNK):
+                yield blob[i:i + _READ_CHUNK]
+            return
+
+        path = self._file(digest)
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            raise PayloadMissing(digest) from None
+        with f:
+            os.utime(path)
+            while chunk := f.read(_READ_CHUNK):
+                yield chunk
+
+    def iter_lines(self, ref: str) -> Iterator[str]:
+        decomp = zlib.decompressobj()
+        tail = b""
+        for chunk in self._compressed_chunks(self._split(ref)):
+            data = tail + decomp.decompress(chunk)
+            *lines, tail = data.split(b"\n")
+            for line in lines:
+                yield line.decode("utf-8")
+        tail += decomp.flush()
+        if tail:
+            yield tail.decode("utf-8")
+
+    def get(self, ref: str) -> List[str]:
+        return list(self.iter_lines(ref))
+
+    def get_bytes(self, ref: str) -> bytes:
+        decomp = zlib.decompressobj()
+        parts = [decomp.decompress(chunk) for chunk in self._compressed_chunks(self._split(ref))]
+        return b"".join(parts) + decomp.flush()
+
+    # ─────────── очистка ───────────
+    def delete(self, ref: str) -> None:
+        digest = self._split(ref)
+        if self.redis is not None:
+            self.redis.delete(KEY_PREFIX + digest)
+        elif os.path.exists(self._file(digest)):
+            os.remove(self._file(digest))
+
+    def prune(self) -> int:
+        """Удаляет файлы старше ttl (для Redis-бэкенда TTL следит сам Redis)."""
+        if self.redis is not None or not os.path.isdir(self.root):
+            return 0
+        cutoff = time.time() - self.ttl
+        removed = 0
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.endswith(".z") and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+        return removed
+
+
+_default: Optional[PayloadStore] = None
+
+
+def default_store() -> PayloadStore:
+    """Общее хранилище процесса: Redis из REDIS_URL, иначе PAYLOAD_DIR."""
+    global _default
+    if _default is None:
+        _default = PayloadStore(get_redis())
+    return _default
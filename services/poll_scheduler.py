@@ -0,0 +1,145 @@
+# services/poll_scheduler.py
+"""
+Планировщик опроса адресов по времени следующего запуска (min-heap).
+
+У каждого адреса свой интервал опроса:
+  • нашли новые трансферы → интервал сокращается (`shrink`), вплоть до `min_interval`;
+  • ничего нового → интервал растёт (`grow`).
+Рост ограничен сверху потолком, выведенным из самого маленького
+`time_gap_min` среди правил адреса: алерт смотрит только последние
+time_gap_min минут, поэтому адрес нельзя опрашивать реже, чем
+`gap_fraction * time_gap_min`, иначе бандл выпадет из окна раньше,
+чем попадёт в БД. Так гарантируется минимальная частота опроса, а
+браузеры и прокси уходят на адреса, которые реально двигают средства.
+"""
+from __future__ import annotations
+
+import heapq
+import itertools
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+@dataclass
+class _Entry:
+    interval: float
+    ceiling: float
+    due: float
+    generation: int = 0
+
+
+class AdaptivePollScheduler:
+    def __init__(
+        self,
+        base_interval: float,
+        *,
+        min_interval: float = 15.0,
+        max_interval: float = 3600.0,
+        shrink: float = 0.5,
+        grow: float = 1.5,
+        gap_fraction: float = 0.5,
+    ):
+        self.base_interval = base_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.shrink = shrink
+        self.grow = grow
+        self.gap_fraction = gap_fraction
+        self._entries: Dict[str, _Entry] = {}
+        self._heap: List[Tuple[float, int, str, int]] = []
+        self._seq = itertools.count()
+
+    # ─────────── helpers ───────────
+    def _ceiling_for(self, gap_min: Optional[float]) -> float:
+        if not gap_min:
+            return self.max_interval
+        return max(self.min_interval, min(self.max_interval, gap_min * 60 * self.gap_fraction))
+
+    def _push(self, addr: str, entry: _Entry) -> None:
+        entry.generation += 1
+        heapq.heappush(self._heap, (entry.due, next(self._seq), addr, entry.generation))
+
+    # ─────────── public API ───────────
+    def sync(self, rules: Iterable[dict], now: Optional[float] = None) -> None:
+        """
+        Синхронизирует набор адресов с активными правилами address_alerts.
+        Новые адреса опрашиваются сразу, удалённые выпадают из расписания.
+        """
+        now = time.monotonic() if now is None else now
+        gaps: Dict[str, Optional[float]] = {}
+        for rule in rules:
+            addr = rule.get("address_to_track")
+            if not addr:
+                continue
+            gap = rule.get("time_gap_min")
+            prev = gaps.get(addr)
+            gaps[addr] = gap if prev is None or (gap is not None and gap < prev) else prev
+
+        for addr in list(self._entries):
+            if addr not in gaps:
+                del self._entries[addr]   # записи в куче станут «протухшими»
+
+        for addr, gap in gaps.items():
+            ceiling = self._ceiling_for(gap)
+            entry = self._entries.get(addr)
+            if entry is None:
+                entry = _Entry(interval=min(self.base_interval, ceiling), ceiling=ceiling, due=now)
+                self._entries[addr] = entry
+                self._push(addr, entry)
+            elif entry.ceiling != ceiling:
+                entry.ceiling = ceiling
+                if entry.interval > ceiling:
+                    entry.interval = ceiling
+                    entry.due = min(entry.due, now + ceiling)
+                    self._push(addr, entry)
+
+    def pop_due(self, now: Optional[float] = None) -> List[str]:
+        """Снимает с кучи все адреса, срок которых наступил."""
+        now = time.monotonic() if now is None else now
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            _, _, addr, gen = heapq.heappop(self._heap)
+            entry = self._entries.get(addr)
+            if entry is None or entry.generation != gen:
+                continue
+            due.append(addr)
+        return due
+
+    def report(self, addr: str, found_new: bool, now: Optional[float] = None) -> float:
+        """Пересчитывает интервал по итогам опроса и ставит адрес обратно в очередь."""
+        entry = self._entries.get(addr)
+        if entry is None:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        factor = self.shrink if found_new else self.grow
+        entry.interval = max(self.min_interval, min(entry.ceiling, entry.interval * factor))
+        entry.due = now + entry.interval
+        self._push(addr, entry)
+        return entry.interval
+
+    def retry_later(self, addr: str, delay: float, now: Optional[float] = None) -> None:
+        """Неудачный опрос: интервал не трогаем, повторяем через delay."""
+        entry = self._entries.get(addr)
+        if entry is None:
+            return
+        now = time.monotonic() if now is None else now
+        entry.due = now + min(delay, entry.ceiling)
+        self._push(addr, entry)
+
+    def seconds_until_next(self, now: Optional[float] = None) -> Optional[float]:
+        now = time.monotonic() if now is None else now
+        while self._heap:
+            due, _, addr, gen = self._heap[0]
+            entry = self._entries.get(addr)
+            if entry is None or entry.generation != gen:
+                heapq.heappop(self._heap)
+                continue
+            return max(0.0, due - now)
+        return None
+
+    def intervals(self) -> Dict[str, float]:
+        return {addr: e.interval for addr, e in self._entries.items()}
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,198 @@
+# services/proxy_manager.py
+"""
+Пул прокси с оценкой здоровья, взвешенным выбором и circuit breaker'ом.
+
+Для каждого прокси хранится скользящее окно результатов (успех/ошибка) и
+EWMA латентности. `acquire()` выбирает прокси случайно с весом
+success_rate / latency, т.е. быстрые и стабильные получают больше работы.
+После `failure_threshold` ошибок подряд цепь размыкается: прокси выпадает
+из ротации, а фоновый `reprobe_loop()` параллельно перепроверяет
+разомкнутые прокси после `cooldown` секунд и возвращает живые в пул.
+
+Сама проверка (probe) передаётся снаружи — это корутина `proxy -> bool`,
+так модуль не зависит от Playwright.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Deque, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+
+Probe = Callable[[str], Awaitable[bool]]
+
+
+@dataclass
+class ProxyStats:
+    """Скользящая статистика одного прокси."""
+    url: str
+    window: int = 20
+    results: Deque[bool] = field(default_factory=deque)
+    latency: Optional[float] = None       # EWMA, секунды
+    consecutive_failures: int = 0
+    state: str = CLOSED
+    opened_at: float = 0.0
+
+    def record(self, ok: bool, latency: Optional[float], alpha: float) -> None:
+        self.results.append(ok)
+        while len(self.results) > self.window:
+            self.results.popleft()
+        if ok:
+            self.consecutive_failures = 0
+            if latency is not None:
+                self.latency = latency if self.latency is None else alpha * latency + (1 - alpha) * self.latency
+        else:
+            self.consecutive_failures += 1
+
+    @property
+    def success_rate(self) -> float:
+        if not self.results:
+            return 1.0  # оптимистично для новых прокси
+        return sum(self.results) / len(self.results)
+
+    def reset(self) -> None:
+        self.results.clear()
+        self.consecutive_failures = 0
+        self.state = CLOSED
+        self.opened_at = 0.0
+
+
+class ProxyManager:
+    """
+    Менеджер прокси: параллельная стартовая проверка, взвешенный выбор,
+    размыкание цепи при серии ошибок и фоновая перепроверка.
+    """
+
+    def __init__(
+        self,
+        proxies: Iterable[str],
+        probe: Probe,
+        *,
+        window: int = 20,
+        failure_threshold: int = 3,
+        cooldown: float = 120.0,
+        reprobe_interval: float = 30.0,
+        probe_concurrency: int = 5,
+        latency_alpha: float = 0.3,
+        min_success_rate: float = 0.05,
+    ):
+        self._probe = probe
+        self._stats: Dict[str, ProxyStats] = {p: ProxyStats(p, window=window) for p in proxies}
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.reprobe_interval = reprobe_interval
+        self.latency_alpha = latency_alpha
+        self.min_success_rate = min_success_rate
+        self._probe_sem = asyncio.Semaphore(probe_concurrency)
+
+    # ─────────── probing ───────────
+    async def _timed_probe(self, proxy: str) -> tuple[bool, float]:
+        async with self._probe_sem:
+            t0 = time.perf_counter()
+            try:
+                ok = bool(await self._probe(proxy))
+            except Exception as exc:
+                logger.warning("Probe %s упал: %s", proxy, exc)
+                ok = False
+            return ok, time.perf_counter() - t0
+
+    async def validate_all(self) -> List[str]:
+        """Параллельно проверяет все прокси; непрошедшие сразу размыкаются."""
+        proxies = list(self._stats)
+        results = await asyncio.gather(*(self._timed_probe(p) for p in proxies))
+        healthy = []
+        for proxy, (ok, latency) in zip(proxies, results):
+            st = self._stats[proxy]
+            if ok:
+                st.reset()
+                st.record(True, latency, alpha=1.0)
+                healthy.append(proxy)
+            else:
+                st.record(False, None, self.latency_alpha)
+                self._open(st)
+        logger.info("Проверка прокси: рабочих %d из %d", len(healthy), len(proxies))
+        return healthy
+
+    async def reprobe_loop(self) -> None:
+        """Фоновая задача: перепроверяет разомкнутые прокси после cooldown."""
+        while True:
+            await asyncio.sleep(self.reprobe_interval)
+            try:
+                await self.reprobe_once()
+            except Exception as exc:
+                logger.error("reprobe_loop: %s", exc, exc_info=True)
+
+    async def reprobe_once(self) -> List[str]:
+        now = time.monotonic()
+        due = [st for st in self._stats.values()
+               if st.state == OPEN and now - st.opened_at >= self.cooldown]
+        if not due:
+            return []
+        results = await asyncio.gather(*(self._timed_probe(st.url) for st in due))
+        recovered = []
+        for st, (ok, latency) in zip(due, results):
+            if ok:
+                st.reset()
+                st.record(True, latency, alpha=1.0)
+                recovered.append(st.url)
+                logger.info("Прокси %s снова в ротации (%.1fs)", st.url, latency)
+            else:
+                st.opened_at = time.monotonic()
+        return recovered
+
+    # ─────────── selection / feedback ───────────
+    def _open(self, st: ProxyStats) -> None:
+        if st.state != OPEN:
+            logger.warning("Прокси %s выведен из ротации (ошибок подряд: %d)", st.url, st.consecutive_failures)
+        st.state = OPEN
+        st.opened_at = time.monotonic()
+
+    def _weight(self, st: ProxyStats) -> float:
+        latency = st.latency if st.latency is not None else 1.0
+        return max(st.success_rate, self.min_success_rate) / max(latency, 0.1)
+
+    def acquire(self) -> Optional[str]:
+        """
+        Возвращает прокси для следующего запроса. Если все цепи разомкнуты,
+        отдаёт тот, что разомкнулся раньше всех, чтобы цикл не вставал.
+        """
+        closed = [st for st in self._stats.values() if st.state == CLOSED]
+        if closed:
+            weights = [self._weight(st) for st in closed]
+            return random.choices(closed, weights=weights, k=1)[0].url
+        if not self._stats:
+            return None
+        return min(self._stats.values(), key=lambda st: st.opened_at).url
+
+    def report(self, proxy: str, ok: bool, latency: Optional[float] = None) -> None:
+        """Сообщает результат реального запроса через прокси."""
+        st = self._stats.get(proxy)
+        if st is None:
+            return
+        st.record(ok, latency, self.latency_alpha)
+        if not ok and st.consecutive_failures >= self.failure_threshold:
+            self._open(st)
+
+    @property
+    def healthy(self) -> List[str]:
+        return [p for p, st in self._stats.items() if st.state == CLOSED]
+
+    def snapshot(self) -> List[dict]:
+        return [
+            {
+                "proxy": st.url,
+                "state": st.state,
+                "success_rate": round(st.success_rate, 3),
+                "latency": round(st.latency, 2) if st.latency is not None else None,
+                "consecutive_failures": st.consecutive_failures,
+            }
+            for st in self._stats.values()
+        ]
@@ -1,19 +1,55 @@
 # services/queue_service.py
 
-import redis
-import config
+from services.redis_pool import get_redis
+from services.task_eta import TaskEtaModel, format_eta
+from services.task_routing import PRIORITY_DEFAULT, QUEUE_SELENIUM, QUEUE_SLOTS, lanes_ahead
 
-def get_queue_length(queue_name='celery') -> int:
+def get_queue_length(queue_name=QUEUE_SELENIUM, priority=PRIORITY_DEFAULT) -> int:
     """
-    Подключается к Redis и возвращает текущую длину очереди Celery.
+    Подключается к Redis и возвращает кол-во задач очереди Celery, которые
+    будут взяты раньше задачи с приоритетом priority (все полосы с номером ≤ priority).
     """
     try:
-        # Создаем подключение к Redis, используя URL из нашего конфига
-        r = redis.from_url(config.REDIS_URL)
+        # Клиент на общем пуле соединений (services/redis_pool.py)
+        r = get_redis()
 
-        # Команда LLEN возвращает длину списка (нашей очереди)
-        length = r.llen(queue_name)
-        return length
+        # LLEN по каждой полосе очереди (services/task_routing.py)
+        pipe = r.pipeline()
+        for _, key in lanes_ahead(queue_name, priority):
+            pipe.llen(key)
+        return sum(pipe.execute())
     except Exception as e:
         print(f"ERROR: Не удалось подключиться к Redis или получить длину очереди: {e}")
-        return 0 # В случае ошибки возвращаем 0
\ No newline at end of file
+        return 0 # В случае ошибки возвращаем 0
+
+
+def get_queue_position(queue_name=QUEUE_SELENIUM, priority=PRIORITY_DEFAULT) -> int:
+    """Место новой задачи в её полосе: премиум-задачи обгоняют обычные."""
+    return get_queue_length(queue_name, priority) + 1
+
+
+def get_queue_eta(task_name, size=1, queue_name=QUEUE_SELENIUM, priority=PRIORITY_DEFAULT):
+    """
+    Место в очереди и ожидаемое время по истории длительностей (services/task_eta.py):
+    {"position", "wait_sec", "total_sec", "total_p90_sec"}. При ошибке Redis — None.
+    """
+    try:
+        return TaskEtaModel(get_redis()).queue_eta(
+            task_name, size, priority=priority, slots=QUEUE_SLOTS.get(queue_name, 1), queue=queue_name,
+        )
+    except Exception as e:
+        print(f"ERROR: Не удалось оценить время ожидания очереди: {e}")
+        return None
+
+
+def format_queue_eta(eta, lang="ru") -> str:
+    """Строка «место + ожидание» для сообщения пользователю."""
+    if not eta:
+        return ""
+    if lang == "ru":
+        return (f"Вы {eta['position']}-й в очереди. Старт через {format_eta(eta['wait_sec'])}, "
+                f"результат ориентировочно через {format_eta(eta['total_sec'])} "
+                f"(не позже {format_eta(eta['total_p90_sec'])}).")
+    return (f"You are #{eta['position']} in the queue. Starts in {format_eta(eta['wait_sec'], lang)}, "
+            f"result expected in {format_eta(eta['total_sec'], lang)} "
+            f"(at most {format_eta(eta['total_p90_sec'], lang)}).")
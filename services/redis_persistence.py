@@ -0,0 +1,206 @@
+# services/redis_persistence.py
+"""
+Хранение context.user_data / chat_data / bot_data / диалогов PTB в Redis.
+
+    application = Application.builder().token(...).persistence(RedisPersistence("bot")).build()
+
+Ключи (namespace — имя бота, у bot и bot_lite свои данные):
+    ptb:<ns>:user_data   hash  user_id → pickle(user_data)
+    ptb:<ns>:chat_data   hash  chat_id → pickle(chat_data)
+    ptb:<ns>:bot_data    string
+    ptb:<ns>:callback_data string
+    ptb:<ns>:conv:<name> hash  json(key) → pickle(state)
+
+Склейка записей. PTB раз в update_interval (PERSISTENCE_INTERVAL) отдаёт
+изменённые объекты по одному вызову update_*. Здесь они:
+    • сравниваются с последним записанным значением — неизменные не пишутся;
+    • копятся в буфере и уходят одним pipeline на весь проход PTB.
+flush() (остановка приложения) дописывает буфер синхронно, поэтому
+штатный рестарт ничего не теряет; при падении теряется не больше
+PERSISTENCE_INTERVAL секунд изменений.
+
+Данные читаются из Redis один раз при старте (так устроен PTB), поэтому
+несколько реплик корректны, только если апдейты одного пользователя
+всегда попадают в одну реплику — см. services/update_queue.py.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import pickle
+from typing import Any, Dict, Optional, Tuple
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from services.redis_pool import get_async_redis
+
+logger = logging.getLogger(__name__)
+
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", 5))
+KEY_PREFIX = "ptb:"
+
+_STRING = ""   # поле-маркер для строковых ключей (bot_data, callback_data)
+
+
+class RedisPersistence(BasePersistence):
+    def __init__(self, namespace: str, *, store_data: Optional[PersistenceInput] = None,
+                 update_interval: float = PERSISTENCE_INTERVAL):
+        super().__init__(store_data=store_data, update_interval=update_interval)
+        self.namespace = namespace
+        self._written: Dict[Tuple[str, str], bytes] = {}
+        self._pending: Dict[Tuple[str, str], Optional[bytes]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+
+    # ─────────── ключи ───────────
+    def _key(self, name: str) -> str:
+        return f"{KEY_PREFIX}{self.namespace}:{name}"
+
+    @property
+    def _redis(self):
+        redis = get_async_redis()
+        if redis is None:
+            raise RuntimeError("RedisPersistence требует REDIS_URL")
+        return redis
+
+    async def _load_hash(self, name: str) -> Dict[int, Any]:
+        raw = await self._redis.hgetall(self._key(name))
+        data = {}
+        for field, blob in raw.items():
+            field = field.decode() if isinstance(field, bytes) else field
+            try:
+                data[int(field)] = pickle.loads(blob)
+            except Exception as e:
+                logger.warning("PERSISTENCE[%s]: пропущена повреждённая запись %s/%s: %s",
+                               self.namespace, name, field, e)
+                continue
+            self._written[(self._key(name), field)] = blob
+        return data
+
+    async def _load_string(self, name: str) -> Any:
+        blob = await self._redis.get(self._key(name))
+        if blob is None:
+            return None
+        self._written[(self._key(name), _STRING)] = blob
+        return pickle.loads(blob)
+
+    # ─────────── склейка записей ───────────
+    def _stage(self, key: str, field: str, value: Any) -> None:
+        try:
+            blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            logger.error("PERSISTENCE[%s]: не удалось сериализовать %s/%s: %s", self.namespace, key, field, e)
+            return
+        if self._written.get((key, field)) == blob:
+            return
+        self._pending[(key, field)] = blob
+        self._schedule_flush()
+
+    def _stage_delete(self, key: str, field: str) -> None:
+        self._pending[(key, field)] = None
+        self._schedule_flush()
+
+    def _schedule_flush(self) -> None:
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_soon())
+
+    async def _flush_soon(self) -> None:
+        # PTB зовёт update_* конкурентно (gather) — один такт, и весь проход уйдёт одним pipeline
+        await asyncio.sleep(0)
+        try:
+            await self._write_pending()
+        except Exception as e:
+            logger.error("PERSISTENCE[%s]: запись в Redis не удалась, повторим на следующем проходе: %s",
+                         self.namespace, e)
+
+    async def _write_pending(self) -> None:
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        pipe = self._redis.pipeline(transaction=False)
+        for (key, field), blob in batch.items():
+            if field == _STRING and blob is None:
+                pipe.delete(key)
+            elif field == _STRING:
+                pipe.set(key, blob)
+            elif blob is None:
+                pipe.hdel(key, field)
+            else:
+                pipe.hset(key, field, blob)
+        try:
+            await pipe.execute()
+        except Exception:
+            # не теряем: вернём в буфер, если поверх ничего нового не легло
+            for item, blob in batch.items():
+                self._pending.setdefault(item, blob)
+            raise
+        for item, blob in batch.items():
+            if blob is None:
+                self._written.pop(item, None)
+            else:
+                self._written[item] = blob
+
+    async def flush(self) -> None:
+        if self._flush_task is not None:
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        await self._write_pending()
+
+    # ─────────── чтение при старте ───────────
+    async def get_user_data(self) -> Dict[int, Any]:
+        return await self._load_hash("user_data")
+
+    async def get_chat_data(self) -> Dict[int, Any]:
+        return await self._load_hash("chat_data")
+
+    async def get_bot_data(self) -> Any:
+        return await self._load_string("bot_data") or {}
+
+    async def get_callback_data(self) -> Optional[Any]:
+        return await self._load_string("callback_data")
+
+    async def get_conversations(self, name: str) -> Dict[Tuple, object]:
+        key = self._key(f"conv:{name}")
+        raw = await self._redis.hgetall(key)
+        conversations = {}
+        for field, blob in raw.items():
+            field = field.decode() if isinstance(field, bytes) else field
+            conversations[tuple(json.loads(field))] = pickle.loads(blob)
+            self._written[(key, field)] = blob
+        return conversations
+
+    # ─────────── запись ───────────
+    async def update_user_data(self, user_id: int, data: Any) -> None:
+        self._stage(self._key("user_data"), str(user_id), data)
+
+    async def update_chat_data(self, chat_id: int, data: Any) -> None:
+        self._stage(self._key("chat_data"), str(chat_id), data)
+
+    async def update_bot_data(self, data: Any) -> None:
+        self._stage(self._key("bot_data"), _STRING, data)
+
+    async def update_callback_data(self, data: Any) -> None:
+        self._stage(self._key("callback_data"), _STRING, data)
+
+    async def update_conversation(self, name: str, key: Tuple, new_state: Optional[object]) -> None:
+        field = json.dumps(list(key))
+        if new_state is None:
+            self._stage_delete(self._key(f"conv:{name}"), field)
+        else:
+            self._stage(self._key(f"conv:{name}"), field, new_state)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._stage_delete(self._key("user_data"), str(user_id))
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._stage_delete(self._key("chat_data"), str(chat_id))
+
+    # Апдейты пользователя обрабатывает одна реплика (update_queue), её копия и так актуальна
+    async def refresh_user_data(self, user_id: int, user_data: Any) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Any) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Any) -> None:
+        pass
@@ -0,0 +1,86 @@
+# services/redis_pool.py
+"""
+Общий пул соединений Redis для бота, воркеров и блокировок.
+
+Вместо `redis.from_url()` на каждый вызов (новое TCP/TLS-подключение к
+облачному Redis) все модули берут клиентов отсюда:
+
+    get_redis()        — sync-клиент на общем ConnectionPool процесса;
+    get_async_redis()  — redis.asyncio-клиент для текущего event loop.
+
+Пулы создаются лениво и живут весь процесс. health_check_interval
+проверяет простаивавшие соединения PING'ом перед использованием, поэтому
+облачный Redis, закрывший их по таймауту, не роняет первый запрос.
+После fork (prefork-воркеры Celery) redis-py сам пересоздаёт
+соединения в дочернем процессе.
+
+Без REDIS_URL обе функции возвращают None — вызывающие модули уже
+умеют работать без Redis.
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+import threading
+import weakref
+from typing import Optional
+
+import redis
+import redis.asyncio as aioredis
+
+import config
+
+HEALTH_CHECK_INTERVAL = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", 30))
+MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 50))
+SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", 60))
+SOCKET_CONNECT_TIMEOUT = float(os.getenv("REDIS_SOCKET_CONNECT_TIMEOUT", 10))
+
+_POOL_KWARGS = dict(
+    health_check_interval=HEALTH_CHECK_INTERVAL,
+    max_connections=MAX_CONNECTIONS,
+    socket_timeout=SOCKET_TIMEOUT,
+    socket_connect_timeout=SOCKET_CONNECT_TIMEOUT,
+    socket_keepalive=True,
+    retry_on_timeout=True,
+)
+
+_lock = threading.Lock()
+_sync_clients: dict = {}
+# асинхронные соединения привязаны к loop'у, в котором созданы
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict]" = weakref.WeakKeyDictionary()
+
+
+def get_redis(url: Optional[str] = None) -> Optional[redis.Redis]:
+    """Sync-клиент на общем пуле процесса (потокобезопасен)."""
+    url = url or config.REDIS_URL
+    if not url:
+        return None
+    client = _sync_clients.get(url)
+    if client is None:
+        with _lock:
+            client = _sync_clients.get(url)
+            if client is None:
+                pool = redis.ConnectionPool.from_url(url, **_POOL_KWARGS)
+                client = _sync_clients[url] = redis.Redis(connection_pool=pool)
+    return client
+
+
+def get_async_redis(url: Optional[str] = None) -> Optional[aioredis.Redis]:
+    """redis.asyncio-клиент на пуле текущего event loop. Соединение открывается при первой команде, не здесь."""
+    url = url or config.REDIS_URL
+    if not url:
+        return None
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    client = clients.get(url)
+    if client is None:
+        pool = aioredis.ConnectionPool.from_url(url, **_POOL_KWARGS)
+        client = clients[url] = aioredis.Redis(connection_pool=pool)
+    return client
+
+
+async def close_async_redis() -> None:
+    """Закрывает пулы текущего loop'а (вызывать при остановке бота/воркера)."""
+    clients = _async_clients.pop(asyncio.get_running_loop(), {})
+    for client in clients.values():
+        await client.close()
+        await client.connection_pool.disconnect()
@@ -0,0 +1,53 @@
+# services/supabase_async.py
+"""
+Асинхронный клиент Supabase (supabase-py AsyncClient / postgrest).
+
+Запросы к БД идут через httpx.AsyncClient внутри postgrest: HTTP/2 и пул
+соединений к Supabase, без прыжков в общий ThreadPoolExecutor, который
+делят со скрейпингом. Клиент создаётся один раз на event loop (httpx
+привязывает соединения к loop'у, в котором они открыты) — в боте это
+один клиент на процесс, в Celery-задачах под async_to_sync — свой на
+каждый временный loop. Такой клиент закрывают `close_client()` до конца
+вызова (tasks/celery_tasks._sync), иначе его пул соединений остаётся открытым.
+
+    client = await get_client()
+    res = await client.table("tokens").select("*").limit(10).execute()
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+import weakref
+
+from supabase import AsyncClient, AsyncClientOptions, acreate_client
+
+from supabase_client import SUPABASE_KEY, SUPABASE_URL
+
+POSTGREST_TIMEOUT = int(os.getenv("SUPABASE_TIMEOUT", 60))
+
+_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncClient]" = weakref.WeakKeyDictionary()
+_locks: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Lock]" = weakref.WeakKeyDictionary()
+
+
+async def get_client() -> AsyncClient:
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is not None:
+        return client
+    lock = _locks.setdefault(loop, asyncio.Lock())
+    async with lock:
+        client = _clients.get(loop)
+        if client is None:
+            client = await acreate_client(
+                SUPABASE_URL, SUPABASE_KEY,
+                options=AsyncClientOptions(postgrest_client_timeout=POSTGREST_TIMEOUT),
+            )
+            _clients[loop] = client
+    return client
+
+
+async def close_client() -> None:
+    """Закрывает HTTP-сессию клиента текущего loop'а (при остановке процесса)."""
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.postgrest.aclose()
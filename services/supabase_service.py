@@ -4,37 +4,91 @@
 Этот файл инкапсулирует все прямые запросы к базе данных.
 Все функции здесь асинхронны и возвращают данные в виде
 простых Python-объектов (списки, словари), не содержат
-логики Telegram-бота.
+логики Telegram-бота. Запросы идут через нативный async-клиент
+(services/supabase_async.py), без run_in_executor.
 """
 
-import asyncio
 from typing import List, Dict, Any, Optional
-from datetime import datetime
+from datetime import datetime, timezone, timedelta
 
-from supabase_client import supabase
+import pandas as pd
+
+from services import user_cache
+from services.supabase_async import get_client
+# --- Доступ и премиум ---
+
+async def get_access_code(code: str) -> Optional[Dict[str, Any]]:
+    """Строка access_codes по коду либо None."""
+    client = await get_client()
+    res = await client.table("access_codes").select("*").eq("code", code).limit(1).execute()
+    return res.data[0] if res.data else None
+
+async def activate_access_code(code: str, tg_id: int) -> None:
+    """Помечает код использованным и выдаёт пользователю премиум."""
+    client = await get_client()
+    await client.table("access_codes").update({
+        "used": True,
+        "used_by": tg_id,
+        "used_at": datetime.now(timezone.utc).isoformat(),
+    }).eq("code", code).execute()
+    await client.table("users").upsert({"id": tg_id, "is_premium": True}, on_conflict="id").execute()
+    await user_cache.invalidate(user_cache.PREMIUM, tg_id)
+
+async def user_is_premium(tg_id: int) -> bool:
+    """
+    Флаг users.is_premium; если строки нет — премиум по использованному
+    коду в access_codes (как services/db_access.user_is_premium).
+    Результат кэшируется (services/user_cache), сбрасывается при активации кода.
+    """
+    return await user_cache.cached(user_cache.PREMIUM, tg_id, lambda: _load_user_is_premium(tg_id))
+
+async def _load_user_is_premium(tg_id: int) -> bool:
+    client = await get_client()
+    try:
+        res = await client.table("users").select("is_premium").eq("id", tg_id).limit(1).execute()
+        if res.data:
+            return bool(res.data[0].get("is_premium"))
+    except Exception as e:
+        print(f"DB_ERROR: users lookup failed for {tg_id}: {e}")
+
+    alt = await (
+        client.table("access_codes")
+              .select("used")
+              .eq("used_by", tg_id)
+              .eq("used", True)
+              .limit(1)
+              .execute()
+    )
+    return bool(alt.data)
 
-def get_table(table_name):
-    return supabase.table(table_name)
 # --- Функции для работы с Шаблонами (Templates) ---
 
 async def fetch_user_templates(user_id: int) -> List[Dict[str, Any]]:
-    """Получает все шаблоны парсинга для указанного пользователя."""
+    """Получает все шаблоны парсинга для указанного пользователя (через кэш)."""
     try:
-        response = await asyncio.get_event_loop().run_in_executor(
-            None, lambda: supabase.table("parse_templates").select("*").eq("user_id", user_id).execute()
-        )
-        return response.data or []
+        return await user_cache.cached(user_cache.TEMPLATES, user_id, lambda: _load_user_templates(user_id))
     except Exception as e:
         print(f"DB_ERROR: fetch_user_templates failed for user {user_id}: {e}")
         return []
 
+async def _load_user_templates(user_id: int) -> List[Dict[str, Any]]:
+    client = await get_client()
+    response = await client.table("parse_templates").select("*").eq("user_id", user_id).execute()
+    return response.data or []
+
+async def _invalidate_templates(*rows: Optional[Dict[str, Any]]) -> None:
+    for user_id in {row.get("user_id") for row in rows if row}:
+        if user_id is not None:
+            await user_cache.invalidate(user_cache.TEMPLATES, user_id)
+
 async def create_template(template_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
     """Создает новый шаблон в базе данных."""
     try:
-        response = await asyncio.get_event_loop().run_in_executor(
-            None, lambda: supabase.table("parse_templates").insert(template_data).execute()
-        )
-        return response.data[0] if response.data else None
+        client = await get_client()
+        response = await client.table("parse_templates").insert(template_data).execute()
+        row = response.data[0] if response.data else None
+        await _invalidate_templates(template_data, row)
+        return row
     except Exception as e:
         print(f"DB_ERROR: create_template failed: {e}")
         return None
@@ -42,20 +96,21 @@ async def create_template(template_data: Dict[str, Any]) -> Optional[Dict[str, A
 async def update_template(template_id: str, updates: Dict[str, Any]) -> Optional[Dict[str, Any]]:
     """Обновляет существующий шаблон по его ID."""
     try:
-        response = await asyncio.get_event_loop().run_in_executor(
-            None, lambda: supabase.table("parse_templates").update(updates).eq("id", template_id).execute()
-        )
-        return response.data[0] if response.data else None
+        client = await get_client()
+        response = await client.table("parse_templates").update(updates).eq("id", template_id).execute()
+        row = response.data[0] if response.data else None
+        await _invalidate_templates(updates, row)
+        return row
     except Exception as e:
         print(f"DB_ERROR: update_template failed for id {template_id}: {e}")
         return None
 
-async def delete_template(template_id: str) -> bool:
+async def delete_template(template_id: str, user_id: Optional[int] = None) -> bool:
     """Удаляет шаблон по его ID."""
     try:
-        await asyncio.get_event_loop().run_in_executor(
-            None, lambda: supabase.table("parse_templates").delete().eq("id", template_id).execute()
-        )
+        client = await get_client()
+        response = await client.table("parse_templates").delete().eq("id", template_id).execute()
+        await _invalidate_templates({"user_id": user_id}, *(response.data or []))
         return True
     except Exception as e:
         print(f"DB_ERROR: delete_template failed for id {template_id}: {e}")
@@ -64,14 +119,29 @@ async def delete_template(template_id: str) -> bool:
 # --- Функции для работы с Токенами ---
 
 async def fetch_unique_launchpads() -> List[str]:
-    """Получает список всех уникальных лаунчпадов из таблицы токенов."""
+    """
+    Уникальные лаунчпады из таблицы токенов (без 'unknown').
+
+    Считает SQL-функция на стороне БД — по сети идут только сами значения:
+
+        create or replace function get_distinct_launchpads()
+        returns table (launchpad text) language sql stable as $$
+            select distinct launchpad from tokens
+            where launchpad is not null and launchpad <> 'unknown'
+        $$;
+
+    Вызывающим нужен кэш services/launchpad_cache, а не эта функция напрямую.
+    """
     try:
-        response = await asyncio.get_event_loop().run_in_executor(
-            None, lambda: supabase.table("tokens").select("launchpad", count='exact').execute()
-        )
-        if response.data:
-            return sorted(list(set(item['launchpad'] for item in response.data if item['launchpad'] and item['launchpad'] != 'unknown')))
-        return []
+        client = await get_client()
+        try:
+            response = await client.rpc('get_distinct_launchpads', {}).execute()
+        except Exception as e:
+            # функция ещё не создана в БД — старый путь через таблицу
+            print(f"DB_WARN: get_distinct_launchpads RPC unavailable, scanning tokens: {e}")
+            response = await client.table("tokens").select("launchpad").execute()
+        return sorted({item['launchpad'] for item in response.data or []
+                       if item.get('launchpad') and item['launchpad'] != 'unknown'})
     except Exception as e:
         print(f"DB_ERROR: fetch_unique_launchpads failed: {e}")
         return []
@@ -79,7 +149,8 @@ async def fetch_unique_launchpads() -> List[str]:
 async def fetch_tokens_by_criteria(start_time: datetime, platforms: List[str], categories: List[str]) -> List[Dict[str, Any]]:
     """Выполняет поиск токенов по заданным критериям времени, платформы и категории."""
     try:
-        query = supabase.table("tokens").select("contract_address, ticker, name, migration_time, launchpad, category")
+        client = await get_client()
+        query = client.table("tokens").select("contract_address, ticker, name, migration_time, launchpad, category")
         query = query.gte("migration_time", start_time.isoformat())
 
         if platforms:
@@ -87,9 +158,7 @@ async def fetch_tokens_by_criteria(start_time: datetime, platforms: List[str], c
         if categories:
             query = query.in_("category", categories)
 
-        response = await asyncio.get_event_loop().run_in_executor(
-            None, lambda: query.range(0, 10000).execute()
-        )
+        response = await query.range(0, 10000).execute()
         return response.data or []
     except Exception as e:
         print(f"DB_ERROR: fetch_tokens_by_criteria failed: {e}")
@@ -102,15 +171,13 @@ async def fetch_dev_stats_by_criteria(start_time: datetime, platforms: list, cat
     Вызывает SQL-функцию в Supabase для получения отфильтрованной статистики по разработчикам.
     """
     try:
+        client = await get_client()
         params = {
             'start_time_filter': start_time.isoformat(),
             'platforms_filter': platforms or None,
             'categories_filter': categories or None
         }
-        response = await asyncio.get_event_loop().run_in_executor(
-            None,
-            lambda: supabase.rpc('get_filtered_dev_stats_v2', params).execute()
-        )
+        response = await client.rpc('get_filtered_dev_stats_v2', params).execute()
         return response.data or []
     except Exception as e:
         print(f"DB_ERROR: fetch_dev_stats_by_criteria failed: {e}")
@@ -119,9 +186,8 @@ async def fetch_dev_stats_by_criteria(start_time: datetime, platforms: list, cat
 async def get_developer_stats(address: str) -> Optional[Dict[str, Any]]:
     """Получает статистику разработчика по адресу кошелька."""
     try:
-        response = await asyncio.get_event_loop().run_in_executor(
-            None, lambda: supabase.table("developer_stats").select("*").eq("developer_address", address).limit(1).execute()
-        )
+        client = await get_client()
+        response = await client.table("developer_stats").select("*").eq("developer_address", address).limit(1).execute()
         return response.data[0] if response.data else None
     except Exception as e:
         print(f"DB_ERROR: get_developer_stats for {address} failed: {e}")
@@ -130,9 +196,8 @@ async def get_developer_stats(address: str) -> Optional[Dict[str, Any]]:
 async def get_trader_stats(address: str) -> Optional[Dict[str, Any]]:
     """Получает статистику трейдера по адресу кошелька."""
     try:
-        response = await asyncio.get_event_loop().run_in_executor(
-            None, lambda: supabase.table("trader_stats").select("*").eq("trader_address", address).limit(1).execute()
-        )
+        client = await get_client()
+        response = await client.table("trader_stats").select("*").eq("trader_address", address).limit(1).execute()
         return response.data[0] if response.data else None
     except Exception as e:
         print(f"DB_ERROR: get_trader_stats for {address} failed: {e}")
@@ -143,10 +208,11 @@ async def get_trader_stats(address: str) -> Optional[Dict[str, Any]]:
 async def get_user_bundle_alerts(user_id: int) -> List[Dict[str, Any]]:
     """Получает все активные трекеры бандлов для пользователя."""
     try:
-        response = await asyncio.get_event_loop().run_in_executor(
-            None, lambda: supabase.table("address_alerts")
-                              .select("address_to_track, time_gap_min, min_cnt, amount_step, min_transfer_amount, max_transfer_amount, custom_name")
-                              .eq("user_id", user_id).eq("is_active", True).execute()
+        client = await get_client()
+        response = await (
+            client.table("address_alerts")
+            .select("address_to_track, time_gap_min, min_cnt, amount_step, min_transfer_amount, max_transfer_amount, custom_name")
+            .eq("user_id", user_id).eq("is_active", True).execute()
         )
         return response.data or []
     except Exception as e:
@@ -156,9 +222,8 @@ async def get_user_bundle_alerts(user_id: int) -> List[Dict[str, Any]]:
 async def count_user_bundle_alerts(user_id: int) -> int:
     """Считает количество активных трекеров у пользователя."""
     try:
-        response = await asyncio.get_event_loop().run_in_executor(
-            None, lambda: supabase.table("address_alerts").select('id', count='exact').eq('user_id', user_id).eq('is_active', True).execute()
-        )
+        client = await get_client()
+        response = await client.table("address_alerts").select('id', count='exact').eq('user_id', user_id).eq('is_active', True).execute()
         return response.count
     except Exception as e:
         print(f"DB_ERROR: count_user_bundle_alerts for user {user_id} failed: {e}")
@@ -167,9 +232,8 @@ async def count_user_bundle_alerts(user_id: int) -> int:
 async def upsert_bundle_alert(alert_data: Dict[str, Any]) -> bool:
     """Создает или обновляет трекер бандлов."""
     try:
-        await asyncio.get_event_loop().run_in_executor(
-            None, lambda: supabase.table("address_alerts").upsert(alert_data, on_conflict='user_id,address_to_track').execute()
-        )
+        client = await get_client()
+        await client.table("address_alerts").upsert(alert_data, on_conflict='user_id,address_to_track').execute()
         return True
     except Exception as e:
         print(f"DB_ERROR: upsert_bundle_alert failed: {e}")
@@ -178,9 +242,8 @@ async def upsert_bundle_alert(alert_data: Dict[str, Any]) -> bool:
 async def delete_bundle_alert(user_id: int, address_to_delete: str) -> bool:
     """Удаляет трекер бандлов для пользователя по адресу."""
     try:
-        await asyncio.get_event_loop().run_in_executor(
-            None, lambda: supabase.table("address_alerts").delete().match({'address_to_track': address_to_delete, 'user_id': user_id}).execute()
-        )
+        client = await get_client()
+        await client.table("address_alerts").delete().match({'address_to_track': address_to_delete, 'user_id': user_id}).execute()
         return True
     except Exception as e:
         print(f"DB_ERROR: delete_bundle_alert failed for user {user_id}: {e}")
@@ -199,24 +262,16 @@ async def fetch_deployed_tokens_for_devs(
     if not developer_addresses:
         return []
     try:
+        client = await get_client()
         # Разбиваем на пачки, чтобы не превысить лимит длины URL
         all_tokens = []
         batch_size = 300 
         for i in range(0, len(developer_addresses), batch_size):
             batch = developer_addresses[i:i + batch_size]
-            response = await asyncio.get_event_loop().run_in_executor(
-                None,
-                lambda b=batch, st=start_time: (
-                    supabase.table("dev_deployed_tokens")
-                            .select("*")
-                            .in_("developer_address", b)
-                            .gte("token_launch_time", st.isoformat())  # фильтр по времени
-                            if st else
-                    supabase.table("dev_deployed_tokens")
-                            .select("*")
-                            .in_("developer_address", b)
-                ).execute()
-            )
+            query = client.table("dev_deployed_tokens").select("*").in_("developer_address", batch)
+            if start_time:
+                query = query.gte("token_launch_time", start_time.isoformat())  # фильтр по времени
+            response = await query.execute()
             if response.data:
                 all_tokens.extend(response.data)
         return all_tokens
@@ -228,8 +283,9 @@ async def get_latest_pnl_for_traders(traders: list, max_age_hours: int = 24):
     if not traders:
         return []
     try:
+        client = await get_client()
         start_time = datetime.now(timezone.utc) - timedelta(hours=max_age_hours)
-        response = supabase.table("pnl_batches").select("*").in_("wallet", traders).gte("batch_created_at", start_time.isoformat()).execute()
+        response = await client.table("pnl_batches").select("*").in_("wallet", traders).gte("batch_created_at", start_time.isoformat()).execute()
         if not response.data:
             return []
         df = pd.DataFrame(response.data)
@@ -241,7 +297,8 @@ async def get_latest_pnl_for_traders(traders: list, max_age_hours: int = 24):
     
 async def get_pnl_for_period(start_time: datetime):
     try:
-        response = supabase.table("pnl_batches").select("*").gte("batch_created_at", start_time.isoformat()).execute()
+        client = await get_client()
+        response = await client.table("pnl_batches").select("*").gte("batch_created_at", start_time.isoformat()).execute()
         return response.data or []
     except Exception as e:
         print(f"Error fetching PNL for period: {e}")
@@ -250,9 +307,8 @@ async def get_pnl_for_period(start_time: datetime):
 async def fetch_pnl_batches_for_period(start_time: datetime) -> List[Dict[str, Any]]:
     """Получает все строки pnl_batches за период (batch_created_at >= start_time), берет свежие по wallet."""
     try:
-        response = await asyncio.get_event_loop().run_in_executor(
-            None, lambda: supabase.table("pnl_batches").select("*").gte("batch_created_at", start_time.isoformat()).execute()
-        )
+        client = await get_client()
+        response = await client.table("pnl_batches").select("*").gte("batch_created_at", start_time.isoformat()).execute()
         if not response.data:
             return []
         
@@ -262,4 +318,10 @@ async def fetch_pnl_batches_for_period(start_time: datetime) -> List[Dict[str, A
         return latest_df.to_dict(orient='records')
     except Exception as e:
         print(f"DB_ERROR: fetch_pnl_batches_for_period failed: {e}")
-        return []
\ No newline at end of file
+        return []
+
+
+async def insert_pnl_batch(rows: List[Dict[str, Any]]) -> None:
+    """Запись строк периодического прогона All-In Parse в pnl_batches (ошибка пробрасывается)."""
+    client = await get_client()
+    await client.table("pnl_batches").insert(rows).execute()
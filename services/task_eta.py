@@ -0,0 +1,254 @@
+# services/task_eta.py
+"""
+Оценка времени ожидания задач Celery по истории их длительностей.
+
+• Каждая завершённая задача пишет (размер входа → секунды) в Redis: список
+  `task_eta:samples:<task>:<bucket>`, где bucket — логарифмическая корзина
+  размера входа (кол-во кошельков / токенов). Хранятся последние N замеров,
+  из них считаются скользящие квантили (p50 — оценка, p90 — «не дольше»).
+• Выполняющиеся задачи регистрируются в hash `task_eta:active` (время
+  старта, тип, размер, очередь), чтобы учесть уже занятые воркеры.
+  Записи, пережившие p90 × ACTIVE_STALE_FACTOR (воркер убит до
+  task_postrun), отбрасываются и удаляются при расчёте ETA.
+• `queue_eta()` читает задачи, стоящие впереди в полосах очереди
+  (services/task_routing.py), и раскладывает их по слотам воркеров:
+  ожидание = момент освобождения слота под нашу задачу.
+
+Сигналы Celery подключаются в celery_app через `connect_signals()`.
+"""
+from __future__ import annotations
+
+import base64
+import bisect
+import heapq
+import json
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from services.payload_store import ref_size
+from services.task_routing import QUEUE_SELENIUM, TASK_ROUTES, lanes_ahead
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "task_eta:"
+ACTIVE_KEY = KEY_PREFIX + "active"
+SAMPLES_PER_BUCKET = 200
+SCAN_LIMIT = 500                      # сколько задач очереди разбирать для ETA
+SIZE_BUCKETS = [1, 100, 1_000, 5_000, 20_000, 40_000]
+
+_TASKS = "tasks.celery_tasks."
+# Весь DAG 'All-In Parse' пользователя целиком: пишется из tasks.celery_tasks._complete
+ALL_IN_PIPELINE = "all_in_parse"
+# Оценка «с нуля», пока нет истории (секунды)
+DEFAULT_DURATIONS: Dict[str, float] = {
+    _TASKS + "run_pnl_fetch_task": 300,
+    _TASKS + "run_traders_fetch_task": 400,
+    _TASKS + "run_swaps_fetch_task": 300,
+    _TASKS + "all_in_top_traders_chunk": 400,
+    _TASKS + "all_in_pnl_chunk": 300,
+    ALL_IN_PIPELINE: 3600,
+}
+FALLBACK_DURATION = 60.0
+# Запись task_eta:active снимается в task_postrun; у убитого воркера (SIGKILL/OOM,
+# обрыв связи) этого не происходит. Запись старше p90 × фактор (но не моложе
+# минимума) считается брошенной: она не занимает слот и удаляется из hash.
+ACTIVE_STALE_FACTOR = float(os.getenv("ETA_ACTIVE_STALE_FACTOR", 3))
+ACTIVE_STALE_MIN = float(os.getenv("ETA_ACTIVE_STALE_MIN", 600))
+
+
+def _count(value) -> int:
+    """Размер списка или ссылки payload store ("<кол-во>:<sha256>")."""
+    if isinstance(value, str):
+        return ref_size(value)
+    return len(value or [])
+
+
+# Размер входа по аргументам задачи
+SIZE_EXTRACTORS: Dict[str, Callable[[tuple, dict], int]] = {
+    _TASKS + "run_pnl_fetch_task": lambda a, kw: _count(kw.get("wallets_ref")),
+    _TASKS + "run_traders_fetch_task": lambda a, kw: _count(kw.get("addresses_ref")),
+    _TASKS + "all_in_top_traders_chunk": lambda a, kw: _count(a[2]) if len(a) > 2 else 1,
+    _TASKS + "all_in_pnl_chunk": lambda a, kw: _count(a[2]) if len(a) > 2 else 1,
+}
+
+
+def task_size(task: str, args: Iterable = (), kwargs: Optional[dict] = None) -> int:
+    extractor = SIZE_EXTRACTORS.get(task)
+    if extractor is None:
+        return 1
+    try:
+        return max(1, int(extractor(tuple(args or ()), kwargs or {})))
+    except Exception:
+        return 1
+
+
+def size_bucket(size: int) -> int:
+    return SIZE_BUCKETS[max(0, bisect.bisect_right(SIZE_BUCKETS, size) - 1)]
+
+
+def _decode(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def _parse_message(raw) -> Optional[Tuple[str, int]]:
+    """kombu-сообщение из Redis-списка → (имя задачи, размер входа)."""
+    try:
+        msg = json.loads(_decode(raw))
+        task = msg["headers"]["task"]
+        body = msg.get("body")
+        if msg.get("properties", {}).get("body_encoding") == "base64":
+            body = base64.b64decode(body)
+        args, kwargs, _ = json.loads(_decode(body))
+        return task, task_size(task, args, kwargs)
+    except Exception:
+        return None
+
+
+class TaskEtaModel:
+    def __init__(self, redis_client, *, samples: int = SAMPLES_PER_BUCKET):
+        self.redis = redis_client
+        self.samples = samples
+
+    def _samples_key(self, task: str, bucket: int) -> str:
+        return f"{KEY_PREFIX}samples:{task}:{bucket}"
+
+    # ─────────── сбор истории ───────────
+    def record(self, task: str, size: int, seconds: float) -> None:
+        key = self._samples_key(task, size_bucket(size))
+        pipe = self.redis.pipeline()
+        pipe.lpush(key, json.dumps([size, round(seconds, 2)]))
+        pipe.ltrim(key, 0, self.samples - 1)
+        pipe.execute()
+
+    def mark_started(self, task_id: str, task: str, size: int) -> None:
+        queue = TASK_ROUTES.get(task, {}).get("queue")
+        self.redis.hset(ACTIVE_KEY, task_id, json.dumps(
+            {"task": task, "size": size, "queue": queue, "started": time.time()}
+        ))
+
+    def mark_finished(self, task_id: str, ok: bool = True) -> None:
+        raw = self.redis.hget(ACTIVE_KEY, task_id)
+        self.redis.hdel(ACTIVE_KEY, task_id)
+        if raw is None or not ok:
+            return
+        info = json.loads(_decode(raw))
+        self.record(info["task"], info["size"], time.time() - info["started"])
+
+    # ─────────── оценки ───────────
+    def _bucket_samples(self, task: str, bucket: int) -> np.ndarray:
+        raw = self.redis.lrange(self._samples_key(task, bucket), 0, -1)
+        return np.array([json.loads(_decode(r)) for r in raw], dtype=float).reshape(-1, 2)
+
+    def estimate(self, task: str, size: int, q: float = 0.5) -> float:
+        """
+        Квантиль q длительности для задачи этого размера. Если в корзине
+        пусто — ближайшая корзина с историей, масштабированная по размеру
+        (секунды на элемент), иначе DEFAULT_DURATIONS.
+        """
+        bucket = size_bucket(size)
+        data = self._bucket_samples(task, bucket)
+        if len(data):
+            return float(np.quantile(data[:, 1], q))
+        idx = SIZE_BUCKETS.index(bucket)
+        for other in sorted(SIZE_BUCKETS, key=lambda b: abs(SIZE_BUCKETS.index(b) - idx)):
+            data = self._bucket_samples(task, other)
+            if len(data):
+                per_item = np.quantile(data[:, 1] / np.maximum(data[:, 0], 1), q)
+                return float(per_item * size)
+        return DEFAULT_DURATIONS.get(task, FALLBACK_DURATION)
+
+    def _is_stale(self, info: Dict[str, Any], elapsed: float) -> bool:
+        limit = self.estimate(info["task"], info["size"], q=0.9) * ACTIVE_STALE_FACTOR
+        return elapsed > max(limit, ACTIVE_STALE_MIN)
+
+    def _active_remaining(self, queue: str) -> List[float]:
+        now = time.time()
+        remaining, stale = [], []
+        for task_id, raw in (self.redis.hgetall(ACTIVE_KEY) or {}).items():
+            try:
+                info = json.loads(_decode(raw))
+                elapsed = now - info["started"]
+                if self._is_stale(info, elapsed):
+                    stale.append(task_id)
+                    continue
+            except (ValueError, KeyError, TypeError):
+                stale.append(task_id)
+                continue
+            if info.get("queue") != queue:
+                continue
+            remaining.append(max(0.0, self.estimate(info["task"], info["size"]) - elapsed))
+        if stale:
+            self.redis.hdel(ACTIVE_KEY, *stale)
+            logger.info("ETA: удалено %d брошенных записей активных задач", len(stale))
+        return remaining
+
+    def _queued_ahead(self, queue: str, priority: int) -> List[Tuple[str, int]]:
+        ahead: List[Tuple[str, int]] = []
+        for _, key in lanes_ahead(queue, priority):
+            # kombu кладёт LPUSH и забирает BRPOP: первым уйдёт правый конец списка
+            raw = self.redis.lrange(key, -SCAN_LIMIT, -1) or []
+            ahead.extend(p for p in map(_parse_message, reversed(raw)) if p)
+        return ahead
+
+    def queue_eta(self, task: str, size: int, *, priority: int, slots: int,
+                  queue: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Место в очереди, ожидание старта и время до результата (секунды).
+        slots — сколько задач очереди выполняется одновременно (concurrency воркеров).
+        """
+        queue = queue or TASK_ROUTES.get(task, {}).get("queue", QUEUE_SELENIUM)
+        ahead = self._queued_ahead(queue, priority)
+        active = sorted(self._active_remaining(queue))
+        slots = max(slots, len(active), 1)
+
+        free_at = active + [0.0] * (slots - len(active))
+        heapq.heapify(free_at)
+        cache: Dict[Tuple[str, int], float] = {}
+        for name, n in ahead:
+            key = (name, size_bucket(n))
+            if key not in cache:
+                cache[key] = self.estimate(name, n)
+            heapq.heappush(free_at, heapq.heappop(free_at) + cache[key])
+        wait = free_at[0]
+        own = self.estimate(task, size)
+        return {
+            "position": len(ahead) + 1,
+            "wait_sec": wait,
+            "total_sec": wait + own,
+            "total_p90_sec": wait + self.estimate(task, size, q=0.9),
+        }
+
+
+def format_eta(seconds: float, lang: str = "ru") -> str:
+    minutes = int(round(seconds / 60))
+    m, h = ("мин", "ч") if lang == "ru" else ("min", "h")
+    if minutes < 1:
+        return f"< 1 {m}"
+    if minutes < 60:
+        return f"~{minutes} {m}"
+    return f"~{minutes // 60} {h} {minutes % 60:02d} {m}"
+
+
+def connect_signals(redis_client) -> None:
+    """Запись длительностей и активных задач через сигналы Celery."""
+    from celery.signals import task_postrun, task_prerun
+
+    model = TaskEtaModel(redis_client)
+
+    @task_prerun.connect(weak=False)
+    def _on_prerun(task_id=None, task=None, args=None, kwargs=None, **_):
+        try:
+            model.mark_started(task_id, task.name, task_size(task.name, args, kwargs))
+        except Exception as exc:
+            logger.debug("ETA: prerun %s: %s", task_id, exc)
+
+    @task_postrun.connect(weak=False)
+    def _on_postrun(task_id=None, task=None, state=None, **_):
+        try:
+            model.mark_finished(task_id, ok=state == "SUCCESS")
+        except Exception as exc:
+            logger.debug("ETA: postrun %s: %s", task_id, exc)
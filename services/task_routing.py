@@ -0,0 +1,75 @@
+# services/task_routing.py
+"""
+Очереди Celery и приоритетные полосы.
+
+Задачи разведены по трём очередям, каждую обслуживают свои воркеры со своей
+concurrency:
+    selenium_heavy — всё, что поднимает Chrome/Discord (PNL, топ-трейдеры, свопы);
+    api_light      — быстрые задачи на API/БД и оркестрация DAG All-In Parse;
+    periodic       — фоновые периодические прогоны.
+
+Внутри очереди работают приоритеты Redis-брокера (`priority_steps`): у
+каждой очереди несколько списков-полос, воркер забирает из полосы с
+меньшим номером первой. Премиум-пользователи идут в PRIORITY_PREMIUM,
+остальные — в PRIORITY_DEFAULT, периодические прогоны — в PRIORITY_BACKGROUND.
+
+Запуск воркеров:
+    celery -A celery_app worker -Q selenium_heavy -c 2 -n selenium@%h
+    celery -A celery_app worker -Q api_light -c 8 -n api@%h
+    celery -A celery_app worker -Q periodic -c 1 -n periodic@%h
+"""
+from __future__ import annotations
+
+import os
+from typing import Dict, List, Tuple
+
+QUEUE_SELENIUM = "selenium_heavy"
+QUEUE_API = "api_light"
+QUEUE_PERIODIC = "periodic"
+QUEUES = (QUEUE_SELENIUM, QUEUE_API, QUEUE_PERIODIC)
+# Сколько задач очередь выполняет одновременно (сумма -c воркеров) — для ETA
+QUEUE_SLOTS: Dict[str, int] = {
+    QUEUE_SELENIUM: int(os.getenv("SELENIUM_WORKER_SLOTS", 2)),
+    QUEUE_API: int(os.getenv("API_WORKER_SLOTS", 8)),
+    QUEUE_PERIODIC: int(os.getenv("PERIODIC_WORKER_SLOTS", 1)),
+}
+
+# Redis-брокер: 0 — самый высокий приоритет
+PRIORITY_PREMIUM = 0
+PRIORITY_DEFAULT = 3
+PRIORITY_BACKGROUND = 6
+PRIORITY_STEPS = [PRIORITY_PREMIUM, PRIORITY_DEFAULT, PRIORITY_BACKGROUND, 9]
+PRIORITY_SEP = "\x06\x16"   # kombu: ключ полосы = "<queue>\x06\x16<priority>"
+
+_TASKS = "tasks.celery_tasks."
+TASK_ROUTES: Dict[str, Dict[str, str]] = {
+    # Selenium / Discord
+    _TASKS + "run_pnl_fetch_task": {"queue": QUEUE_SELENIUM},
+    _TASKS + "run_traders_fetch_task": {"queue": QUEUE_SELENIUM},
+    _TASKS + "run_swaps_fetch_task": {"queue": QUEUE_SELENIUM},
+    _TASKS + "all_in_top_traders_chunk": {"queue": QUEUE_SELENIUM},
+    _TASKS + "all_in_pnl_chunk": {"queue": QUEUE_SELENIUM},
+    # API / оркестрация
+    _TASKS + "run_token_parse_task": {"queue": QUEUE_API},
+    _TASKS + "run_all_in_parse_pipeline_task_wrapper": {"queue": QUEUE_API},
+    _TASKS + "all_in_pnl_stage": {"queue": QUEUE_API},
+    _TASKS + "all_in_finalize": {"queue": QUEUE_API},
+    _TASKS + "all_in_failed": {"queue": QUEUE_API},
+    # Периодика
+    _TASKS + "run_all_in_parse_periodic_task": {"queue": QUEUE_PERIODIC},
+    _TASKS + "all_in_lease_keepalive": {"queue": QUEUE_PERIODIC},
+}
+
+
+def priority_for(premium: bool) -> int:
+    return PRIORITY_PREMIUM if premium else PRIORITY_DEFAULT
+
+
+def lane_key(queue: str, priority: int) -> str:
+    """Redis-ключ списка полосы (полоса 0 хранится в ключе самой очереди)."""
+    return queue if priority == 0 else f"{queue}{PRIORITY_SEP}{priority}"
+
+
+def lanes_ahead(queue: str, priority: int) -> List[Tuple[int, str]]:
+    """Полосы, которые воркер разберёт раньше или вместе с задачей приоритета priority."""
+    return [(p, lane_key(queue, p)) for p in PRIORITY_STEPS if p <= priority]
@@ -0,0 +1,224 @@
+# services/telegram_delivery.py
+"""
+Очередь доставки в Telegram с учётом flood-лимитов.
+
+Все отправки идут через `TelegramDelivery`:
+  • глобальный token bucket (~30 запросов/с на бота) и bucket на каждый чат
+    (~1 сообщение/с в личке, ~20/мин в группах);
+  • у каждого чата своя очередь и свой воркер, поэтому медленный чат не
+    задерживает остальные, а порядок сообщений внутри чата сохраняется;
+  • прогресс-правки одного сообщения (`edit_progress`) схлопываются: пока
+    правка ждёт своей очереди, новая просто заменяет её текст;
+  • алерты (`send_message(..., merge=True)`), скопившиеся в очереди чата,
+    склеиваются в одно сообщение (до лимита длины Telegram);
+  • RetryAfter не теряет сообщение — доставка в этот чат ставится на
+    паузу на retry_after секунд и повторяется. Telegram не говорит, какой
+    лимит сработал, поэтому пауза глобальная, только если флуд-ожидание
+    одновременно получили global_flood_chats разных чатов; лимит одного
+    чата остальные чаты не задерживает.
+
+Методы возвращают asyncio.Future с результатом вызова Bot API: дождаться его
+нужно там, где важен факт доставки (outbox), прогресс можно не ждать.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import timedelta
+from typing import Any, Deque, Dict, List, Optional
+
+from telegram.error import BadRequest, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_LEN = 4096
+MERGE_SEPARATOR = "\n\n— — —\n\n"
+
+SEND = "send"
+EDIT = "edit"
+
+
+class TokenBucket:
+    """Классический token bucket: rate токенов в секунду, не больше capacity."""
+
+    def __init__(self, rate: float, capacity: float, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._clock = clock
+        self._updated = clock()
+
+    def _refill(self) -> None:
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self) -> float:
+        """Сколько ждать до появления токена (0 — можно сейчас)."""
+        self._refill()
+        return 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    async def acquire(self) -> None:
+        while (wait := self.delay()) > 0:
+            await asyncio.sleep(wait)
+        self._tokens -= 1
+
+
+@dataclass
+class _Item:
+    kind: str
+    chat_id: int
+    text: str
+    kwargs: Dict[str, Any]
+    message_id: Optional[int] = None
+    merge: bool = False
+    futures: List[asyncio.Future] = field(default_factory=list)
+
+
+def _consume(fut: asyncio.Future) -> None:
+    # прогресс-правки обычно не ждут; ошибка уже залогирована воркером
+    if not fut.cancelled():
+        fut.exception()
+
+
+def _retry_seconds(exc: RetryAfter) -> float:
+    value = exc.retry_after
+    return value.total_seconds() if isinstance(value, timedelta) else float(value)
+
+
+class TelegramDelivery:
+    def __init__(
+        self,
+        bot,
+        *,
+        global_rate: float = 25.0,
+        private_rate: float = 1.0,
+        group_rate: float = 20 / 60,
+        max_retries: int = 5,
+        global_flood_chats: int = 3,
+    ):
+        self.bot = bot
+        self.max_retries = max_retries
+        self.global_flood_chats = global_flood_chats
+        self._global = TokenBucket(global_rate, global_rate)
+        self._private_rate = private_rate
+        self._group_rate = group_rate
+        self._buckets: Dict[int, TokenBucket] = {}
+        self._queues: Dict[int, Deque[_Item]] = {}
+        self._workers: Dict[int, asyncio.Task] = {}
+        self._paused_until = 0.0                       # глобальный flood wait
+        self._chat_paused_until: Dict[int, float] = {}  # лимит конкретного чата
+
+    # ─────────── публичный API ───────────
+    def send_message(self, chat_id: int, text: str, *, merge: bool = False, **kwargs) -> asyncio.Future:
+        """Ставит сообщение в очередь чата. merge=True — можно склеить с соседними алертами."""
+        return self._enqueue(_Item(SEND, chat_id, text, kwargs, merge=merge))
+
+    def edit_progress(self, chat_id: int, message_id: int, text: str, **kwargs) -> asyncio.Future:
+        """Правка прогресс-сообщения; ещё не отправленная правка того же сообщения заменяется."""
+        queue = self._queues.get(chat_id)
+        if queue:
+            for item in queue:
+                if item.kind == EDIT and item.message_id == message_id:
+                    item.text, item.kwargs = text, kwargs
+                    fut = asyncio.get_running_loop().create_future()
+                    fut.add_done_callback(_consume)
+                    item.futures.append(fut)
+                    return fut
+        return self._enqueue(_Item(EDIT, chat_id, text, kwargs, message_id=message_id))
+
+    async def flush(self) -> None:
+        """Ждёт, пока все очереди опустеют."""
+        while self._workers:
+            await asyncio.gather(*list(self._workers.values()), return_exceptions=True)
+
+    # ─────────── очередь ───────────
+    def _enqueue(self, item: _Item) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        fut.add_done_callback(_consume)
+        item.futures.append(fut)
+        self._queues.setdefault(item.chat_id, deque()).append(item)
+        if item.chat_id not in self._workers:
+            self._workers[item.chat_id] = asyncio.create_task(self._chat_worker(item.chat_id))
+        return fut
+
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            rate = self._group_rate if chat_id < 0 else self._private_rate
+            bucket = self._buckets[chat_id] = TokenBucket(rate, 1)
+        return bucket
+
+    def _take_batch(self, queue: Deque[_Item]) -> _Item:
+        """Первый элемент очереди; подряд идущие merge-алерты склеиваются в него."""
+        item = queue.popleft()
+        if item.kind != SEND or not item.merge:
+            return item
+        while queue and queue[0].kind == SEND and queue[0].merge and queue[0].kwargs == item.kwargs:
+            merged = item.text + MERGE_SEPARATOR + queue[0].text
+            if len(merged) > MAX_MESSAGE_LEN:
+                break
+            nxt = queue.popleft()
+            item.text = merged
+            item.futures.extend(nxt.futures)
+        return item
+
+    async def _chat_worker(self, chat_id: int) -> None:
+        queue = self._queues[chat_id]
+        try:
+            while queue:
+                await self._bucket(chat_id).acquire()
+                item = self._take_batch(queue)
+                try:
+                    result = await self._call(item)
+                except Exception as exc:
+                    logger.error("Telegram %s в чат %s не доставлено: %s", item.kind, chat_id, exc)
+                    for fut in item.futures:
+                        if not fut.done():
+                            fut.set_exception(exc)
+                    continue
+                for fut in item.futures:
+                    if not fut.done():
+                        fut.set_result(result)
+        finally:
+            self._workers.pop(chat_id, None)
+            if not queue:
+                self._queues.pop(chat_id, None)
+            if self._chat_paused_until.get(chat_id, 0.0) <= time.monotonic():
+                self._chat_paused_until.pop(chat_id, None)
+
+    def _pause(self, chat_id: int, wait: float) -> None:
+        now = time.monotonic()
+        until = now + wait
+        self._chat_paused_until[chat_id] = max(self._chat_paused_until.get(chat_id, 0.0), until)
+        flooded = [t for t in self._chat_paused_until.values() if t > now]
+        if len(flooded) >= self.global_flood_chats:
+            # флуд-ожидание сразу у нескольких чатов — это лимит бота, а не чата
+            self._paused_until = max(self._paused_until, min(flooded))
+
+    async def _call(self, item: _Item):
+        for attempt in range(self.max_retries + 1):
+            pause = max(self._paused_until, self._chat_paused_until.get(item.chat_id, 0.0)) - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            await self._global.acquire()
+            try:
+                if item.kind == EDIT:
+                    return await self.bot.edit_message_text(
+                        chat_id=item.chat_id, message_id=item.message_id, text=item.text, **item.kwargs
+                    )
+                return await self.bot.send_message(chat_id=item.chat_id, text=item.text, **item.kwargs)
+            except RetryAfter as exc:
+                wait = _retry_seconds(exc)
+                logger.warning("Telegram flood limit (chat %s): пауза %.1fs, попытка %d",
+                               item.chat_id, wait, attempt + 1)
+                self._pause(item.chat_id, wait)
+                if attempt == self.max_retries:
+                    raise
+            except BadRequest as exc:
+                if item.kind == EDIT and "not modified" in str(exc).lower():
+                    return None
+                raise
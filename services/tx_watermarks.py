@@ -0,0 +1,158 @@
+# services/tx_watermarks.py
+"""
+In-memory high-water marks и дедупликация подписей для tracked_transactions.
+
+Вместо SELECT последнего block_time на каждый адрес в каждом цикле воркер
+держит в памяти:
+  • watermark — максимальный block_time, уже записанный для адреса;
+  • ограниченный набор последних подписей (signature) этого адреса.
+
+Новыми считаются строки с block_time >= watermark, подписи которых ещё не
+видели — так строки с тем же block_time, что и watermark, не теряются и не
+дублируются. Состояние опционально зеркалится в Redis, чтобы рестарт
+воркера не требовал похода в БД. Если ни памяти, ни Redis нет, адрес
+один раз «прогревается» через bootstrap-колбэк (обычно — запрос к БД).
+"""
+from __future__ import annotations
+
+import logging
+from collections import deque
+from datetime import datetime, timezone
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Set
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# bootstrap(addr) -> [{"signature": ..., "block_time": ...}, ...] (свежие первыми)
+Bootstrap = Callable[[str], List[Dict[str, Any]]]
+
+
+def _as_utc(value) -> Optional[datetime]:
+    if value is None or (not isinstance(value, datetime) and pd.isna(value)):
+        return None
+    ts = pd.Timestamp(value)
+    ts = ts.tz_localize("UTC") if ts.tzinfo is None else ts.tz_convert("UTC")
+    return ts.to_pydatetime()
+
+
+class _AddressState:
+    __slots__ = ("watermark", "order", "seen")
+
+    def __init__(self, maxlen: int):
+        self.watermark: Optional[datetime] = None
+        self.order: Deque[str] = deque(maxlen=maxlen)
+        self.seen: Set[str] = set()
+
+    def add(self, signature: str) -> None:
+        if signature in self.seen:
+            return
+        if len(self.order) == self.order.maxlen:
+            self.seen.discard(self.order[0])
+        self.order.append(signature)
+        self.seen.add(signature)
+
+
+class WatermarkStore:
+    """Per-address watermark + bounded signature set с опциональным Redis."""
+
+    def __init__(
+        self,
+        bootstrap: Optional[Bootstrap] = None,
+        redis_client=None,
+        *,
+        max_signatures: int = 2000,
+        key_prefix: str = "bundle_tracker",
+    ):
+        self._bootstrap = bootstrap
+        self._redis = redis_client
+        self._max = max_signatures
+        self._prefix = key_prefix
+        self._state: Dict[str, _AddressState] = {}
+
+    # ─────────── redis keys ───────────
+    @property
+    def _wm_key(self) -> str:
+        return f"{self._prefix}:watermarks"
+
+    def _sig_key(self, addr: str) -> str:
+        return f"{self._prefix}:sigs:{addr}"
+
+    # ─────────── loading ───────────
+    def _load(self, addr: str) -> _AddressState:
+        st = self._state.get(addr)
+        if st is not None:
+            return st
+        st = _AddressState(self._max)
+        if not self._load_from_redis(addr, st) and self._bootstrap is not None:
+            try:
+                rows = self._bootstrap(addr) or []
+            except Exception as exc:
+                logger.error("Watermark bootstrap для %s не удался: %s", addr, exc)
+                rows = []
+            # bootstrap отдаёт свежие первыми — добавляем от старых к новым
+            for row in reversed(rows):
+                if row.get("signature"):
+                    st.add(row["signature"])
+                ts = _as_utc(row.get("block_time"))
+                if ts is not None and (st.watermark is None or ts > st.watermark):
+                    st.watermark = ts
+        self._state[addr] = st
+        return st
+
+    def _load_from_redis(self, addr: str, st: _AddressState) -> bool:
+        if self._redis is None:
+            return False
+        try:
+            raw_wm = self._redis.hget(self._wm_key, addr)
+            if raw_wm is None:
+                return False
+            st.watermark = datetime.fromisoformat(raw_wm.decode() if isinstance(raw_wm, bytes) else raw_wm)
+            for sig in reversed(self._redis.lrange(self._sig_key(addr), 0, self._max - 1)):
+                st.add(sig.decode() if isinstance(sig, bytes) else sig)
+            return True
+        except Exception as exc:
+            logger.warning("Не удалось прочитать watermark %s из Redis: %s", addr, exc)
+            return False
+
+    # ─────────── public API ───────────
+    def watermark(self, addr: str) -> Optional[datetime]:
+        return self._load(addr).watermark
+
+    def filter_new(self, df: pd.DataFrame, addr: str) -> pd.DataFrame:
+        """Оставляет только строки, которых ещё нет в tracked_transactions."""
+        if df.empty:
+            return df
+        st = self._load(addr)
+        mask = pd.Series(True, index=df.index)
+        if st.watermark is not None and "block_time" in df.columns:
+            mask &= df["block_time"] >= st.watermark
+        if "signature" in df.columns:
+            mask &= ~df["signature"].isin(st.seen)
+            return df[mask].drop_duplicates(subset=["signature"])
+        if st.watermark is not None and "block_time" in df.columns:
+            # без подписей дедупить нечем — строго новее watermark
+            mask &= df["block_time"] > st.watermark
+        return df[mask]
+
+    def commit(self, addr: str, signatures: Iterable[str], max_block_time) -> None:
+        """Фиксирует успешно записанные строки: двигает watermark и запоминает подписи."""
+        st = self._load(addr)
+        sigs = [s for s in signatures if s]
+        for sig in sigs:
+            st.add(sig)
+        ts = _as_utc(max_block_time)
+        if ts is not None and (st.watermark is None or ts > st.watermark):
+            st.watermark = ts
+        if self._redis is None:
+            return
+        try:
+            pipe = self._redis.pipeline()
+            if st.watermark is not None:
+                pipe.hset(self._wm_key, addr, st.watermark.astimezone(timezone.utc).isoformat())
+            if sigs:
+                pipe.lpush(self._sig_key(addr), *sigs)
+                pipe.ltrim(self._sig_key(addr), 0, self._max - 1)
+            pipe.execute()
+        except Exception as exc:
+            logger.warning("Не удалось сохранить watermark %s в Redis: %s", addr, exc)
@@ -0,0 +1,219 @@
+# services/update_processor.py
+"""
+Параллельная обработка апдейтов с сохранением порядка внутри пользователя.
+
+По умолчанию PTB обрабатывает апдейты строго по одному: медленный
+обработчик одного пользователя (выгрузка dev-stats, разбор большого
+.txt) задерживает всех остальных.
+
+    Application.builder().concurrent_updates(UserOrderedUpdateProcessor())
+
+• Апдейты разных пользователей идут параллельно (не больше
+  BOT_CONCURRENT_UPDATES одновременно).
+• Апдейты одного пользователя — строго по очереди: у каждого ключа
+  (user id, иначе chat id) свой asyncio.Lock, а он отдаёт владение
+  ожидающим в порядке прихода. user_data не правится двумя
+  обработчиками сразу.
+• Пользователь сначала встаёт в свою очередь и только потом занимает
+  общий слот, поэтому флуд одного пользователя держит один слот, а не все.
+
+Тяжёлые операции помечаются `@heavy_operation`: обработчик в очереди
+пользователя только читает и меняет user_data, а саму работу отдаёт
+отдельной задаче (очередь пользователя свободна — меню отвечает, пока идёт
+выгрузка), не больше HEAVY_OPS_PER_USER на пользователя и HEAVY_OPS_TOTAL
+на процесс. Лишний запуск получает ответ «дождитесь».
+
+Апдейты, взятые из общей очереди (services/update_queue.py), помечаются
+`track()` и считаются в `in_flight`, пока их обработка (вместе с
+отделённой тяжёлой задачей) не закончится:
+очередь приложения при параллельной обработке почти всегда пуста, и
+только этот счётчик показывает, сколько апдейтов реплика держит в памяти.
+"""
+from __future__ import annotations
+
+import asyncio
+import functools
+import logging
+import os
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
+
+from telegram.ext import BaseUpdateProcessor
+
+from ui.translations import get_text
+
+logger = logging.getLogger(__name__)
+
+BOT_CONCURRENT_UPDATES = int(os.getenv("BOT_CONCURRENT_UPDATES", 64))
+HEAVY_OPS_PER_USER = int(os.getenv("HEAVY_OPS_PER_USER", 1))
+HEAVY_OPS_TOTAL = int(os.getenv("HEAVY_OPS_TOTAL", 8))
+
+
+def update_key(update: Any) -> Optional[Hashable]:
+    user = getattr(update, "effective_user", None)
+    if user is not None:
+        return user.id
+    chat = getattr(update, "effective_chat", None)
+    return chat.id if chat is not None else None
+
+
+class KeyedLocks:
+    """asyncio.Lock на ключ; запись удаляется, когда её никто не держит и не ждёт."""
+
+    def __init__(self):
+        self._locks: Dict[Hashable, List] = {}   # ключ → [lock, кол-во держащих/ждущих]
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    async def run(self, key: Hashable, coroutine: Awaitable[Any]) -> Any:
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                return await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates: int = BOT_CONCURRENT_UPDATES):
+        super().__init__(max_concurrent_updates)
+        self._locks = KeyedLocks()
+        self._tracked: Dict[int, int] = {}   # id(update) → обработчик + отделённые задачи
+        self._released = asyncio.Event()
+
+    @property
+    def in_flight(self) -> int:
+        """Апдейты из track(), обработка которых ещё не закончилась."""
+        return len(self._tracked)
+
+    def track(self, update: object) -> None:
+        self._tracked[id(update)] = 1
+
+    def hold(self, update: object) -> None:
+        """Работа апдейта продолжается в отдельной задаче: он остаётся в in_flight до release()."""
+        if id(update) in self._tracked:
+            self._tracked[id(update)] += 1
+
+    def release(self, update: object) -> None:
+        left = self._tracked.get(id(update))
+        if left is None:
+            return
+        if left > 1:
+            self._tracked[id(update)] = left - 1
+        else:
+            del self._tracked[id(update)]
+            self._released.set()
+
+    async def run_in_order(self, key: Optional[Hashable], coroutine: Awaitable[Any]) -> Any:
+        """Выполняет coroutine в очереди пользователя key — после уже ждущих там апдейтов."""
+        if key is None:
+            return await coroutine
+        return await self._locks.run(key, coroutine)
+
+    async def wait_in_flight_below(self, limit: int) -> None:
+        while len(self._tracked) >= limit:
+            self._released.clear()
+            await self._released.wait()
+
+    async def process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        try:
+            key = update_key(update)
+            if key is None:
+                await super().process_update(update, coroutine)
+                return
+            # сначала очередь пользователя, потом общий слот (семафор базового класса)
+            await self._locks.run(key, super().process_update(update, coroutine))
+        finally:
+            self.release(update)
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+# ─────────── тяжёлые операции ───────────
+_user_heavy: Dict[Hashable, int] = {}
+_total_heavy: Optional[asyncio.Semaphore] = None
+
+
+async def _notify_busy(update, context) -> None:
+    text = get_text(context.user_data.get("lang", "en"), "heavy_op_busy")
+    if update.callback_query:
+        try:
+            await update.callback_query.answer(text, show_alert=True)
+            return
+        except Exception:
+            pass   # обработчик уже ответил на query — пишем сообщением
+    if update.effective_chat:
+        try:
+            await context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+        except Exception as e:
+            logger.debug("heavy_operation: не удалось сообщить о занятости: %s", e)
+
+
+def _release_heavy(key: Hashable) -> None:
+    _user_heavy[key] -= 1
+    if not _user_heavy[key]:
+        del _user_heavy[key]
+
+
+def heavy_operation(func):
+    """
+    Декоратор обработчика (update, context) тяжёлой операции.
+
+    Сам обработчик выполняется в очереди пользователя: читает и меняет
+    user_data и возвращает корутину тяжёлой части (None — запускать нечего).
+    Тяжёлая часть получает только простые значения и выполняется отдельной
+    задачей с лимитами HEAVY_OPS_PER_USER / HEAVY_OPS_TOTAL. Если она
+    возвращает follow_up(context), тот снова выполняется в очереди
+    пользователя — результат попадает в user_data по порядку.
+    """
+    @functools.wraps(func)
+    async def wrapper(update, context, *args, **kwargs):
+        global _total_heavy
+        key = update_key(update)
+        if _user_heavy.get(key, 0) >= HEAVY_OPS_PER_USER:
+            await _notify_busy(update, context)
+            return
+        _user_heavy[key] = _user_heavy.get(key, 0) + 1
+        try:
+            heavy = await func(update, context, *args, **kwargs)
+        except BaseException:
+            _release_heavy(key)
+            raise
+        if heavy is None:
+            _release_heavy(key)
+            return
+        if _total_heavy is None:
+            _total_heavy = asyncio.Semaphore(HEAVY_OPS_TOTAL)
+        processor = getattr(context.application, "update_processor", None)
+        if not isinstance(processor, UserOrderedUpdateProcessor):
+            processor = None
+        if processor:
+            processor.hold(update)
+
+        async def run():
+            try:
+                async with _total_heavy:
+                    follow_up: Optional[Callable[[Any], Awaitable[Any]]] = await heavy
+                if follow_up is not None:
+                    if processor:
+                        await processor.run_in_order(key, follow_up(context))
+                    else:
+                        await follow_up(context)
+            finally:
+                _release_heavy(key)
+                if processor:
+                    processor.release(update)
+
+        context.application.create_task(run(), update=update, name=f"heavy:{func.__name__}:{key}")
+
+    return wrapper
@@ -0,0 +1,136 @@
+# services/update_queue.py
+"""
+Общая очередь апдейтов Telegram для нескольких реплик бота.
+
+    Telegram ──webhook──▶ webhook_ingress.py ──LPUSH──▶ tg_updates:<бот>:<шард>
+                                                          │ BRPOP
+                                          bot.py (BOT_MODE=worker, BOT_SHARD=i)
+
+Шард выбирается по id пользователя (или чата) — все апдейты одного
+пользователя попадают к одной реплике, по порядку. Поэтому её копия
+user_data всегда актуальна, а RedisPersistence достаточно читать при
+старте: перезапущенная реплика поднимает сессии своих пользователей из
+Redis и продолжает с того же места.
+
+Меняя BOT_SHARDS, перезапускайте все реплики разом — иначе старые копии
+user_data останутся у прежних владельцев.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import signal
+from typing import Any, Dict, Optional
+
+from telegram import Update
+
+from services.redis_pool import get_async_redis
+
+logger = logging.getLogger(__name__)
+
+BOT_SHARDS = int(os.getenv("BOT_SHARDS", 1))
+BOT_SHARD = int(os.getenv("BOT_SHARD", 0))
+KEY_PREFIX = "tg_updates:"
+MAX_BUFFERED = int(os.getenv("BOT_MAX_BUFFERED_UPDATES", 8))   # не больше стольких апдейтов вне Redis
+POP_TIMEOUT = 1
+
+
+def updates_key(namespace: str, shard: int) -> str:
+    return f"{KEY_PREFIX}{namespace}:{shard}"
+
+
+def is_primary() -> bool:
+    """Реплика, которая ведёт общие фоновые job'ы (алерты) — ровно одна на бота."""
+    return BOT_SHARD == 0
+
+
+def shard_of(update: Dict[str, Any], shards: int = BOT_SHARDS) -> int:
+    """
+    Шард по сырому JSON апдейта: from/user, иначе чат.
+    Не объект апдейта → ValueError (ingress отвечает на него 400).
+    """
+    if not isinstance(update, dict):
+        raise ValueError(f"апдейт должен быть JSON-объектом, а не {type(update).__name__}")
+    for field, payload in update.items():
+        if field == "update_id" or not isinstance(payload, dict):
+            continue
+        message = payload.get("message")
+        owner = (payload.get("from") or payload.get("user") or payload.get("chat")
+                 or (message.get("chat") if isinstance(message, dict) else None) or {})
+        if not isinstance(owner, dict):
+            raise ValueError(f"поле {field}: владелец апдейта не объект")
+        try:
+            return abs(int(owner.get("id", 0))) % shards
+        except TypeError:
+            raise ValueError(f"поле {field}: некорректный id") from None
+    return 0
+
+
+async def push_update(namespace: str, raw: bytes, shards: int = BOT_SHARDS) -> int:
+    """Кладёт сырой апдейт в очередь его шарда (вызывает ingress). Битый JSON → ValueError."""
+    shard = shard_of(json.loads(raw), shards)
+    await get_async_redis().lpush(updates_key(namespace, shard), raw)
+    return shard
+
+
+async def _consume(application, key: str, stop: asyncio.Event) -> None:
+    """
+    Переносит апдейты шарда из Redis в приложение. Забираем новый, только
+    когда в обработке (в очереди приложения или уже в обработчике) меньше
+    MAX_BUFFERED апдейтов: при падении реплики теряется не больше них.
+    Считает UserOrderedUpdateProcessor (services/update_processor.py) —
+    очередь приложения при параллельной обработке почти всегда пуста.
+    """
+    redis = get_async_redis()
+    processor = application.update_processor
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(processor.wait_in_flight_below(MAX_BUFFERED), POP_TIMEOUT)
+        except asyncio.TimeoutError:
+            continue   # заодно проверяем stop
+        try:
+            item = await redis.brpop(key, timeout=POP_TIMEOUT)
+        except Exception as e:
+            logger.warning("UPDATE_QUEUE: Redis недоступен (%s), повтор через 1 с", e)
+            await asyncio.sleep(1)
+            continue
+        if item is None:
+            continue
+        try:
+            update = Update.de_json(json.loads(item[1]), application.bot)
+        except Exception as e:
+            logger.error("UPDATE_QUEUE: битый апдейт в %s пропущен: %s", key, e)
+            continue
+        processor.track(update)
+        await application.update_queue.put(update)
+
+
+async def run_worker(application, namespace: str, shard: Optional[int] = None) -> None:
+    """
+    Аналог application.run_polling() для реплики за webhook'ом: тот же
+    жизненный цикл (post_init / post_stop / post_shutdown), но апдейты
+    берутся из очереди шарда.
+    """
+    shard = BOT_SHARD if shard is None else shard
+    key = updates_key(namespace, shard)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    logger.info("UPDATE_QUEUE: реплика %s/%s слушает %s", shard, BOT_SHARDS, key)
+    try:
+        await _consume(application, key, stop)
+    finally:
+        await application.stop()     # дорабатывает уже полученные апдейты и пишет persistence
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
@@ -0,0 +1,131 @@
+# services/user_cache.py
+"""
+Read-through кэш пользовательских данных, которые читаются на каждом
+шаге навигации по меню: премиум-статус и шаблоны парсинга.
+
+Два уровня:
+    • LRU процесса (USER_CACHE_SIZE записей, USER_CACHE_LOCAL_TTL секунд) —
+      повторные нажатия в меню вообще не выходят из процесса;
+    • Redis (`ucache:<пространство>:<ключ>`, USER_CACHE_TTL секунд) —
+      общий для bot / bot_lite и переживает перезапуск.
+
+Значения хранятся как JSON-строки и на каждом чтении разбираются заново:
+вызывающий получает свою копию и может её менять (handlers правят
+шаблон прямо в user_data), не портя кэш.
+
+Запись в БД обязана вызвать `invalidate()`: она удаляет ключ в Redis и
+локальную копию. Локальные копии в других процессах доживают не больше
+USER_CACHE_LOCAL_TTL. Без Redis работает только LRU процесса.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable
+
+from services.redis_pool import get_async_redis, get_redis
+
+logger = logging.getLogger(__name__)
+
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 5000))
+USER_CACHE_LOCAL_TTL = float(os.getenv("USER_CACHE_LOCAL_TTL", 30))
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", 600))
+KEY_PREFIX = "ucache:"
+
+PREMIUM = "premium"
+TEMPLATES = "templates"
+
+_MISSING = object()
+
+
+class _LRU:
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def get(self, key: str):
+        item = self._data.get(key)
+        if item is None:
+            return _MISSING
+        expires_at, raw = item
+        if time.monotonic() >= expires_at:
+            del self._data[key]
+            return _MISSING
+        self._data.move_to_end(key)
+        return raw
+
+    def set(self, key: str, raw: str) -> None:
+        self._data[key] = (time.monotonic() + self.ttl, raw)
+        self._data.move_to_end(key)
+        while len(self._data) > self.size:
+            self._data.popitem(last=False)
+
+    def pop(self, key: str) -> None:
+        self._data.pop(key, None)
+
+
+_local = _LRU(USER_CACHE_SIZE, USER_CACHE_LOCAL_TTL)
+
+
+def _key(namespace: str, key: Any) -> str:
+    return f"{KEY_PREFIX}{namespace}:{key}"
+
+
+async def cached(namespace: str, key: Any, loader: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    Значение из кэша или из `loader()`. Исключение loader'а пробрасывается
+    и ничего не кэширует.
+    """
+    full_key = _key(namespace, key)
+    raw = _local.get(full_key)
+    if raw is not _MISSING:
+        return json.loads(raw)
+
+    redis = get_async_redis()
+    if redis is not None:
+        try:
+            raw = await redis.get(full_key)
+        except Exception as e:
+            logger.warning("USER_CACHE: Redis недоступен (%s), читаем из БД", e)
+            redis, raw = None, None
+        if raw is not None:
+            raw = raw.decode() if isinstance(raw, bytes) else raw
+            _local.set(full_key, raw)
+            return json.loads(raw)
+
+    value = await loader()
+    raw = json.dumps(value, default=str)
+    _local.set(full_key, raw)
+    if redis is not None:
+        try:
+            await redis.set(full_key, raw, ex=USER_CACHE_TTL)
+        except Exception as e:
+            logger.warning("USER_CACHE: не удалось записать %s: %s", full_key, e)
+    return json.loads(raw)
+
+
+async def invalidate(namespace: str, key: Any) -> None:
+    full_key = _key(namespace, key)
+    _local.pop(full_key)
+    redis = get_async_redis()
+    if redis is not None:
+        try:
+            await redis.delete(full_key)
+        except Exception as e:
+            logger.warning("USER_CACHE: не удалось сбросить %s: %s", full_key, e)
+
+
+def invalidate_sync(namespace: str, key: Any) -> None:
+    """Для синхронного кода (services/db_access)."""
+    full_key = _key(namespace, key)
+    _local.pop(full_key)
+    redis = get_redis()
+    if redis is not None:
+        try:
+            redis.delete(full_key)
+        except Exception as e:
+            logger.warning("USER_CACHE: не удалось сбросить %s: %s", full_key, e)
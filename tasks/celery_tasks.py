@@ -1,11 +1,16 @@
+import io
 import os
 import shutil
 import tempfile
 import asyncio
 import uuid
+import hashlib
+from contextlib import contextmanager
 import pandas as pd
 from datetime import datetime, timezone, timedelta
 from asgiref.sync import async_to_sync
+from celery import chord
+from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.by import By
@@ -17,8 +22,23 @@ import numpy as np
 from celery_app import celery
 import config
 from services import supabase_service
+from services.lease_lock import Lease
+from services.payload_store import default_store, ref_size
+from services.redis_pool import get_redis
+from services.job_dedup import JOB_PNL, JOB_TOP_TRADERS, RESULT_FILENAMES, default_coalescer
+from services.task_eta import ALL_IN_PIPELINE, TaskEtaModel
+from services.task_routing import PRIORITY_BACKGROUND, PRIORITY_DEFAULT
+from services.batch_checkpoints import (BatchCheckpoint, ChunkResultMissing, claim_batch, finish_batch,
+                                        release_batch)
+from services.export_writer import ExportWriter, iter_query_rows, send_export
+from services import file_id_cache
+from services.supabase_async import close_client, get_client
+from services.telegram_delivery import TelegramDelivery
+from tasks.filters import apply_pnl_filters
 from workers.get_trader_pnl import perform_pnl_fetch
 from workers.get_top_traders import perform_toplevel_traders_fetch
+from workers.get_program_swaps import perform_program_swaps
+from ui.translations import get_text
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 import logging
@@ -30,8 +50,7 @@ logger = logging.getLogger(__name__)
 TOKENS_CHUNK_SIZE = 1000
 TRADERS_CHUNK_SIZE = 40000
 
-redis_url = os.getenv('REDIS_URL')
-redis = Redis.from_url(redis_url)
+redis = get_redis()
 
 def init_worker_driver():
     logger.info("CELERY_TASK: Инициализация Selenium-драйвера...")
@@ -59,306 +78,626 @@ def init_worker_driver():
     logger.info("CELERY_TASK: Драйвер успешно создан.")
     return driver
 
-async def _run_all_in_parse_periodic_task_async(template: dict):
-    lock_key = "all_in_parse_lock"
+# ─────────────────────────────────────────────────────────────────────────────
+#  All-In Parse как DAG Celery
+#
+#  start ─▶ chord([top_traders_chunk × N]) ─▶ pnl_stage
+#                 pnl_stage ─▶ chord([pnl_chunk × M]) ─▶ finalize
+#
+#  Каждый чанк — отдельная задача со своим драйвером, поэтому пакеты токенов
+#  и трейдеров обрабатываются параллельно на всех свободных воркерах.
+#  ctx — общий контекст запуска:
+#    batch_id, template, mode ("deliver" — пользователю в Telegram,
+#    "store" — периодический прогон в pnl_batches), chat_id, message_id.
+# ─────────────────────────────────────────────────────────────────────────────
+
+PNL_NUMERIC_COLS = [
+    "balance", "wsol_balance", "roi_7d", "roi_30d", "winrate_7d", "winrate_30d",
+    "avg_holding_time", "usd_profit_7d", "usd_profit_30d", "avg_token_age_7d", "avg_token_age_30d",
+    "top_three_pnl", "avg_quick_buy_and_sell_percentage", "avg_bundled_token_buys_percentage",
+    "avg_sold_more_than_bought_percentage", "avg_first_buy_mcap_7d", "total_buys_7d", "pf_buys_7d",
+    "pf_swap_buys_7d", "bonk_buys_7d", "raydium_buys_7d", "boop_buys_7d", "meteora_buys_7d",
+    "avg_first_buy_mcap_30d", "total_buys_30d", "pf_buys_30d", "pf_swap_buys_30d", "bonk_buys_30d",
+    "raydium_buys_30d", "boop_buys_30d", "meteora_buys_30d", "avg_buys_per_token_7d",
+    "avg_buys_per_token_30d", "total_sells_7d", "total_sells_30d", "avg_forwarder_tip",
+    "avg_token_cost_7d", "avg_token_cost_30d", "unrealised_pnl_7d", "unrealised_pnl_30d",
+    "total_cost_7d", "total_cost_30d", "traded_tokens"  # traded_tokens integer
+]
+
+PERIODIC_LEASE_NAME = "all_in_parse"
+PERIODIC_LEASE_TTL = int(os.getenv("ALL_IN_LEASE_TTL", 600))
+# Аренду продлевают работающие подзадачи DAG, а в паузах между ними (очередь,
+# countdown ретраев) — all_in_lease_keepalive, пока DAG подаёт признаки жизни.
+# Нет их дольше PERIODIC_STALL_TIMEOUT (воркер убит) — аренда истекает.
+PERIODIC_STALL_TIMEOUT = int(os.getenv("ALL_IN_STALL_TIMEOUT", 1800))
+PROGRESS_PREFIX = "all_in_parse:progress:"
+CHUNK_MAX_RETRIES = int(os.getenv("ALL_IN_CHUNK_MAX_RETRIES", 3))
+CHUNK_RETRY_DELAY = 60
+
+
+def _sync(fn):
+    """
+    async_to_sync, закрывающий клиент Supabase своего временного loop'а
+    (services/supabase_async.py): иначе каждый вызов оставляет пул соединений httpx.
+    """
+    async def _run(*args, **kwargs):
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            await close_client()
+    return async_to_sync(_run)
+
+
+def _chunks(items: list, size: int) -> list:
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def _payload_to_file(ref: str) -> str:
+    """Адреса из payload store построчно во временный .txt (вход Discord-бота)."""
+    with tempfile.NamedTemporaryFile(delete=False, mode='w', suffix=".txt", encoding='utf-8') as tmp_f:
+        try:
+            for line in default_store().iter_lines(ref):
+                tmp_f.write(line + "\n")
+        except Exception:
+            tmp_f.close()
+            os.remove(tmp_f.name)
+            raise
+        return tmp_f.name
+
+
+def _parse_traders(lines) -> list:
+    return [line.strip() for line in lines if line.strip() and not line.startswith('---')]
+
+
+def _with_driver(fn, *args):
+    """Запускает fn(driver, *args) на собственном драйвере задачи и гарантированно его закрывает."""
+    driver = init_worker_driver()
     try:
-        if not redis.set(lock_key, "locked", nx=True, ex=3600):
-            logger.info("Periodic task already running, skipping.")
-            return
-        
-        temp_files_to_clean = []
-        batch_id = str(uuid.uuid4())
-        batch_created_at = datetime.now(timezone.utc)
+        return fn(driver, *args)
+    finally:
+        driver.quit()
+        if hasattr(driver, 'temp_dir') and os.path.exists(driver.temp_dir):
+            shutil.rmtree(driver.temp_dir, ignore_errors=True)
+
+
+def _notify(ctx: dict, text: str):
+    """Правка прогресс-сообщения пользователя (для mode=deliver)."""
+    if ctx.get("mode") != "deliver":
+        logger.info(f"Batch {ctx['batch_id']}: {text}")
+        return
+
+    async def _edit():
+        delivery = TelegramDelivery(Bot(token=config.TELEGRAM_BOT_TOKEN))
+        delivery.edit_progress(ctx["chat_id"], ctx["message_id"], text, disable_web_page_preview=True)
+        await delivery.flush()
+
+    try:
+        _sync(_edit)()
+    except Exception as e:
+        logger.warning(f"Batch {ctx['batch_id']}: не удалось обновить прогресс: {e}")
+
+
+def _periodic_lease(ctx: dict) -> Lease | None:
+    """Аренда периодического прогона, переданная по DAG через ctx (token + fencing token)."""
+    info = ctx.get("lease")
+    if not info:
+        return None
+    return Lease.adopt(redis, PERIODIC_LEASE_NAME, info["token"], info["fence"], ttl=PERIODIC_LEASE_TTL)
+
+
+def _keep_lease(ctx: dict, ahead: float = 0):
+    """
+    Подзадача DAG жива: продлевает аренду периодического прогона и отмечает
+    прогресс для keepalive. ahead — запланированная пауза (countdown ретрая).
+    """
+    lease = _periodic_lease(ctx)
+    if not lease:
+        return
+    try:
+        lease.renew()
+        redis.set(PROGRESS_PREFIX + lease.token, int(time.time()), ex=PERIODIC_STALL_TIMEOUT + int(ahead))
+    except Exception as e:
+        logger.warning(f"Batch {ctx['batch_id']}: аренда не продлена: {e}")
+
 
-        logger.info(f"Batch {batch_id}: Этап 1 - Поиск токенов")
+@contextmanager
+def _lease_heartbeat(ctx: dict):
+    """Пока подзадача DAG работает, она продлевает аренду периодического прогона."""
+    lease = _periodic_lease(ctx)
+    if lease:
+        _keep_lease(ctx)
+        lease.start_heartbeat()
+    try:
+        yield lease
+    finally:
+        if lease:
+            lease.stop_heartbeat()
+            _keep_lease(ctx)
+
+
+def _finish(ctx: dict):
+    lease = _periodic_lease(ctx)
+    if lease:
+        lease.release()
+        redis.delete(PROGRESS_PREFIX + lease.token)
+
+
+def _fail(ctx: dict):
+    """Остановка с ошибкой: чекпоинты и batch_id остаются для продолжения следующим запуском."""
+    release_batch(redis, ctx["batch_id"])
+    _finish(ctx)
+
+
+def _complete(ctx: dict):
+    """Успешное завершение: чекпоинты больше не нужны, следующий запуск начнётся с нуля."""
+    BatchCheckpoint(ctx["batch_id"]).cleanup()
+    finish_batch(redis, ctx["run_key"], ctx["batch_id"])
+    _finish(ctx)
+    if ctx.get("started_at"):
+        # длительность всего DAG — основа ETA для следующих 'All-In Parse'
+        TaskEtaModel(redis).record(ALL_IN_PIPELINE, 1, time.time() - ctx["started_at"])
+
+
+def _retry_chunk(task, ctx: dict, what: str, exc: Exception | None = None):
+    """
+    Повтор чанка с тем же batch_id. После исчерпания попыток чанк падает:
+    chord уходит в errback, а не собирает отчёт без этого пакета.
+    """
+    if task.request.retries < CHUNK_MAX_RETRIES:
+        logger.warning(f"Batch {ctx['batch_id']}: {what} — повтор {task.request.retries + 1}/{CHUNK_MAX_RETRIES} ({exc})")
+        countdown = CHUNK_RETRY_DELAY * (task.request.retries + 1)
+        _keep_lease(ctx, ahead=countdown)
+        raise task.retry(exc=exc, countdown=countdown)
+    logger.error(f"Batch {ctx['batch_id']}: {what} — попытки исчерпаны ({exc})")
+    raise ChunkResultMissing(f"batch {ctx['batch_id']}: {what}") from exc
+
+
+def _start_all_in_pipeline(ctx: dict):
+    """
+    Этап 1 (токены) и запуск fan-out по чанкам токенов. Если для run_key
+    есть незавершённый и не выполняющийся сейчас batch, берём его batch_id и
+    сохранённый список токенов: чанки нарезаются так же, и готовые пропускаются.
+    """
+    template = ctx["template"]
+    ctx["batch_id"] = claim_batch(redis, ctx["run_key"], ctx["batch_id"])
+    checkpoint = BatchCheckpoint(ctx["batch_id"])
+
+    token_addresses = checkpoint.load_tokens()
+    if token_addresses is not None:
+        logger.info(f"Batch {ctx['batch_id']}: продолжаю с чекпоинта ({len(token_addresses)} токенов)")
+    else:
+        _notify(ctx, "🚀 Этап 1/3: Поиск токенов...")
         hours = int(template.get('time_period', '24h').replace('h', ''))
         start_time = datetime.now(timezone.utc) - timedelta(hours=hours)
         categories = [cat for cat in template.get('categories', []) if cat in ['completed', 'completing']]
-        tokens = await supabase_service.fetch_tokens_by_criteria(start_time, template.get('platforms', []), categories)
+        tokens = _sync(supabase_service.fetch_tokens_by_criteria)(start_time, template.get('platforms', []), categories)
+        token_addresses = [t['contract_address'] for t in tokens or []]
+        if token_addresses:
+            checkpoint.save_tokens(token_addresses)
+
+    if not token_addresses:
+        _notify(ctx, "❌ Не найдено токенов по вашему шаблону. Задача остановлена.")
+        _complete(ctx)
+        return
+
+    token_chunks = _chunks(token_addresses, TOKENS_CHUNK_SIZE)
+    ctx = {**ctx, "tokens_count": len(token_addresses), "token_chunks": len(token_chunks)}
+    _notify(ctx, f"👥 Этап 2/3: Получение трейдеров для {len(token_addresses)} токенов "
+                 f"({len(token_chunks)} пакетов параллельно). Это может занять время...")
+
+    priority = ctx.get("priority", PRIORITY_DEFAULT)
+    # в брокер уходят только ссылки на пакеты (services/payload_store.py); ссылка на
+    # нормализованный пакет — ещё и ключ кэша результатов (services/job_dedup.py)
+    coalescer = default_coalescer()
+    header = [all_in_top_traders_chunk.s(ctx, i, coalescer.input_ref(chunk)).set(priority=priority)
+              for i, chunk in enumerate(token_chunks)]
+    _keep_lease(ctx)
+    chord(header, all_in_pnl_stage.s(ctx).set(priority=priority)).on_error(all_in_failed.s(ctx)).apply_async()
+
+
+@celery.task(bind=True, max_retries=CHUNK_MAX_RETRIES)
+def all_in_top_traders_chunk(self, ctx: dict, index: int, tokens_ref: str) -> list:
+    """Один пакет токенов → список трейдеров (из чекпоинта, если пакет уже готов)."""
+    checkpoint = BatchCheckpoint(ctx["batch_id"])
+    cached = checkpoint.load_traders(index)
+    if cached is not None:
+        return cached
+    coalescer = default_coalescer()
+    result_ref = coalescer.cached(JOB_TOP_TRADERS, tokens_ref)
+    if result_ref:
+        # тот же пакет токенов недавно считал другой прогон или пользователь
+        traders = _parse_traders(coalescer.store.get(result_ref))
+        checkpoint.save_traders(index, traders)
+        return traders
+
+    input_path = _payload_to_file(tokens_ref)
+    result_path = None
+    try:
+        try:
+            with _lease_heartbeat(ctx):
+                result_path = _with_driver(perform_toplevel_traders_fetch, input_path)
+        except Exception as e:
+            _retry_chunk(self, ctx, f"пакет токенов {index}", e)
+        if not result_path:
+            _retry_chunk(self, ctx, f"пакет токенов {index} без результата")
+        with open(result_path, 'rb') as f:
+            data = f.read()
+        coalescer.store_result(JOB_TOP_TRADERS, tokens_ref, data)
+        traders = _parse_traders(data.decode('utf-8').splitlines())
+        checkpoint.save_traders(index, traders)
+        return traders
+    finally:
+        for path in (input_path, result_path):
+            if path and os.path.exists(path):
+                os.remove(path)
+
+
+@celery.task(bind=True)
+def all_in_pnl_stage(self, trader_lists: list, ctx: dict):
+    """Объединяет трейдеров всех пакетов и раздаёт PNL-пакеты второму chord'у."""
+    _keep_lease(ctx)
+    unique_traders = sorted({t for traders in trader_lists for t in traders})
+    if not unique_traders:
+        _notify(ctx, "⚠️ Трейдеры для анализа PNL не найдены. Завершаю задачу.")
+        _complete(ctx)
+        return
+
+    trader_chunks = _chunks(unique_traders, TRADERS_CHUNK_SIZE)
+    ctx = {**ctx, "traders_count": len(unique_traders)}
+    _notify(ctx, f"📊 Этап 3/3: Получение PNL для {len(unique_traders)} трейдеров "
+                 f"({len(trader_chunks)} пакетов параллельно).")
+
+    priority = ctx.get("priority", PRIORITY_DEFAULT)
+    coalescer = default_coalescer()
+    header = [all_in_pnl_chunk.s(ctx, i, coalescer.input_ref(chunk)).set(priority=priority)
+              for i, chunk in enumerate(trader_chunks)]
+    raise self.replace(chord(header, all_in_finalize.s(ctx).set(priority=priority)).on_error(all_in_failed.s(ctx)))
+
+
+@celery.task(bind=True, max_retries=CHUNK_MAX_RETRIES)
+def all_in_pnl_chunk(self, ctx: dict, index: int, traders_ref: str) -> str:
+    """Один пакет трейдеров → ссылка на PNL CSV в общем хранилище (из чекпоинта, если пакет уже готов)."""
+    checkpoint = BatchCheckpoint(ctx["batch_id"])
+    cached = checkpoint.pnl_ref(index)
+    if cached:
+        return cached
+    coalescer = default_coalescer()
+    result_ref = coalescer.cached(JOB_PNL, traders_ref)
+    if result_ref:
+        return checkpoint.save_pnl_ref(index, result_ref)
+
+    path = None
+    try:
+        try:
+            with _lease_heartbeat(ctx):
+                path = _with_driver(perform_pnl_fetch, coalescer.store.get(traders_ref))
+        except Exception as e:
+            _retry_chunk(self, ctx, f"PNL-пакет {index}", e)
+        if not path:
+            _retry_chunk(self, ctx, f"PNL-пакет {index} без результата")
+        with open(path, 'rb') as f:
+            result_ref = coalescer.store_result(JOB_PNL, traders_ref, f.read())
+        return checkpoint.save_pnl_ref(index, result_ref)
+    finally:
+        if path and os.path.exists(path):
+            os.remove(path)
+
+
+@celery.task
+def all_in_finalize(pnl_refs: list, ctx: dict):
+    """Этап 4: объединение PNL-отчётов и доставка пользователю или запись в pnl_batches."""
+    checkpoint = BatchCheckpoint(ctx["batch_id"])
+    try:
+        # CSV читаются из общего хранилища: чанки работали на других хостах
+        frames = [pd.read_csv(io.BytesIO(checkpoint.load_pnl(i, ref))) for i, ref in enumerate(pnl_refs)]
+    except ChunkResultMissing as e:
+        logger.error(f"Batch {ctx['batch_id']}: {e}")
+        _notify(ctx, "❌ Не удалось получить все PNL-отчеты. Задача прервана, повторный запуск продолжит с места остановки.")
+        _fail(ctx)
+        raise
+    if not frames:
+        _notify(ctx, "❌ Не удалось получить ни одного PNL отчета. Задача прервана.")
+        _complete(ctx)
+        return
+
+    _notify(ctx, "🖇️ Этап 4/4: Объединение и фильтрация PNL-отчетов...")
+    merged_df = pd.concat(frames, ignore_index=True).drop_duplicates(subset=['wallet'])
+    del frames
+    if ctx["mode"] == "store":
+        with _lease_heartbeat(ctx) as lease:
+            if lease:
+                lease.check()   # fencing: аренду не перехватил другой прогон
+            _store_pnl_batch(merged_df, ctx)
+    else:
+        _sync(_deliver_pnl_report)(merged_df, ctx)
+    _complete(ctx)
+
 
-        if not tokens:
-            logger.warning(f"Batch {batch_id}: Токены не найдены")
+@celery.task
+def all_in_failed(request, exc, traceback, ctx: dict):
+    """errback chord'ов: сообщаем пользователю и снимаем блокировку; чекпоинты остаются для повтора."""
+    logger.error(f"Batch {ctx['batch_id']}: 'All-In Parse' провалился в {request.task}: {exc}")
+    _notify(ctx, "❌ Произошла критическая ошибка во время 'All-In Parse'.")
+    _fail(ctx)
+
+
+def _store_pnl_batch(merged_df: pd.DataFrame, ctx: dict):
+    # ЧИСТКА ДАННЫХ: Конвертируем numeric, invalid -> NaN -> None
+    for col in PNL_NUMERIC_COLS:
+        if col in merged_df.columns:
+            merged_df[col] = pd.to_numeric(merged_df[col], errors='coerce')
+
+    batch_data = []
+    for _, row in merged_df.iterrows():
+        batch_entry = {
+            "batch_id": ctx["batch_id"],
+            "batch_created_at": ctx["batch_created_at"],
+            "wallet": row["wallet"],
+            "last_trade_time": row.get("last_trade_time"),
+        }
+        for col in PNL_NUMERIC_COLS:
+            val = row.get(col)
+            batch_entry[col] = None if pd.isna(val) else val
+        batch_data.append(batch_entry)
+
+    _sync(supabase_service.insert_pnl_batch)(batch_data)
+    logger.info(f"Batch {ctx['batch_id']}: Сохранено {len(batch_data)} записей в Supabase")
+
+
+async def _deliver_pnl_report(merged_df: pd.DataFrame, ctx: dict):
+    chat_id, message_id = ctx["chat_id"], ctx["message_id"]
+    pnl_filters = ctx["template"].get('pnl_filters', {})
+    if pnl_filters:
+        logger.info(f"Applying PNL filters: {pnl_filters}")
+        filtered_df = apply_pnl_filters(merged_df, pnl_filters)
+    else:
+        filtered_df = merged_df
+
+    caption = (
+        f"✅ All-In Parse завершен!\n\n"
+        f"Анализ на основе:\n"
+        f"  - Токенов найдено: {ctx.get('tokens_count')}\n"
+        f"  - Уникальных трейдеров: {ctx.get('traders_count')}\n\n"
+        f"В этом файле финальный PNL-отчет для {len(filtered_df)} трейдеров (после фильтрации)."
+    )
+    bot = Bot(token=config.TELEGRAM_BOT_TOKEN)
+    delivery = TelegramDelivery(bot)
+    back_button_markup = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад в меню", callback_data="main_menu")]])
+    # Сжатый отчёт пишется во временный spooled-файл и при необходимости режется на части
+    with ExportWriter(f"all_in_parse_pnl_{datetime.now(timezone.utc).strftime('%Y%m%d_%H%M%S')}") as writer:
+        writer.write_frame(filtered_df)
+    await send_export(bot, chat_id, writer.parts, caption, reply_markup=back_button_markup)
+    await delivery.edit_progress(chat_id, message_id, "Все готово!", disable_web_page_preview=True)
+
+
+@celery.task
+def all_in_lease_keepalive(lease_info: dict):
+    """
+    Продлевает аренду периодического прогона в паузах DAG (чанки в очереди,
+    countdown ретраев), пока подзадачи отмечают прогресс. Завершается, когда
+    аренду сняли (finalize/errback) или она истекла без признаков жизни.
+    """
+    lease = Lease.adopt(redis, PERIODIC_LEASE_NAME, lease_info["token"], lease_info["fence"], ttl=PERIODIC_LEASE_TTL)
+    if redis.exists(PROGRESS_PREFIX + lease.token):
+        if not lease.renew():
             return
+    elif lease.is_held():
+        logger.warning(f"Lease {PERIODIC_LEASE_NAME}: DAG без прогресса {PERIODIC_STALL_TIMEOUT}s — не продлеваю")
+    else:
+        return
+    all_in_lease_keepalive.apply_async((lease_info,), countdown=PERIODIC_LEASE_TTL / 3, priority=PRIORITY_BACKGROUND)
 
-        token_addresses = [t['contract_address'] for t in tokens]
-        logger.info(f"Batch {batch_id}: Найдено {len(tokens)} токенов")
-
-        logger.info(f"Batch {batch_id}: Этап 2 - Получение топ-трейдеров")
-        token_chunks = [token_addresses[i:i + TOKENS_CHUNK_SIZE] for i in range(0, len(token_addresses), TOKENS_CHUNK_SIZE)]
-        all_traders_files = []
-
-        for chunk in token_chunks:
-            driver = None
-            try:
-                with tempfile.NamedTemporaryFile(delete=False, mode='w', suffix=".txt", encoding='utf-8') as tmp_f:
-                    tmp_f.write("\n".join(chunk))
-                    temp_filepath = tmp_f.name
-                    temp_files_to_clean.append(temp_filepath)
-
-                driver = init_worker_driver()
-                for attempt in range(3):
-                    try:
-                        driver.get("https://discord.com/channels/@me/1331338750789419090")
-                        WebDriverWait(driver, 60).until(EC.presence_of_element_located((By.CSS_SELECTOR, "main[class*='chatContent']")))
-                        break
-                    except (TimeoutException, WebDriverException) as e:
-                        logger.warning(f"Retry {attempt+1}/3 for top traders: {e}")
-                        time.sleep(5)
-                else:
-                    raise Exception("Failed to load Discord DM for top traders")
-
-                result_path = perform_toplevel_traders_fetch(driver, temp_filepath)
-                if result_path:
-                    all_traders_files.append(result_path)
-            finally:
-                if driver:
-                    driver.quit()
-                    if hasattr(driver, 'temp_dir') and os.path.exists(driver.temp_dir):
-                        shutil.rmtree(driver.temp_dir, ignore_errors=True)
-                        logger.info(f"Очищен temp: {driver.temp_dir}")
-
-        if not all_traders_files:
-            logger.error(f"Batch {batch_id}: Не удалось получить топ-трейдеров")
-            raise Exception("Top Traders fetch failed")
-
-        final_trader_list = []
-        for path in all_traders_files:
-            with open(path, 'r', encoding='utf-8') as f:
-                final_trader_list.extend([line.strip() for line in f if line.strip() and not line.startswith('---')])
-            temp_files_to_clean.append(path)
-
-        unique_traders = list(set(final_trader_list))
-        logger.info(f"Batch {batch_id}: Найдено {len(unique_traders)} уникальных трейдеров")
-
-        logger.info(f"Batch {batch_id}: Этап 3 - Получение PNL")
-        trader_chunks = [unique_traders[i:i + TRADERS_CHUNK_SIZE] for i in range(0, len(unique_traders), TRADERS_CHUNK_SIZE)]
-        all_pnl_reports_paths = []
-
-        for chunk in trader_chunks:
-            driver = None
-            try:
-                driver = init_worker_driver()
-                for attempt in range(3):
-                    try:
-                        driver.get("https://discord.com/channels/@me/1331338750789419090")
-                        WebDriverWait(driver, 60).until(EC.presence_of_element_located((By.CSS_SELECTOR, "main[class*='chatContent']")))
-                        break
-                    except (TimeoutException, WebDriverException) as e:
-                        logger.warning(f"Retry {attempt+1}/3 for PNL: {e}")
-                        time.sleep(5)
-                else:
-                    raise Exception("Failed to load Discord DM for PNL")
-
-                pnl_csv_path = perform_pnl_fetch(driver, chunk)
-                if pnl_csv_path:
-                    all_pnl_reports_paths.append(pnl_csv_path)
-                    temp_files_to_clean.append(pnl_csv_path)
-            finally:
-                if driver:
-                    driver.quit()
-                    if hasattr(driver, 'temp_dir') and os.path.exists(driver.temp_dir):
-                        shutil.rmtree(driver.temp_dir, ignore_errors=True)
-                        logger.info(f"Очищен temp: {driver.temp_dir}")
-
-        if not all_pnl_reports_paths:
-            logger.error(f"Batch {batch_id}: Не удалось получить PNL")
-            raise Exception("PNL fetch failed")
-
-        logger.info(f"Batch {batch_id}: Этап 4 - Сохранение в Supabase")
-        df_list = [pd.read_csv(path) for path in all_pnl_reports_paths]
-        merged_df = pd.concat(df_list, ignore_index=True).drop_duplicates(subset=['wallet'])
-
-        # ЧИСТКА ДАННЫХ: Конвертируем numeric, invalid -> NaN -> None
-        numeric_cols = [
-            "balance", "wsol_balance", "roi_7d", "roi_30d", "winrate_7d", "winrate_30d",
-            "avg_holding_time", "usd_profit_7d", "usd_profit_30d", "avg_token_age_7d", "avg_token_age_30d",
-            "top_three_pnl", "avg_quick_buy_and_sell_percentage", "avg_bundled_token_buys_percentage",
-            "avg_sold_more_than_bought_percentage", "avg_first_buy_mcap_7d", "total_buys_7d", "pf_buys_7d",
-            "pf_swap_buys_7d", "bonk_buys_7d", "raydium_buys_7d", "boop_buys_7d", "meteora_buys_7d",
-            "avg_first_buy_mcap_30d", "total_buys_30d", "pf_buys_30d", "pf_swap_buys_30d", "bonk_buys_30d",
-            "raydium_buys_30d", "boop_buys_30d", "meteora_buys_30d", "avg_buys_per_token_7d",
-            "avg_buys_per_token_30d", "total_sells_7d", "total_sells_30d", "avg_forwarder_tip",
-            "avg_token_cost_7d", "avg_token_cost_30d", "unrealised_pnl_7d", "unrealised_pnl_30d",
-            "total_cost_7d", "total_cost_30d", "traded_tokens"  # traded_tokens integer
-        ]
-        for col in numeric_cols:
-            if col in merged_df.columns:
-                merged_df[col] = pd.to_numeric(merged_df[col], errors='coerce')
-
-        batch_data = []
-        for _, row in merged_df.iterrows():
-            batch_entry = {
-                "batch_id": batch_id,
-                "batch_created_at": batch_created_at.isoformat(),
-                "wallet": row["wallet"],
-                "last_trade_time": row.get("last_trade_time"),
-            }
-            for col in numeric_cols:
-                val = row.get(col)
-                batch_entry[col] = None if pd.isna(val) else val
-            batch_data.append(batch_entry)
-
-        response = supabase_service.client.table("pnl_batches").insert(batch_data).execute()
-        logger.info(f"Batch {batch_id}: Сохранено {len(batch_data)} записей в Supabase")
 
-    except Exception as e:
-        logger.error(f"Batch {batch_id}: Ошибка - {e}")
+@celery.task
+def run_all_in_parse_periodic_task(template: dict):
+    # Аренда с коротким TTL живёт весь DAG (подзадачи + keepalive) и снимается
+    # в finalize/errback; прогон убитого воркера освобождает её не позже чем
+    # через PERIODIC_STALL_TIMEOUT + PERIODIC_LEASE_TTL
+    lease = Lease(redis, PERIODIC_LEASE_NAME, ttl=PERIODIC_LEASE_TTL)
+    if not lease.acquire():
+        logger.info("Periodic task already running, skipping.")
+        return
+    batch_created_at = datetime.now(timezone.utc)
+    ctx = {
+        "batch_id": str(uuid.uuid4()),
+        "batch_created_at": batch_created_at.isoformat(),
+        "template": template,
+        "mode": "store",
+        "run_key": "periodic",
+        "priority": PRIORITY_BACKGROUND,
+        "lease": {"token": lease.token, "fence": lease.fence},
+    }
+    try:
+        _keep_lease(ctx)
+        all_in_lease_keepalive.apply_async((ctx["lease"],), countdown=PERIODIC_LEASE_TTL / 3,
+                                           priority=PRIORITY_BACKGROUND)
+        _start_all_in_pipeline(ctx)
+    except Exception:
+        _fail(ctx)
         raise
-    finally:
-        for f_path in temp_files_to_clean:
-            if os.path.exists(f_path):
-                os.remove(f_path)
-        redis.delete(lock_key)
-        logger.info(f"Batch {batch_id}: Временные файлы очищены")
+
 
 @celery.task
-def run_all_in_parse_periodic_task(template: dict):
-    async_to_sync(_run_all_in_parse_periodic_task_async)(template)
-    
-async def _all_in_parse_pipeline_async(chat_id: int, template: dict, message_id: int):
+def run_all_in_parse_pipeline_task_wrapper(chat_id: int, template: dict, message_id: int, priority: int = PRIORITY_DEFAULT):
+    """
+    Запуск 'All-In Parse' пользователя: редактирует уже отправленное
+    сообщение очереди и раскладывает пайплайн на DAG подзадач.
+    """
+    ctx = {
+        "batch_id": str(uuid.uuid4()),
+        "template": template,
+        "mode": "deliver",
+        "chat_id": chat_id,
+        "message_id": message_id,
+        "run_key": f"user:{chat_id}:{template.get('id')}",
+        "priority": priority,   # полоса пользователя сохраняется для всех подзадач DAG
+        "started_at": time.time(),
+    }
+    _notify(ctx, (
+        f"✅ Ваша очередь подошла! Начинаю 'All-In Parse' по шаблону '{template.get('template_name', '...')}'.\n\n"
+        "Это может занять много времени. Я буду присылать файлы по мере готовности."
+    ))
+    try:
+        _start_all_in_pipeline(ctx)
+    except Exception as e:
+        logger.error(f"CELERY_ERROR: 'All-In Parse' провалился: {e}")
+        _notify(ctx, "❌ Произошла критическая ошибка во время 'All-In Parse'.")
+        _fail(ctx)
+        raise
+
+
+# ─────────────────────────────────────────────────────────────────────────────
+#  Задачи пользователя по .txt-файлу. Список адресов приходит ссылкой на
+#  payload store (services/payload_store.py), а не JSON-массивом в брокере.
+# ─────────────────────────────────────────────────────────────────────────────
+
+async def _send_result(chat_ids, data: bytes | None, filename: str, caption: str, error_text: str):
     """
-    Асинхронная версия пайплайна.
-    ИСПРАВЛЕНО: Принимает message_id и редактирует существующее сообщение.
+    Один и тот же результат всем, кто ждал эту задачу (services/job_dedup.py):
+    файл загружается один раз, остальным чатам уходит его file_id.
     """
     bot = Bot(token=config.TELEGRAM_BOT_TOKEN)
-    temp_files_to_clean = []
-    
+    delivery = TelegramDelivery(bot)
+    markup = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад в меню", callback_data="main_menu")]])
+    digest = hashlib.sha256(data).hexdigest() if data else None
+    for chat_id in chat_ids:
+        try:
+            if data:
+                await file_id_cache.send_document(bot, chat_id, digest, data, filename=filename,
+                                                  caption=caption, reply_markup=markup)
+            else:
+                await delivery.send_message(chat_id, error_text, reply_markup=markup)
+        except Exception as e:
+            logger.warning(f"Не удалось отправить результат в чат {chat_id}: {e}")
+
+
+def _finish_job(job_type: str, input_ref: str, chat_id: int, path: str | None, caption: str, error_text: str,
+                cache: bool = True):
+    """
+    Кэширует результат задачи и раздаёт его инициатору и присоединившимся чатам.
+    cache=False — результат неполный: отправляется, но как готовый отчёт не кэшируется.
+    """
+    data = None
+    if path:
+        with open(path, "rb") as f:
+            data = f.read()
+    coalescer = default_coalescer()
+    if cache:
+        _, waiters = coalescer.complete(job_type, input_ref, data)
+    else:
+        waiters = coalescer.fail(job_type, input_ref)
+    _sync(_send_result)(sorted({chat_id, *waiters}), data, RESULT_FILENAMES[job_type], caption, error_text)
+
+
+@celery.task
+def run_pnl_fetch_task(chat_id: int, wallets_ref: str):
+    """PNL по списку кошельков; пакеты по TRADERS_CHUNK_SIZE на одном драйвере."""
+    csv_paths, final_csv_path = [], None
+    caption = f"✅ Ваш PNL-отчет готов. В файле статистика для {ref_size(wallets_ref)} кошельков."
     try:
-        # --- Уведомление о старте ---
-        # Это сообщение теперь редактирует то, что уже есть в чате
-        start_text = (
-            f"✅ Ваша очередь подошла! Начинаю 'All-In Parse' по шаблону '{template.get('template_name', '...')}'.\n\n"
-            "Это может занять много времени. Я буду присылать файлы по мере готовности."
-        )
-        await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=start_text, disable_web_page_preview=True)
-
-        # --- ЭТАП 1: GET TOKENS ---
-        # Уведомления об этапах теперь тоже отправляются как новые сообщения
-        await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=f"🚀 Этап 1/3: Поиск токенов...", disable_web_page_preview=True)
-        hours = int(template.get('time_period', '24h').replace('h', ''))
-        start_time = datetime.now(timezone.utc) - timedelta(hours=hours)
-        categories = [cat for cat in template.get('categories', []) if cat in ['completed', 'completing']]
-        tokens = await supabase_service.fetch_tokens_by_criteria(start_time, template.get('platforms', []), categories)
+        # внутри try: истёкшая ссылка (PayloadMissing) тоже доходит до _finish_job
+        wallets = default_store().get(wallets_ref)
+
+        def _fetch_all(driver):
+            return [perform_pnl_fetch(driver, chunk) for chunk in _chunks(wallets, TRADERS_CHUNK_SIZE)]
+
+        results = _with_driver(_fetch_all)
+        csv_paths = [p for p in results if p and os.path.exists(p)]
+        missing = len(results) - len(csv_paths)
+        if missing and csv_paths:
+            caption += f"\n⚠️ {missing} из {len(results)} пакетов не получены — отчёт неполный."
+        if len(csv_paths) > 1:
+            final_csv_path = os.path.join(config.FILES_DIR, f"pnl_merged_{uuid.uuid4()}.csv")
+            pd.concat([pd.read_csv(p) for p in csv_paths], ignore_index=True).to_csv(final_csv_path, index=False)
+        elif csv_paths:
+            final_csv_path = csv_paths[0]
+        # неполный отчёт не кэшируется: повторный запрос того же списка посчитает его заново
+        _finish_job(JOB_PNL, wallets_ref, chat_id, final_csv_path, caption,
+                    "❌ Не удалось получить ни одного отчета от Discord-бота.", cache=not missing)
+    except Exception as e:
+        logger.error(f"CELERY_ERROR: PNL по списку для {chat_id} провалился: {e}")
+        _finish_job(JOB_PNL, wallets_ref, chat_id, None, caption, "❌ Произошла ошибка при получении PNL.")
+    finally:
+        for path in {*csv_paths, final_csv_path}:
+            if path and os.path.exists(path):
+                os.remove(path)
 
-        if not tokens:
-            await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text="❌ Не найдено токенов по вашему шаблону. Задача остановлена.", disable_web_page_preview=True)
-            return
 
-        token_addresses = [t['contract_address'] for t in tokens]
-        await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=f"✅ Этап 1 завершен. Найдено {len(tokens)} токенов.", disable_web_page_preview=True)
-
-        # --- ЭТАП 2: GET TOP TRADERS ---
-        await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=f"👥 Этап 2/3: Получение трейдеров для {len(token_addresses)} токенов. Это может занять время...", disable_web_page_preview=True)
-        
-        token_chunks = [token_addresses[i:i + TOKENS_CHUNK_SIZE] for i in range(0, len(token_addresses), TOKENS_CHUNK_SIZE)]
-        all_traders_files = []
-        
-        for i, chunk in enumerate(token_chunks, 1):
-            if len(token_chunks) > 1:
-                await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=f"👥 Этап 2/3: Обрабатываю пакет токенов {i} из {len(token_chunks)}...", disable_web_page_preview=True)
-            
-            driver_traders = None
-            try:
-                with tempfile.NamedTemporaryFile(delete=False, mode='w', suffix=".txt", encoding='utf-8') as tmp_f:
-                    tmp_f.write("\n".join(chunk))
-                    temp_filepath = tmp_f.name
-                    temp_files_to_clean.append(temp_filepath)
-                
-                driver_traders = init_worker_driver()
-                result_path = perform_toplevel_traders_fetch(driver_traders, temp_filepath)
-                if result_path:
-                    all_traders_files.append(result_path)
-            finally:
-                if driver_traders: driver_traders.quit()
-
-        if not all_traders_files:
-             await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text="❌ Не удалось получить список трейдеров. Задача остановлена.", disable_web_page_preview=True)
-             raise Exception("Top Traders fetch failed")
-
-        final_trader_list = []
-        for path in all_traders_files:
-            with open(path, 'r', encoding='utf-8') as f:
-                final_trader_list.extend([line.strip() for line in f if line.strip() and not line.startswith('---')])
-            temp_files_to_clean.append(path)
-        
-        await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text="✅ Этап 2 завершен. Список трейдеров собран.", disable_web_page_preview=True)
-
-        # --- ЭТАП 3: GET PNL ---
-        unique_traders = list(set(final_trader_list))
-        if not unique_traders:
-            await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text="⚠️ Трейдеры для анализа PNL не найдены. Завершаю задачу.", disable_web_page_preview=True)
-            return
+@celery.task
+def run_traders_fetch_task(chat_id: int, addresses_ref: str):
+    """Топ-трейдеры по списку токенов; адреса пишутся во входной файл прямо из хранилища."""
+    input_path = result_path = None
+    caption = "✅ Список топ-трейдеров готов."
+    try:
+        input_path = _payload_to_file(addresses_ref)
+        result_path = _with_driver(perform_toplevel_traders_fetch, input_path)
+        _finish_job(JOB_TOP_TRADERS, addresses_ref, chat_id, result_path, caption,
+                    "❌ Не удалось получить трейдеров от Discord-бота.")
+    except Exception as e:
+        logger.error(f"CELERY_ERROR: топ-трейдеры для {chat_id} провалились: {e}")
+        _finish_job(JOB_TOP_TRADERS, addresses_ref, chat_id, None, caption, "❌ Произошла ошибка при получении трейдеров.")
+    finally:
+        for path in (input_path, result_path):
+            if path and os.path.exists(path):
+                os.remove(path)
+
 
-        await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=f"📊 Этап 3/3: Получение PNL для {len(unique_traders)} трейдеров.", disable_web_page_preview=True)
-        
-        trader_chunks = [unique_traders[i:i + TRADERS_CHUNK_SIZE] for i in range(0, len(unique_traders), TRADERS_CHUNK_SIZE)]
-        all_pnl_reports_paths = []
-        
-        for i, chunk in enumerate(trader_chunks, 1):
-            if len(trader_chunks) > 1:
-                await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=f"🪓 Обрабатываю PNL-пакет {i} из {len(trader_chunks)}...", disable_web_page_preview=True)
-            
-            driver_pnl = None
-            try:
-                driver_pnl = init_worker_driver()
-                pnl_csv_path = perform_pnl_fetch(driver_pnl, chunk)
-                if pnl_csv_path:
-                    all_pnl_reports_paths.append(pnl_csv_path)
-                    temp_files_to_clean.append(pnl_csv_path)
-            finally:
-                if driver_pnl: driver_pnl.quit()
-
-        if not all_pnl_reports_paths:
-            await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text="❌ Не удалось получить ни одного PNL отчета. Задача прервана.", disable_web_page_preview=True)
-            raise Exception("PNL fetch failed")
-
-        # --- ЭТАП 4: ОБЪЕДИНЕНИЕ И ОТПРАВКА PNL ---
-        await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=f"🖇️ Этап 4/4: Объединение и фильтрация PNL-отчетов...", disable_web_page_preview=True)
-        
-        df_list = [pd.read_csv(path) for path in all_pnl_reports_paths]
-        merged_df = pd.concat(df_list, ignore_index=True).drop_duplicates(subset=['wallet'])
-        
-        # --- НОВЫЙ ШАГ: ПРИМЕНЯЕМ ПРОДВИНУТЫЕ ФИЛЬТРЫ ---
-        pnl_filters = template.get('pnl_filters', {})
-        if pnl_filters:
-            logger.info(f"Applying PNL filters: {pnl_filters}")
-            filtered_df = apply_pnl_filters(merged_df, pnl_filters)
-        else:
-            filtered_df = merged_df # Если фильтров нет, используем объединенный DF
-        # ----------------------------------------------------
-
-        final_filename = f"all_in_parse_final_pnl_{uuid.uuid4()}.csv"
-        final_csv_path = os.path.join(config.FILES_DIR, final_filename)
-        filtered_df.to_csv(final_csv_path, index=False) # Сохраняем отфильтрованный DF
-        temp_files_to_clean.append(final_csv_path)
-
-        caption = (
-            f"✅ All-In Parse завершен!\n\n"
-            f"Анализ на основе:\n"
-            f"  - Токенов найдено: {len(tokens)}\n"
-            f"  - Уникальных трейдеров: {len(unique_traders)}\n\n"
-            f"В этом файле финальный PNL-отчет для {len(filtered_df)} трейдеров (после фильтрации)."
-        )
-        
-        back_button_markup = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад в меню", callback_data="main_menu")]])
-        with open(final_csv_path, "rb") as f:
-            await bot.send_document(
-                chat_id=chat_id, document=f,
-                caption=caption,
-                reply_markup=back_button_markup,
-            )
-        
-        await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text="Все готово!", disable_web_page_preview=True)
-        
+@celery.task
+def run_swaps_fetch_task(program: str, interval: str, chat_id: int):
+    """Swaps программы за интервал (Program Parse) через Discord-бота; CSV уходит в чат."""
+    result_path = None
+    try:
+        result_path = _with_driver(perform_program_swaps, program, interval)
+        data = None
+        if result_path:
+            with open(result_path, "rb") as f:
+                data = f.read()
+        _sync(_send_result)([chat_id], data, f"swaps_{program[:8]}_{interval}.csv",
+                                    f"✅ Swaps программы `{program}` за {interval} готовы.",
+                                    "❌ Не удалось получить swaps от Discord-бота.")
     except Exception as e:
-        print(f"CELERY_ERROR: 'All-In Parse' провалился: {e}")
-        error_text = f"❌ Произошла критическая ошибка во время 'All-In Parse'."
-        try:
-            await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=error_text, disable_web_page_preview=True)
-        except:
-            await bot.send_message(chat_id=chat_id, text=error_text, disable_web_page_preview=True)
+        logger.error(f"CELERY_ERROR: swaps {program} для {chat_id} провалились: {e}")
+        _sync(_send_result)([chat_id], None, "", "", "❌ Произошла ошибка при получении swaps.")
     finally:
-        for f_path in temp_files_to_clean:
-            if os.path.exists(f_path):
-                os.remove(f_path)
-        print("CELERY_TASK: 'All-In Parse' завершен, временные файлы очищены.")
\ No newline at end of file
+        if result_path and os.path.exists(result_path):
+            os.remove(result_path)
+
+
+async def _token_parse_export(chat_id: int, settings: dict):
+    lang = settings.get("lang", "en")
+    hours = int(settings.get("period", "24h").replace("h", ""))
+    start_time = datetime.now(timezone.utc) - timedelta(hours=hours)
+    platforms = settings.get("platforms") or []
+    categories = settings.get("categories") or []
+    client = await get_client()
+
+    def make_query():
+        query = client.table("tokens").select("contract_address, ticker, name, migration_time, launchpad, category")
+        query = query.gte("migration_time", start_time.isoformat())
+        if platforms:
+            query = query.in_("launchpad", platforms)
+        if categories and set(categories) != set(config.TOKEN_CATEGORIES):
+            query = query.in_("category", categories)
+        return query.order("migration_time")
+
+    bot = Bot(token=config.TELEGRAM_BOT_TOKEN)
+    markup = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад в меню", callback_data="main_menu")]])
+    fieldnames = ["contract_address", "ticker", "name", "migration_time", "launchpad", "category"]
+    with ExportWriter(f"tokens_{datetime.now(timezone.utc).strftime('%Y%m%d_%H%M%S')}", fieldnames) as writer:
+        async for row in iter_query_rows(make_query):
+            writer.write_row(row)
+    if not writer.total_rows:
+        writer.discard()
+        await TelegramDelivery(bot).send_message(chat_id, get_text(lang, "no_tokens_found"), reply_markup=markup)
+        return
+    await send_export(bot, chat_id, writer.parts, get_text(lang, "csv_caption").format(writer.total_rows), reply_markup=markup)
+
+
+@celery.task
+def run_token_parse_task(chat_id: int, settings: dict):
+    """Token Parse в фоне: выгрузка токенов по платформам / периоду / категориям из настроек пользователя."""
+    try:
+        _sync(_token_parse_export)(chat_id, settings)
+    except Exception as e:
+        logger.error(f"CELERY_ERROR: Token Parse для {chat_id} провалился: {e}")
+        _sync(_send_result)([chat_id], None, "", "", "❌ Произошла ошибка при выгрузке токенов.")
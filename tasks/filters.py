@@ -1,3 +1,6 @@
+import pandas as pd
+
+
 def apply_pnl_filters(df: pd.DataFrame, filters: dict) -> pd.DataFrame:
     """Применяет сохраненные PNL-фильтры к DataFrame."""
     if not filters:
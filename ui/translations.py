@@ -121,6 +121,7 @@ TRANSLATIONS = {
         "pnl_filter_invalid_range": "Минимум не может быть больше максимума. Пожалуйста, введите корректный диапазон.",
         "pnl_filter_invalid_input": "❗️ Неверный формат. Введите одно число, два числа или `0` для сброса.",
         "prompt_send_txt_file": "Пожалуйста, отправьте .txt файл со списком адресов.",
+        "heavy_op_busy": "⏳ Предыдущая операция ещё выполняется. Дождитесь её завершения.",
 
         # Template management additions
         "template_manage_title": "🗂️ Управление шаблонами All-in parse:",
@@ -132,7 +133,7 @@ TRANSLATIONS = {
         "template_not_found_error": "❌ Шаблон не найден.",
         "template_editing_prompt": "✏️ Редактируем шаблон '{}':",
         "template_deleted": "🗑️ Шаблон удален. Ваши шаблоны:",
-        "all_in_parse_queued": "⏳ Ваш 'All-In Parse' принят. Вы {}-й в очереди.\n\nЗадача запустится, как только освободится воркер."
+        "all_in_parse_queued": "⏳ Ваш 'All-In Parse' принят. {}\n\nЗадача запустится, как только освободится воркер."
         ,
         "template_view_prompt": "📂 *Ваши шаблоны All-in Parse:*"
         ,
@@ -260,6 +261,7 @@ TRANSLATIONS = {
         "pnl_filter_invalid_range": "Minimum cannot be greater than maximum. Please enter a valid range.",
         "pnl_filter_invalid_input": "❗ Invalid format. Enter one number, two numbers, or `0` to reset.",
         "prompt_send_txt_file": "Please send a .txt file with a list of addresses.",
+        "heavy_op_busy": "⏳ Your previous operation is still running. Please wait for it to finish.",
         "template_creation_started": "🧾 Creating new template '{}':",
         # Template management additions
         "template_manage_title": "🗂️ Template management for All-in parse:",
@@ -271,7 +273,7 @@ TRANSLATIONS = {
         "template_not_found_error": "❌ Template not found.",
         "template_editing_prompt": "✏️ Editing template '{}':",
         "template_deleted": "🗑️ Template deleted. Your templates:",
-        "all_in_parse_queued": "⏳ Your 'All-In Parse' has been accepted. You are {} in queue.\n\nThe task will start when a worker is free."
+        "all_in_parse_queued": "⏳ Your 'All-In Parse' has been accepted. {}\n\nThe task will start when a worker is free."
         ,
         "template_view_prompt": "📂 *Your All-in Parse templates:*"
         ,
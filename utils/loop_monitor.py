@@ -0,0 +1,179 @@
+# utils/loop_monitor.py
+"""
+Мониторинг задержки event loop'а и поиск блокирующих вызовов.
+
+Включается переменной окружения LOOP_MONITOR=1 (по умолчанию выключен):
+
+    monitor = start_from_env("bot")      # внутри работающего loop'а
+
+• Пульс: корутина спит `interval` секунд и меряет, насколько позже
+  проснулась. Задержка (lag) пишется в гистограмму с корзинами
+  LAG_BUCKETS_MS.
+• Сторож: отдельный поток проверяет время последнего пульса. Если loop
+  не отвечает дольше `threshold`, сторож снимает стек потока loop'а
+  (sys._current_frames) — в логе видно, какая корутина и какая строка
+  держат loop (синхронный `.execute()`, `pd.read_csv`, ...). Один стек
+  на одно зависание.
+• Экспорт: раз в `report_every` секунд — строка со сводкой в лог, и,
+  если задан LOOP_MONITOR_PROM_FILE, гистограмма в формате Prometheus
+  textfile (для node_exporter).
+"""
+from __future__ import annotations
+
+import asyncio
+import bisect
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+LOOP_MONITOR_ENABLED = os.getenv("LOOP_MONITOR", "0") == "1"
+LOOP_MONITOR_THRESHOLD = float(os.getenv("LOOP_MONITOR_THRESHOLD", 0.25))   # секунды
+LOOP_MONITOR_INTERVAL = float(os.getenv("LOOP_MONITOR_INTERVAL", 0.1))
+LOOP_MONITOR_REPORT_EVERY = float(os.getenv("LOOP_MONITOR_REPORT_EVERY", 60))
+LOOP_MONITOR_PROM_FILE = os.getenv("LOOP_MONITOR_PROM_FILE")
+
+LAG_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+STACK_LIMIT = 40
+
+
+class LagHistogram:
+    """Накопительная гистограмма задержек (мс), совместимая с Prometheus."""
+
+    def __init__(self, buckets: List[float] = LAG_BUCKETS_MS):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)   # последняя — +Inf
+        self.total = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, lag_ms: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, lag_ms)] += 1
+        self.total += 1
+        self.sum_ms += lag_ms
+        self.max_ms = max(self.max_ms, lag_ms)
+
+    def quantile(self, q: float) -> float:
+        """Верхняя граница корзины, в которую попадает квантиль q."""
+        if not self.total:
+            return 0.0
+        rank, seen = q * self.total, 0
+        for bound, count in zip(self.buckets + [float("inf")], self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max_ms)
+        return self.max_ms
+
+    def prometheus(self, name: str) -> str:
+        lines = ["# TYPE event_loop_lag_ms histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets + ["+Inf"], self.counts):
+            cumulative += count
+            lines.append(f'event_loop_lag_ms_bucket{{loop="{name}",le="{bound}"}} {cumulative}')
+        lines.append(f'event_loop_lag_ms_sum{{loop="{name}"}} {self.sum_ms:.3f}')
+        lines.append(f'event_loop_lag_ms_count{{loop="{name}"}} {self.total}')
+        return "\n".join(lines) + "\n"
+
+
+class LoopMonitor:
+    def __init__(self, name: str, *, threshold: float = LOOP_MONITOR_THRESHOLD,
+                 interval: float = LOOP_MONITOR_INTERVAL, report_every: float = LOOP_MONITOR_REPORT_EVERY,
+                 prom_file: Optional[str] = LOOP_MONITOR_PROM_FILE):
+        self.name = name
+        self.threshold = threshold
+        self.interval = interval
+        self.report_every = report_every
+        self.prom_file = prom_file
+        self.histogram = LagHistogram()
+        self.stalls = 0
+        self._last_beat = time.monotonic()
+        self._loop_thread_id: Optional[int] = None
+        self._captured = False
+        self._task: Optional[asyncio.Task] = None
+        self._stop = threading.Event()
+        self._watchdog: Optional[threading.Thread] = None
+
+    # ─────────── пульс в loop'е ───────────
+    async def _beat(self) -> None:
+        next_report = time.monotonic() + self.report_every
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.histogram.observe(max(0.0, now - started - self.interval) * 1000)
+            self._last_beat = now
+            self._captured = False
+            if now >= next_report:
+                next_report = now + self.report_every
+                self.report()
+
+    # ─────────── сторож в отдельном потоке ───────────
+    def _watch(self) -> None:
+        while not self._stop.wait(self.threshold / 2):
+            blocked = time.monotonic() - self._last_beat - self.interval
+            if blocked >= self.threshold and not self._captured:
+                self._captured = True
+                self.stalls += 1
+                self._dump_stack(blocked)
+
+    def _dump_stack(self, blocked: float) -> None:
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None:
+            return
+        stack = "".join(traceback.format_stack(frame, limit=STACK_LIMIT))
+        logger.warning("LOOP_MONITOR[%s]: loop заблокирован уже %.0f мс, стек:\n%s",
+                       self.name, blocked * 1000, stack)
+
+    # ─────────── отчёт ───────────
+    def snapshot(self) -> Dict[str, float]:
+        h = self.histogram
+        return {
+            "count": h.total,
+            "mean_ms": h.sum_ms / h.total if h.total else 0.0,
+            "p50_ms": h.quantile(0.5),
+            "p99_ms": h.quantile(0.99),
+            "max_ms": h.max_ms,
+            "stalls": self.stalls,
+        }
+
+    def report(self) -> None:
+        s = self.snapshot()
+        logger.info("LOOP_MONITOR[%s]: lag p50≤%.0fms p99≤%.0fms max=%.0fms, зависаний=%d (замеров %d)",
+                    self.name, s["p50_ms"], s["p99_ms"], s["max_ms"], s["stalls"], s["count"])
+        if self.prom_file:
+            tmp = f"{self.prom_file}.tmp"
+            try:
+                with open(tmp, "w") as f:
+                    f.write(self.histogram.prometheus(self.name))
+                    f.write(f'event_loop_stalls_total{{loop="{self.name}"}} {self.stalls}\n')
+                os.replace(tmp, self.prom_file)
+            except OSError as e:
+                logger.warning("LOOP_MONITOR[%s]: не удалось записать %s: %s", self.name, self.prom_file, e)
+
+    # ─────────── запуск / остановка ───────────
+    def start(self) -> "LoopMonitor":
+        """Вызывать из работающего loop'а."""
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._task = asyncio.get_running_loop().create_task(self._beat(), name=f"loop-monitor-{self.name}")
+        self._watchdog = threading.Thread(target=self._watch, name=f"loop-monitor-{self.name}", daemon=True)
+        self._watchdog.start()
+        logger.info("LOOP_MONITOR[%s]: включён (порог %.0f мс)", self.name, self.threshold * 1000)
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+
+
+def start_from_env(name: str) -> Optional[LoopMonitor]:
+    """Запускает монитор, если LOOP_MONITOR=1; иначе ничего не делает."""
+    if not LOOP_MONITOR_ENABLED:
+        return None
+    return LoopMonitor(name).start()
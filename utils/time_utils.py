@@ -0,0 +1,81 @@
+# utils/time_utils.py
+"""
+Общие хелперы для времени: векторная нормализация block_time и ISO-сериализация.
+
+Все значения приводятся к tz-aware UTC. Используется воркером трекера
+(bundle_tracker_worker), alert_worker и jobs/check_bundle_alerts.
+"""
+from __future__ import annotations
+
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+import pandas as pd
+from pandas.api import types as ptypes
+
+ISO_UTC_FORMAT = "%Y-%m-%dT%H:%M:%S.%f+00:00"
+
+
+def normalize_timestamps(values: pd.Series) -> pd.Series:
+    """
+    Приводит колонку времени к dtype datetime64[ns, UTC] без построчного apply.
+
+    • числа → unix-секунды (`unit='s'`);
+    • datetime64 → локализация/конвертация в UTC;
+    • строки/смешанные объекты → числа как unix-секунды, остальное через
+      ISO-парсер; naive-значения считаются UTC, мусор → NaT.
+    """
+    s = pd.Series(values)
+    if ptypes.is_datetime64_any_dtype(s):
+        return s.dt.tz_localize("UTC") if s.dt.tz is None else s.dt.tz_convert("UTC")
+    if ptypes.is_bool_dtype(s):
+        return pd.Series(pd.NaT, index=s.index, dtype="datetime64[ns, UTC]")
+    if ptypes.is_numeric_dtype(s):
+        return pd.to_datetime(s, unit="s", utc=True, errors="coerce")
+
+    numeric = pd.to_numeric(s, errors="coerce")
+    is_num = numeric.notna()
+    out = pd.Series(pd.NaT, index=s.index, dtype="datetime64[ns, UTC]")
+    if is_num.any():
+        out[is_num] = pd.to_datetime(numeric[is_num], unit="s", utc=True, errors="coerce")
+    rest = ~is_num & s.notna()
+    if rest.any():
+        out[rest] = pd.to_datetime(s[rest].astype(str), utc=True, errors="coerce", format="ISO8601")
+    return out
+
+
+def timestamps_to_iso(values: pd.Series) -> pd.Series:
+    """ISO-строки (UTC) для нормализованной колонки; NaT → None. Для записи в Supabase."""
+    s = normalize_timestamps(values)
+    return s.dt.strftime(ISO_UTC_FORMAT).astype(object).where(s.notna(), None)
+
+
+def to_utc(value: datetime) -> datetime:
+    """naive → считаем UTC, aware → конвертируем в UTC."""
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+
+
+def utc_iso(value: datetime) -> str:
+    return to_utc(value).isoformat()
+
+
+def window_start(minutes: float, now: Optional[datetime] = None) -> datetime:
+    """Начало окна `minutes` минут назад от now (UTC)."""
+    now = datetime.now(timezone.utc) if now is None else to_utc(now)
+    return now - timedelta(minutes=minutes)
+
+
+def window_start_iso(minutes: float, now: Optional[datetime] = None) -> str:
+    return window_start(minutes, now).isoformat()
+
+
+def parse_iso(value) -> Optional[datetime]:
+    """Строка ISO из Supabase (или datetime) → aware UTC datetime; мусор → None."""
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return to_utc(value)
+    try:
+        return to_utc(datetime.fromisoformat(str(value).replace("Z", "+00:00")))
+    except ValueError:
+        return None
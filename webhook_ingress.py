@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+webhook_ingress.py
+Приёмник webhook'а Telegram перед репликами бота.
+
+Ничего не обрабатывает: проверяет секрет, раскладывает апдейт в Redis-
+очередь его шарда (services/update_queue.py) и сразу отвечает 200.
+Реплики bot.py с BOT_MODE=worker разбирают свои шарды. Приёмников
+может быть несколько за балансировщиком — состояния у них нет.
+
+    WEBHOOK_BOT=bot|bot_lite       какой токен регистрировать
+    WEBHOOK_URL=https://.../tg     публичный адрес (setWebhook при старте)
+    WEBHOOK_SECRET=...             X-Telegram-Bot-Api-Secret-Token
+    WEBHOOK_PORT=8080, WEBHOOK_PATH=/tg
+"""
+
+import logging, os
+
+from aiohttp import web
+from dotenv import load_dotenv
+from telegram import Bot, Update
+
+load_dotenv()
+
+import config
+from services.redis_pool import close_async_redis
+from services.update_queue import BOT_SHARDS, push_update
+
+WEBHOOK_BOT = os.getenv("WEBHOOK_BOT", "bot")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/tg")
+TOKENS = {"bot": config.TELEGRAM_BOT_TOKEN, "bot_lite": config.TELEGRAM_BOT_LITE_TOKEN}
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+logger = logging.getLogger(__name__)
+
+
+async def handle_update(request: web.Request) -> web.Response:
+    if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return web.Response(status=403)
+    raw = await request.read()
+    try:
+        await push_update(WEBHOOK_BOT, raw)
+    except ValueError:
+        return web.Response(status=400)
+    # ошибка Redis → 500, Telegram повторит доставку сам
+    return web.Response()
+
+
+async def on_startup(app: web.Application) -> None:
+    if WEBHOOK_URL:
+        async with Bot(TOKENS[WEBHOOK_BOT]) as bot:
+            await bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET,
+                                  allowed_updates=Update.ALL_TYPES)
+        logger.info("Webhook %s → %s (%d шардов)", WEBHOOK_BOT, WEBHOOK_URL, BOT_SHARDS)
+
+
+async def on_cleanup(app: web.Application) -> None:
+    await close_async_redis()
+
+
+def build_app() -> web.Application:
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_update)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+if __name__ == "__main__":
+    if not config.REDIS_URL:
+        raise SystemExit("webhook_ingress требует REDIS_URL")
+    web.run_app(build_app(), port=WEBHOOK_PORT)